@@ -1,7 +1,25 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from app.routes import router
+from app.config import Config
+from app.container import AppContainer
+from app.routes import router, prometheus_router
+from app.uploads import UploadSizeLimitMiddleware
+from app import tracing
+
+@asynccontextmanager
+async def lifespan(app):
+    """Build the services on startup (once per server process) and close them on shutdown"""
+    app.state.container = AppContainer()
+    try:
+        await app.state.container.start()
+        yield
+    finally:
+        await app.state.container.close()
 
 def create_app():
-    app = FastAPI(title="LLM Rate Limiter API")
+    app = FastAPI(title="LLM Rate Limiter API", lifespan=lifespan)
+    app.add_middleware(UploadSizeLimitMiddleware, max_bytes=Config.UPLOAD_MAX_REQUEST_BYTES)
     app.include_router(router, prefix="/llm", tags=["llm"])
-    return app
\ No newline at end of file
+    app.include_router(prometheus_router, tags=["metrics"])
+    tracing.instrument_app(app)
+    return app
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+from app.llm_processor import estimate_tokens
+from app.utils import custom_logging
+from app import metrics
+
+logger = custom_logging(__name__)
+
+# Structured output for a batched call: one {id, answer} object per item, so
+# answers are matched to items by id rather than by position.
+BATCH_ANSWER_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"id": {"type": "INTEGER"}, "answer": {"type": "STRING"}},
+        "required": ["id", "answer"],
+    },
+}
+
+
+def parse_batch_answers(response, count):
+    """Answers of a batched call by item index; items the model skipped are missing."""
+    answers = {}
+    for entry in json.loads(response or "[]"):
+        if isinstance(entry, dict) and isinstance(entry.get("id"), int) and 0 <= entry["id"] < count:
+            answers[entry["id"]] = entry.get("answer")
+    return answers
+
+
+class MicroBatcher:
+    """
+    Collects items for up to `max_wait` seconds or `max_items`, whichever comes
+    first, and hands them to `flush` as one batch. `flush(items)` returns one
+    result per item, in order; each submitter gets its own result, or the
+    batch's exception. Reports `batched_calls` and `batched_items`, labelled with the batcher name.
+    """
+
+    def __init__(self, name, flush, max_items, max_wait):
+        self.name = name
+        self.flush = flush
+        self.max_items = max_items
+        self.max_wait = max_wait  # Seconds
+        self._pending = []  # (item, future)
+        self._timer = None
+        self._batches = set()
+
+    async def submit(self, item):
+        """Add an item to the next batch and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_items:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush_pending)
+        return await future
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run(self, batch):
+        # Submitters that went away meanwhile are left out
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        metrics.counter("batched_calls", batcher=self.name).inc()
+        metrics.counter("batched_items", batcher=self.name).inc(len(batch))
+        try:
+            results = await self.flush([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Batch of {len(batch)} items returned {len(results)} results")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class PromptBatcher:
+    """
+    Opt-in micro-batcher in front of the LLM processor for short text-only prompts.
+
+    Prompts that arrive within `max_wait` of each other are sent as one call:
+    the batch takes a single permit, charged the sum of the prompts' token
+    estimates, and asks for one answer per prompt as structured output. A batch
+    of one is sent as a plain call. Prompts the model skipped in its answer are
+    retried on their own. A batch waits for its permit no longer than the
+    earliest client deadline among its prompts.
+    """
+
+    INPUT_TYPE = "text_only"
+
+    def __init__(self, llm_processor, semaphore_manager, max_items, max_wait, max_chars):
+        self.llm_processor = llm_processor
+        self.semaphore_manager = semaphore_manager
+        self.max_chars = max_chars  # Longer prompts are never batched
+        self.batcher = MicroBatcher("prompts", self._send, max_items, max_wait)
+
+    def accepts(self, input_type, input_data):
+        """Whether a request can be batched: a short text-only prompt."""
+        text = input_data.get("text")
+        return (
+            input_type == self.INPUT_TYPE and not input_data.get("files")
+            and bool(text) and len(text) <= self.max_chars
+        )
+
+    async def process(self, input_data, deadline=None):
+        """
+        Answer one prompt as part of the next batch. `deadline` is the monotonic
+        time by which the client wants an answer, if it sent one. Raises
+        TimeoutError if no permit is granted.
+        """
+        return await self.batcher.submit((input_data["text"], deadline))
+
+    async def _call(self, input_data, deadlines, response_schema=None):
+        """One upstream call under one permit, charged the whole call's token estimate."""
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        lease = await self.semaphore_manager.acquire_semaphore(
+            self.INPUT_TYPE, tokens=estimate_tokens(input_data), budget=self.llm_processor.budgets,
+            max_wait=max(0, min(deadlines) - time.monotonic()) if deadlines else None
+        )
+        try:
+            return await self.llm_processor.process_llm_request(input_data, lease, response_schema=response_schema)
+        finally:
+            await self.semaphore_manager.release_semaphore(lease)
+
+    async def _send(self, items):
+        texts = [text for text, _ in items]
+        deadlines = [deadline for _, deadline in items]
+        if len(texts) == 1:
+            return [await self._call({"text": texts[0]}, deadlines)]
+
+        prompt = (
+            "Answer each of the following prompts independently, as if it were the only one. "
+            "Return one entry per prompt with its id and your full answer.\n\n"
+            + json.dumps([{"id": i, "prompt": text} for i, text in enumerate(texts)], ensure_ascii=False)
+        )
+        answers = parse_batch_answers(
+            await self._call({"text": prompt}, deadlines, response_schema=BATCH_ANSWER_SCHEMA), len(texts)
+        )
+        missing = [i for i in range(len(texts)) if not answers.get(i)]
+        if missing:
+            logger.warning(f"Batched call skipped {len(missing)} of {len(texts)} prompts; sending them on their own")
+            retried = await asyncio.gather(*[self._call({"text": texts[i]}, [deadlines[i]]) for i in missing])
+            answers.update(zip(missing, retried))
+        return [answers[i] for i in range(len(texts))]
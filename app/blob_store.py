@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import os
+import time
+import tempfile
+import redis.asyncio as redis
+from app.uploads import map_file
+from app.utils import custom_logging
+
+logger = custom_logging(__name__)
+
+
+def blob_ref(data):
+    """Content address of a blob: the hex SHA-256 of its bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """Content-addressed storage for uploaded file bytes, so queue entries only carry references."""
+
+    async def put(self, data, ref=None):
+        """Store `data` (deduplicated by content) and return its reference."""
+        raise NotImplementedError("Subclasses must implement put")
+
+    async def get(self, ref):
+        """Return the blob's bytes (or a read-only memoryview over them), or None if it is gone."""
+        raise NotImplementedError("Subclasses must implement get")
+
+    async def release(self, ref):
+        """Drop one reference taken by put(), once the entry that carried it is done with it."""
+        pass
+
+    async def initialize(self):
+        pass
+
+    async def cleanup(self):
+        pass
+
+
+class RedisBlobStore(BlobStore):
+    """
+    Blobs as Redis strings, counted by reference: each put() takes one and each
+    release() drops one, and the last release deletes the blob. Blobs whose
+    references are never released (e.g. an entry that was lost) expire `ttl`
+    seconds after they were last stored.
+    """
+
+    KEY_PREFIX = "blob:"
+
+    # Identical uploads share one copy; storing again adds a reference and extends its lifetime
+    PUT_LUA = """
+    if not redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2], 'NX') then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    """
+
+    RELEASE_LUA = """
+    local refs = redis.call('DECR', KEYS[2])
+    if refs <= 0 then
+        redis.call('DEL', KEYS[1], KEYS[2])
+    end
+    return refs
+    """
+
+    def __init__(self, redis_url, ttl):
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.redis_client = None
+        self.scripts = {}
+
+    async def initialize(self):
+        """Initialize a binary-safe Redis connection."""
+        if self.redis_client is None:
+            self.redis_client = await redis.from_url(self.redis_url)
+            self.scripts = {
+                "put": self.redis_client.register_script(self.PUT_LUA),
+                "release": self.redis_client.register_script(self.RELEASE_LUA),
+            }
+
+    def _refs_key(self, ref):
+        return f"{self.KEY_PREFIX}{ref}:refs"
+
+    async def put(self, data, ref=None):
+        ref = ref or blob_ref(data)
+        await self.scripts["put"](keys=[self.KEY_PREFIX + ref, self._refs_key(ref)], args=[data, self.ttl])
+        return ref
+
+    async def release(self, ref):
+        await self.scripts["release"](keys=[self.KEY_PREFIX + ref, self._refs_key(ref)])
+
+    async def get(self, ref):
+        return await self.redis_client.get(self.KEY_PREFIX + ref)
+
+    async def cleanup(self):
+        """Cleanup resources when shutting down."""
+        if self.redis_client:
+            await self.redis_client.close()
+
+
+class FileBlobStore(BlobStore):
+    """
+    Blobs as files under a shared directory, e.g. a volume mounted by API and worker pods.
+    Reads are memory-mapped, so bytes are not copied into the process until used.
+    Like Redis blobs, a file is deleted `ttl` seconds after it was last stored: each
+    process sweeps the directory by mtime every `sweep_interval` seconds.
+    """
+
+    def __init__(self, directory, ttl, sweep_interval=3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.sweep_interval = min(sweep_interval, ttl)
+        self._sweep_task = None
+
+    def _path(self, ref):
+        return os.path.join(self.directory, ref[:2], ref)
+
+    async def initialize(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def put(self, data, ref=None):
+        ref = ref or blob_ref(data)
+        await asyncio.to_thread(self._write, self._path(ref), data)
+        return ref
+
+    @staticmethod
+    def _write(path, data):
+        # Identical uploads share one copy; storing again only extends its lifetime.
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename, so readers never see a partial blob.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def get(self, ref):
+        try:
+            return map_file(self._path(ref))
+        except FileNotFoundError:
+            return None
+
+    def _sweep(self):
+        """Delete blobs (and temporary files left by crashed writers) older than the TTL. Returns how many."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    # Already swept by another process
+                    pass
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self._sweep)
+                if removed:
+                    logger.info(f"Removed {removed} expired blobs from {self.directory}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Blob sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def cleanup(self):
+        """Stop the sweep when shutting down."""
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except asyncio.CancelledError:
+                pass
+            self._sweep_task = None
+
+
+def create_blob_store(backend, redis_url, ttl, directory):
+    """Build the blob store selected by BLOB_STORE ("redis" or "file")."""
+    if backend == "file":
+        return FileBlobStore(directory, ttl)
+    return RedisBlobStore(redis_url, ttl)
+
+
+async def resolve_files(input_data, blob_store):
+    """
+    Return a copy of `input_data` whose file entries carry their bytes, fetching
+    referenced blobs from the store. Entries that already have data are kept as is.
+    """
+    files = []
+    for file in input_data.get("files") or []:
+        if "data" not in file:
+            data = await blob_store.get(file["ref"])
+            if data is None:
+                raise ValueError(f"File {file.get('filename')} is no longer available (blob {file['ref']} expired)")
+            file = dict(file, data=data)
+        files.append(file)
+    return dict(input_data, files=files)
@@ -0,0 +1,128 @@
+import hashlib
+import time
+from collections import OrderedDict
+import redis.asyncio as redis
+from app.utils import custom_logging
+from app import metrics
+
+logger = custom_logging(__name__)
+
+
+def normalized_text_hash(text):
+    """Hash of the text with case and whitespace differences removed."""
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire after a TTL.
+
+    Capped by entry count and optionally by the total size of the values.
+    Hits, misses and evictions are reported as `{name}_hits` etc. counters.
+    """
+
+    def __init__(self, name, maxsize, ttl, max_bytes=None, sizeof=len):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            metrics.counter(f"{self.name}_misses").inc()
+            return None
+        expires_at, size, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            metrics.counter(f"{self.name}_misses").inc()
+            return None
+        self._entries.move_to_end(key)
+        metrics.counter(f"{self.name}_hits").inc()
+        return value
+
+    def set(self, key, value, ttl=None):
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), size, value)
+        self.total_bytes += size
+        while len(self._entries) > self.maxsize or (self.max_bytes and self.total_bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            metrics.counter(f"{self.name}_evictions").inc()
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ClassificationCache:
+    """
+    Two-level cache of image-request classifications keyed by normalized text hash.
+
+    The in-process LRU answers repeated prompts without any I/O; the Redis level
+    (one hash per entry, expiring after the TTL) shares results across replicas.
+    """
+
+    KEY_PREFIX = "classifier:"
+
+    def __init__(self, redis_url, maxsize, ttl):
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.local = TTLCache("classification_cache", maxsize, ttl)
+        self.redis_client = None
+
+    async def initialize(self):
+        """Initialize the Redis connection."""
+        if self.redis_client is None:
+            self.redis_client = await redis.from_url(self.redis_url, decode_responses=True)
+
+    async def get(self, text):
+        """Cached decision for `text`, or None if unknown."""
+        key = normalized_text_hash(text)
+        decision = self.local.get(key)
+        if decision is not None:
+            return decision
+        if self.redis_client is None:
+            return None
+
+        try:
+            cached = await self.redis_client.hget(self.KEY_PREFIX + key, "is_image")
+        except Exception as e:
+            logger.warning(f"Classification cache lookup failed: {e}")
+            return None
+        if cached is None:
+            metrics.counter("classification_cache_redis_misses").inc()
+            return None
+        metrics.counter("classification_cache_redis_hits").inc()
+        decision = cached == "1"
+        self.local.set(key, decision)
+        return decision
+
+    async def set(self, text, decision):
+        key = normalized_text_hash(text)
+        self.local.set(key, decision)
+        if self.redis_client is None:
+            return
+        try:
+            async with self.redis_client.pipeline() as pipe:
+                pipe.hset(self.KEY_PREFIX + key, "is_image", int(decision))
+                pipe.expire(self.KEY_PREFIX + key, self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Classification cache store failed: {e}")
+
+    async def cleanup(self):
+        """Cleanup resources when shutting down."""
+        if self.redis_client:
+            await self.redis_client.close()
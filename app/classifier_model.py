@@ -0,0 +1,98 @@
+"""
+Local image-request model used as the classifier's second tier.
+
+Train it from the requests already logged in Postgres (their input_type is the
+label the LLM classifier assigned) and point CLASSIFIER_MODEL_PATH at the output:
+
+    python3 -m app.classifier_model --output classifier.pkl
+"""
+import argparse
+import asyncio
+import json
+import pickle
+from app.utils import custom_logging
+
+logger = custom_logging(__name__)
+
+
+class LocalImageRequestModel:
+    """Wraps a fitted scikit-learn pipeline that predicts P(image generation) from text."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    @classmethod
+    def load(cls, path):
+        """Load a pickled pipeline. Returns None if the file or scikit-learn is unavailable."""
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return cls(pickle.load(f))
+        except Exception as e:
+            logger.warning(f"Local classifier model not loaded from {path}: {e}")
+            return None
+
+    def predict_proba(self, text):
+        """Probability that `text` asks for an image to be generated."""
+        return float(self.pipeline.predict_proba([text])[0][1])
+
+
+def train(texts, labels):
+    """Fit a TF-IDF + logistic regression pipeline on (text, is_image_request) pairs."""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    pipeline = make_pipeline(
+        TfidfVectorizer(ngram_range=(1, 2), min_df=2, sublinear_tf=True),
+        LogisticRegression(class_weight="balanced", max_iter=1000),
+    )
+    pipeline.fit(texts, labels)
+    return pipeline
+
+
+async def load_training_data(database_url, limit):
+    """Read logged request texts and whether they were routed as image generation."""
+    import asyncpg
+
+    conn = await asyncpg.connect(database_url)
+    try:
+        rows = await conn.fetch(
+            "SELECT input_type, input_data FROM requests ORDER BY created_at DESC LIMIT $1", limit
+        )
+    finally:
+        await conn.close()
+
+    texts, labels = [], []
+    for row in rows:
+        try:
+            text = json.loads(row["input_data"]).get("text")
+        except (ValueError, AttributeError):
+            continue
+        if text:
+            texts.append(text)
+            labels.append(int(row["input_type"] == "image_generation"))
+    return texts, labels
+
+
+async def main():
+    from app.config import Config
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", required=True, help="Where to write the pickled model")
+    parser.add_argument("--limit", type=int, default=50000, help="Most recent requests to train on")
+    args = parser.parse_args()
+
+    texts, labels = await load_training_data(Config.DATABASE_URL, args.limit)
+    if len(set(labels)) < 2:
+        raise SystemExit("Need logged examples of both image and non-image requests to train")
+
+    pipeline = train(texts, labels)
+    with open(args.output, "wb") as f:
+        pickle.dump(pipeline, f)
+    logger.info(f"Trained local classifier on {len(texts)} requests ({sum(labels)} image) -> {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -8,4 +9,115 @@ class Config:
     REDIS_URL = os.getenv("REDIS_URL")
     RATE_LIMITS = {"text_only": 5, "multi_modal": 3, "image_generation": 2}
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    SEMAPHORE_TIMEOUT = 3
\ No newline at end of file
+    GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+    GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")  # Override to point at a local fake server
+    GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 60))  # Per-call timeout in seconds
+    GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", 100))
+    # Upstream per-model quotas enforced before calling the LLM; 0 (the default) disables a limit,
+    # so set them to the key's tier, e.g. GEMINI_RPM_LIMIT=15 and GEMINI_TPM_LIMIT=1000000 on the free tier
+    MODEL_QUOTAS = {
+        "gemini-2.0-flash": {
+            "rpm": int(os.getenv("GEMINI_RPM_LIMIT", 0)),
+            "tpm": int(os.getenv("GEMINI_TPM_LIMIT", 0)),
+        },
+    }
+    # Pool of API keys and models calls are spread over, each with its own rate budget and concurrency, e.g.
+    # [{"name": "flash-a", "api_key": "...", "model": "gemini-2.0-flash", "rpm": 15, "tpm": 1000000, "concurrency": 5}]
+    LLM_POOL = json.loads(os.getenv("LLM_POOL", "[]"))
+    GEMINI_API_KEYS = [key for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key]  # Without LLM_POOL
+    MEMBER_FAILURE_THRESHOLD = int(os.getenv("MEMBER_FAILURE_THRESHOLD", 5))  # Consecutive failures that eject a member
+    MEMBER_EJECTION_MS = int(os.getenv("MEMBER_EJECTION_MS", 30000))
+    # Optional TF-IDF + logistic regression model for the classifier's second tier
+    CLASSIFIER_MODEL_PATH = os.getenv("CLASSIFIER_MODEL_PATH")
+    CLASSIFIER_CONFIDENCE = float(os.getenv("CLASSIFIER_CONFIDENCE", 0.8))
+    CLASSIFIER_BATCHING_ENABLED = os.getenv("CLASSIFIER_BATCHING_ENABLED", "false").lower() == "true"
+    CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", 10000))
+    CLASSIFICATION_CACHE_TTL = int(os.getenv("CLASSIFICATION_CACHE_TTL", 3600))  # Seconds
+    # Opt-in response cache with request coalescing for identical LLM inputs
+    RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+    RESPONSE_CACHE_TTLS = {"text_only": 300, "multi_modal": 600, "image_generation": 0}  # Seconds; 0 disables
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # Per process
+    RESPONSE_CACHE_MAX_ITEM_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ITEM_BYTES", 1024 * 1024))  # Shared in Redis
+    # Opt-in micro-batching: short text_only prompts arriving within BATCH_MAX_WAIT_MS of each other
+    # share one permit and one structured-output call
+    PROMPT_BATCHING_ENABLED = os.getenv("PROMPT_BATCHING_ENABLED", "false").lower() == "true"
+    BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 8))
+    BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", 10))
+    BATCH_MAX_PROMPT_CHARS = int(os.getenv("BATCH_MAX_PROMPT_CHARS", 500))  # Longer prompts are sent on their own
+    # Redis Streams queue for rate-limited requests
+    QUEUE_CONSUMER_GROUP = os.getenv("QUEUE_CONSUMER_GROUP", "workers")
+    QUEUE_BLOCK_MS = int(os.getenv("QUEUE_BLOCK_MS", 5000))  # Longest a worker blocks on XREADGROUP
+    QUEUE_CLAIM_IDLE_MS = int(os.getenv("QUEUE_CLAIM_IDLE_MS", 300000))  # Pending this long = worker died
+    WORKER_DRAIN_TIMEOUT = int(os.getenv("WORKER_DRAIN_TIMEOUT", 60))  # Seconds to finish in-flight work on shutdown
+    # Where queued requests' file bytes are kept: "redis" or "file" (a directory shared by API and workers)
+    BLOB_STORE = os.getenv("BLOB_STORE", "redis")
+    BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "/var/lib/llm-rate-limiter/blobs")
+    BLOB_TTL = int(os.getenv("BLOB_TTL", 21600))  # Seconds a blob outlives its last enqueue if never acknowledged
+    # Uploads are spooled to temp files in chunks and rejected as soon as they pass these limits
+    UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", 200 * 1024 * 1024))
+    UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", 512 * 1024 * 1024))
+    UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+    UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR")  # Defaults to the system temp directory
+    # Files that would push a request's inline bytes past this go through the Gemini Files API
+    GEMINI_INLINE_MAX_BYTES = int(os.getenv("GEMINI_INLINE_MAX_BYTES", 16 * 1024 * 1024))
+    # Request log rows are written behind in batches
+    REQUEST_LOG_BATCH_SIZE = int(os.getenv("REQUEST_LOG_BATCH_SIZE", 500))
+    REQUEST_LOG_FLUSH_INTERVAL = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", 0.2))  # Seconds
+    REQUEST_LOG_MAX_PENDING = int(os.getenv("REQUEST_LOG_MAX_PENDING", 10000))  # Writers wait beyond this
+    REQUEST_LOG_DRAIN_TIMEOUT = int(os.getenv("REQUEST_LOG_DRAIN_TIMEOUT", 10))  # Seconds to flush on shutdown
+    REQUEST_LOG_RETRY_TIMEOUT = int(os.getenv("REQUEST_LOG_RETRY_TIMEOUT", 300))  # Seconds a batch is retried while the DB is down
+    # The requests table has one partition per day; expired ones are dropped whole
+    REQUEST_RETENTION_DAYS = int(os.getenv("REQUEST_RETENTION_DAYS", 30))
+    REQUEST_PARTITION_DAYS_AHEAD = int(os.getenv("REQUEST_PARTITION_DAYS_AHEAD", 7))
+    REQUEST_PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("REQUEST_PARTITION_MAINTENANCE_INTERVAL", 3600))  # Seconds
+    # Recent request states are cached in Redis for /status; long polls and SSE wait up to STATUS_MAX_WAIT
+    STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", 3600))
+    STATUS_CACHE_MAX_RESPONSE_BYTES = int(os.getenv("STATUS_CACHE_MAX_RESPONSE_BYTES", 256 * 1024))
+    STATUS_MAX_WAIT = int(os.getenv("STATUS_MAX_WAIT", 60))
+    STATUS_SSE_KEEPALIVE = int(os.getenv("STATUS_SSE_KEEPALIVE", 15))  # Seconds between SSE keep-alive comments
+    RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "true").lower() == "true"  # Apply schema migrations on startup
+    # Weighted fair queuing: a flow's share is its priority weight times its tenant's weight
+    PRIORITY_WEIGHTS = {"high": 4, "normal": 2, "low": 1}
+    TENANT_WEIGHTS = json.loads(os.getenv("TENANT_WEIGHTS", "{}"))  # e.g. {"acme": 3}; others weigh 1
+    TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-ID")
+    # Milliseconds a client is willing to wait for an answer; admission runs, queues or rejects up front from it
+    DEADLINE_HEADER = os.getenv("DEADLINE_HEADER", "X-Deadline-Ms")
+    QUEUE_FLOW_IDLE_MS = int(os.getenv("QUEUE_FLOW_IDLE_MS", 3600000))  # Empty flows idle this long are forgotten
+    WORKER_METRICS_INTERVAL = int(os.getenv("WORKER_METRICS_INTERVAL", 10))  # Seconds between metrics exports to Redis
+    # OpenTelemetry spans across submit -> queue -> worker, exported over OTLP (see app/tracing.py)
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+    # Opt-in adaptive concurrency: RATE_LIMITS are the starting limits, moved within these bounds (AIMD)
+    # by upstream latency and 429/503s; the adapted limits are shared by all replicas through Redis
+    ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+    CONCURRENCY_LIMIT_BOUNDS = {
+        "text_only": {"min": 1, "max": int(os.getenv("TEXT_ONLY_MAX_CONCURRENCY", 20))},
+        "multi_modal": {"min": 1, "max": int(os.getenv("MULTI_MODAL_MAX_CONCURRENCY", 12))},
+        "image_generation": {"min": 1, "max": int(os.getenv("IMAGE_GENERATION_MAX_CONCURRENCY", 6))},
+    }
+    ADAPTIVE_BACKOFF = float(os.getenv("ADAPTIVE_BACKOFF", 0.9))  # Limit multiplier on congestion
+    ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", 2.0))  # x baseline latency = congestion
+    # Per-model circuit breaker shared through Redis: consecutive upstream faults (5xx, timeouts) open it,
+    # calls then fail fast (and /submit queues) for CIRCUIT_OPEN_MS before CIRCUIT_HALF_OPEN_PROBES probes
+    CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+    CIRCUIT_OPEN_MS = int(os.getenv("CIRCUIT_OPEN_MS", 30000))
+    CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", 1))
+    # Upstream faults are retried under the same permit with full jitter, within a per-process retry budget
+    UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 2))
+    RETRY_BASE_DELAY_MS = int(os.getenv("RETRY_BASE_DELAY_MS", 200))
+    RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.1))  # Retries per call over the last 10 s
+    RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", 1))
+    # Longest a queued request waits in the worker for open circuits before it fails
+    WORKER_CIRCUIT_MAX_WAIT = int(os.getenv("WORKER_CIRCUIT_MAX_WAIT", 300))  # Seconds
+    # Hedged calls (comma-separated input types, e.g. text_only): a second call on a free permit
+    # after the model's recent HEDGE_PERCENTILE latency, first answer wins
+    HEDGE_INPUT_TYPES = [t for t in os.getenv("HEDGE_INPUT_TYPES", "").split(",") if t]
+    HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+    HEDGE_MIN_DELAY_MS = int(os.getenv("HEDGE_MIN_DELAY_MS", 200))
+    # Local permit blocks: each process reserves up to LOCAL_PERMIT_BLOCK permits per input type from the
+    # shared pool and lends them to calls without a Redis round trip; unused ones go back after LOCAL_PERMIT_IDLE_MS.
+    # Only calls without RPM/TPM/concurrency quotas use them, since those are charged in Redis per call. 0 disables
+    LOCAL_PERMIT_BLOCK = int(os.getenv("LOCAL_PERMIT_BLOCK", 0))
+    LOCAL_PERMIT_IDLE_MS = int(os.getenv("LOCAL_PERMIT_IDLE_MS", 500))
+    SEMAPHORE_TIMEOUT = 3
+    SEMAPHORE_LEASE_TTL = 30  # Seconds; leases are extended by a heartbeat while held
\ No newline at end of file
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from contextlib import contextmanager
+import asyncpg
+import redis.asyncio as redis
+from app.config import Config
+from app.utils import custom_logging
+from app import tracing
+
+logger = custom_logging(__name__)
+
+
+class AppContainer:
+    """
+    The API's shared services, built by the app's lifespan and torn down with it.
+
+    Nothing connects or loads at import time: start() opens the database pool,
+    applies pending migrations, builds the LLM client pool and classifier, and
+    initializes the Redis-backed services concurrently. Each step's duration is
+    kept in `startup_timings` (milliseconds) and reported at /llm/metrics.
+    """
+
+    def __init__(self):
+        self.db_pool = None
+        self.redis_client = None
+        self.request_logger = None
+        self.gemini_processor = None
+        self.classification_cache = None
+        self.request_classifier = None
+        self.response_cache = None
+        self.semaphore_manager = None
+        self.circuit_breaker = None
+        self.prompt_batcher = None
+        self.blob_store = None
+        self.request_queue = None
+        self.status_cache = None
+        self.startup_timings = {}
+
+    @contextmanager
+    def _timed(self, step):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_timings[step] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def start(self):
+        # Deferred so importing the app does not pull in the SDKs and models
+        from app.batcher import PromptBatcher
+        from app.blob_store import create_blob_store
+        from app.cache import ClassificationCache
+        from app.llm_processor import create_llm_pool, member_quotas, pool_members
+        from app.models import migrate
+        from app.request_classifier import RequestClassifier
+        from app.request_logger import RequestLogger
+        from app.request_queue import RequestQueue
+        from app.resilience import CircuitBreaker, ResilientProcessor, RetryBudget
+        from app.response_cache import ResponseCache
+        from app.semaphore_manager import SemaphoreManager
+        from app.status_cache import StatusCache
+
+        started = time.perf_counter()
+        tracing.configure("llm-rate-limiter-api")
+
+        with self._timed("database"):
+            self.db_pool = await asyncpg.create_pool(Config.DATABASE_URL)
+        if Config.RUN_MIGRATIONS:
+            with self._timed("migrations"):
+                async with self.db_pool.acquire() as conn:
+                    await migrate(conn)
+        self.request_logger = RequestLogger(self.db_pool)
+        self.request_logger.start()
+
+        members = pool_members()
+        self.semaphore_manager = SemaphoreManager(
+            Config.REDIS_URL, Config.RATE_LIMITS, Config.SEMAPHORE_TIMEOUT,
+            Config.SEMAPHORE_LEASE_TTL, member_quotas(members),
+            Config.CONCURRENCY_LIMIT_BOUNDS if Config.ADAPTIVE_CONCURRENCY else None,
+            Config.ADAPTIVE_BACKOFF, Config.ADAPTIVE_LATENCY_TOLERANCE,
+            Config.MEMBER_FAILURE_THRESHOLD, Config.MEMBER_EJECTION_MS,
+            Config.LOCAL_PERMIT_BLOCK, Config.LOCAL_PERMIT_IDLE_MS
+        )
+        if Config.CIRCUIT_BREAKER_ENABLED:
+            self.circuit_breaker = CircuitBreaker(
+                Config.REDIS_URL, Config.CIRCUIT_FAILURE_THRESHOLD, Config.CIRCUIT_OPEN_MS,
+                Config.CIRCUIT_HALF_OPEN_PROBES
+            )
+        with self._timed("llm_client"):
+            # Circuit breaking, budgeted retries and hedging around the key/model pool
+            self.gemini_processor = ResilientProcessor(
+                create_llm_pool(members), self.semaphore_manager, self.circuit_breaker,
+                RetryBudget(Config.RETRY_BUDGET_RATIO, Config.RETRY_BUDGET_MIN_PER_SECOND),
+                Config.UPSTREAM_MAX_RETRIES, Config.RETRY_BASE_DELAY_MS / 1000,
+                Config.HEDGE_INPUT_TYPES, Config.HEDGE_PERCENTILE, Config.HEDGE_MIN_DELAY_MS / 1000,
+            )
+
+        self.classification_cache = ClassificationCache(
+            Config.REDIS_URL, Config.CLASSIFICATION_CACHE_SIZE, Config.CLASSIFICATION_CACHE_TTL
+        )
+        with self._timed("classifier"):
+            self.request_classifier = RequestClassifier(
+                gemini_processor=self.gemini_processor, cache=self.classification_cache,
+                batch_max_items=Config.BATCH_MAX_ITEMS if Config.CLASSIFIER_BATCHING_ENABLED else 1,
+                batch_max_wait=Config.BATCH_MAX_WAIT_MS / 1000,
+            )
+
+        if Config.RESPONSE_CACHE_ENABLED:
+            self.response_cache = ResponseCache(
+                Config.REDIS_URL, Config.RESPONSE_CACHE_TTLS,
+                Config.RESPONSE_CACHE_MAX_BYTES, Config.RESPONSE_CACHE_MAX_ITEM_BYTES
+            )
+        if Config.PROMPT_BATCHING_ENABLED:
+            self.prompt_batcher = PromptBatcher(
+                self.gemini_processor, self.semaphore_manager, Config.BATCH_MAX_ITEMS,
+                Config.BATCH_MAX_WAIT_MS / 1000, Config.BATCH_MAX_PROMPT_CHARS
+            )
+        self.blob_store = create_blob_store(Config.BLOB_STORE, Config.REDIS_URL, Config.BLOB_TTL, Config.BLOB_STORE_PATH)
+        self.request_queue = RequestQueue(Config.REDIS_URL, self.blob_store, Config.QUEUE_CONSUMER_GROUP)
+        self.status_cache = StatusCache(Config.REDIS_URL, Config.STATUS_CACHE_TTL, Config.STATUS_CACHE_MAX_RESPONSE_BYTES)
+
+        with self._timed("redis"):
+            self.redis_client = await redis.from_url(Config.REDIS_URL, decode_responses=True)
+            services = [
+                self.semaphore_manager, self.classification_cache, self.blob_store,
+                self.request_queue, self.status_cache,
+            ]
+            if self.response_cache:
+                services.append(self.response_cache)
+            if self.circuit_breaker:
+                services.append(self.circuit_breaker)
+            await asyncio.gather(*[service.initialize() for service in services])
+
+        self.startup_timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(f"Startup finished in {self.startup_timings['total']} ms: {self.startup_timings}")
+
+    async def close(self):
+        """Release everything start() created, including after a partial start."""
+        if self.request_logger:
+            # Write out buffered request rows before the pool goes away
+            await self.request_logger.close()
+        if self.db_pool:
+            await self.db_pool.close()
+        if self.redis_client:
+            await self.redis_client.close()
+        for service in (
+            self.semaphore_manager, self.request_queue, self.blob_store,
+            self.classification_cache, self.response_cache, self.status_cache, self.circuit_breaker,
+        ):
+            if service:
+                await service.cleanup()
+        if self.gemini_processor:
+            await self.gemini_processor.close()
+        tracing.shutdown()
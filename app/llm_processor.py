@@ -1,83 +1,341 @@
+import asyncio
+import io
+import itertools
 import time
 from typing import AsyncGenerator
-from google.genai import types 
-from google import genai
+import httpx
 import base64
-import asyncio
+import math
+from app.config import Config
+from app.utils import custom_logging
+from app import metrics, tracing
+
+logger = custom_logging(__name__)
+
+# google.genai takes a few hundred milliseconds to import, so it is imported where
+# it is first used (processor construction at startup) rather than with the app.
+
+# Gemini bills images and document pages at a flat rate of roughly 258 tokens.
+FILE_TOKEN_ESTIMATE = 258
+
+# Upstream responses that mean Gemini is throttling us or is saturated.
+OVERLOAD_STATUS_CODES = {429, 503}
+# Upstream responses that count against a pool member's health: a bad or
+# exhausted key, or a server error.
+MEMBER_FAILURE_STATUS_CODES = {401, 403, 429}
 
 def parse_request(input_data):
+        from google.genai import types
+
         contents = []
         if "text" in input_data:
             contents.append(input_data["text"])
         
         if "files" in input_data:
             for file in input_data["files"]:
+                if "uri" in file:
+                    # Uploaded through the Files API
+                    contents.append(types.Part.from_uri(file_uri=file["uri"], mime_type=file["type"]))
+                    continue
+                data = file["data"]
+                # Blobs may arrive as memoryviews over a mapped file; the SDK only accepts bytes.
+                if not isinstance(data, bytes):
+                    data = bytes(data)
                 contents.append(types.Part.from_bytes(
                     mime_type=file["type"],
-                    data=file["data"]
+                    data=data
                 ))
         return contents
 
+def estimate_tokens(input_data):
+    """Rough prompt token count used to charge the TPM budget before the call."""
+    tokens = 0
+    if input_data.get("text"):
+        tokens += math.ceil(len(input_data["text"]) / 4)
+    tokens += FILE_TOKEN_ESTIMATE * len(input_data.get("files") or [])
+    return max(tokens, 1)
+
+def is_overload(error):
+    """Whether an upstream error means the adaptive concurrency limit should back off (429/503 or a timeout)."""
+    from google.genai import errors
+
+    if isinstance(error, errors.APIError):
+        return error.code in OVERLOAD_STATUS_CODES
+    return isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError))
+
+def is_member_failure(error):
+    """Whether an upstream error counts toward ejecting the pool member that served the call."""
+    from google.genai import errors
+
+    if isinstance(error, errors.APIError):
+        return error.code in MEMBER_FAILURE_STATUS_CODES or error.code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+def error_code(error):
+    """Label for an upstream error in metrics: the HTTP status, or the kind of failure."""
+    from google.genai import errors
+
+    if isinstance(error, errors.APIError):
+        return str(error.code)
+    if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "transport"
+    return type(error).__name__
+
+def record_error(lease, error):
+    """Tell the lease's adaptive limit and its pool member's health about an upstream error."""
+    if is_overload(error):
+        lease.record_overload()
+    if is_member_failure(error):
+        lease.record_failure()
+
+def pool_members():
+    """
+    The API keys and models calls are spread over, from LLM_POOL, or else one
+    member per key in GEMINI_API_KEYS (or GEMINI_API_KEY) on GEMINI_MODEL with
+    that model's MODEL_QUOTAS. A single key's member is named after the model,
+    so its rate buckets keep their names.
+    """
+    if Config.LLM_POOL:
+        members = Config.LLM_POOL
+    else:
+        keys = Config.GEMINI_API_KEYS or [Config.GEMINI_API_KEY]
+        quotas = Config.MODEL_QUOTAS.get(Config.GEMINI_MODEL, {})
+        members = [
+            dict(quotas, api_key=key, name=Config.GEMINI_MODEL if len(keys) == 1 else f"{Config.GEMINI_MODEL}#{i}")
+            for i, key in enumerate(keys, 1)
+        ]
+    return [
+        {
+            "name": member["name"],
+            "api_key": member["api_key"],
+            "model": member.get("model", Config.GEMINI_MODEL),
+            "rpm": int(member.get("rpm") or 0),
+            "tpm": int(member.get("tpm") or 0),
+            "concurrency": int(member.get("concurrency") or 0),
+        }
+        for member in members
+    ]
+
+def member_quotas(members):
+    """SemaphoreManager quotas for pool members: each is a rate budget with its own concurrency limit."""
+    return {
+        member["name"]: {"rpm": member["rpm"], "tpm": member["tpm"], "concurrency": member["concurrency"]}
+        for member in members
+    }
+
 class LLMProcessor:
     def __init__(self, api_key):
         self.api_key = api_key
 
-    async def process_llm_request(self, input_type, input_data):
+    async def process_llm_request(self, input_data, lease=None, timeout=None, response_schema=None):
         raise NotImplementedError("Subclasses must implement process_llm_request")
 
+    async def close(self):
+        pass
+
 
 class GeminiProcessor(LLMProcessor):
-    def __init__(self, api_key):
+    def __init__(
+        self,
+        api_key,
+        model=Config.GEMINI_MODEL,
+        timeout=Config.GEMINI_TIMEOUT,
+        max_connections=Config.GEMINI_MAX_CONNECTIONS,
+        base_url=Config.GEMINI_BASE_URL,
+        inline_max_bytes=Config.GEMINI_INLINE_MAX_BYTES,
+    ):
+        from google import genai
+        from google.genai import types
+
         super().__init__(api_key)
-        self.client = genai.Client(api_key=self.api_key)
+        self.model = model
+        self.timeout = timeout  # Default per-call timeout in seconds
+        self.inline_max_bytes = inline_max_bytes
+        # One pooled HTTP client per process, shared by every async call.
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self.client = genai.Client(
+            api_key=self.api_key,
+            http_options=types.HttpOptions(
+                base_url=base_url,
+                timeout=int(timeout * 1000),
+                httpx_async_client=self.http_client,
+            ),
+        )
 
 
-    async def process_llm_request(self, input_data):
-        model = "gemini-2.0-flash"
-        
-        contents = parse_request(input_data)
+    async def process_llm_request(self, input_data, lease=None, timeout=None, response_schema=None):
+        """
+        Send one request. With `response_schema` the model answers in JSON
+        matching it, and the JSON text is returned.
+        """
+        from google.genai import types
 
-        # Run the synchronous API call in a thread pool
-        response = await asyncio.to_thread(
-            self._generate_content,
-            model=model,
-            contents=contents
-        )
-        time.sleep(2)
-        # return "Processed a response successfully"
+        input_data, uploaded = await self._upload_large_files(input_data)
+        try:
+            contents = parse_request(input_data)
+
+            config_args = {}
+            if timeout is not None:
+                config_args["http_options"] = types.HttpOptions(timeout=int(timeout * 1000))
+            if response_schema is not None:
+                config_args.update(response_mime_type="application/json", response_schema=response_schema)
+            config = types.GenerateContentConfig(**config_args) if config_args else None
+
+            start = time.perf_counter()
+            try:
+                with tracing.span("gemini.generate_content", model=self.model):
+                    response = await self.client.aio.models.generate_content(
+                        model=self.model,
+                        contents=contents,
+                        config=config,
+                    )
+            except Exception as e:
+                metrics.counter("gemini_calls", model=self.model, code=error_code(e)).inc()
+                if lease is not None:
+                    record_error(lease, e)
+                raise
+            elapsed = time.perf_counter() - start
+            metrics.counter("gemini_calls", model=self.model, code="200").inc()
+            metrics.latency("gemini_call", model=self.model).observe(elapsed)
+            if lease is not None:
+                lease.record_latency(elapsed)
+        finally:
+            await self._delete_files(uploaded)
+        if lease is not None and response.usage_metadata:
+            # Correct the TPM estimate with the real prompt size on release
+            lease.record_usage(response.usage_metadata.prompt_token_count or 0)
         return response.text
 
-    def _generate_content(self, model, contents):
-        """Synchronous helper method to call the API"""
-        return self.client.models.generate_content(
-            model=model,
-            contents=contents
-        )
-    
-    def _generate_content_stream(self, prompt: str):
+    async def _upload_large_files(self, input_data):
         """
-        Synchronously call the LLM client's streaming generator.
+        Send files that would push the request's inline bytes past `inline_max_bytes`
+        through the Files API, streaming from disk when the file has a path.
+        Returns the input with those files replaced by URIs, and the uploaded names.
         """
-        model = "gemini-2.0-flash"
-        contents = [
-            prompt
-        ]
-        return self.client.models.generate_content_stream(
-            model=model,
-            contents=contents
-        )
+        from google.genai import types
+
+        files = []
+        uploaded = []
+        inline_bytes = 0
+        try:
+            for file in input_data.get("files") or []:
+                size = file.get("size", len(file.get("data") or b""))
+                if "uri" in file or inline_bytes + size <= self.inline_max_bytes:
+                    inline_bytes += 0 if "uri" in file else size
+                    files.append(file)
+                    continue
+
+                with metrics.latency("gemini_file_upload").time():
+                    remote = await self.client.aio.files.upload(
+                        file=file.get("path") or io.BytesIO(file["data"]),
+                        config=types.UploadFileConfig(mime_type=file["type"], display_name=file.get("filename")),
+                    )
+                    uploaded.append(remote.name)
+                    while remote.state == types.FileState.PROCESSING:
+                        await asyncio.sleep(1)
+                        remote = await self.client.aio.files.get(name=remote.name)
+                if remote.state == types.FileState.FAILED:
+                    raise ValueError(f"Gemini could not process file {file.get('filename')}")
+                files.append({"filename": file.get("filename"), "type": file["type"], "uri": remote.uri})
+        except BaseException:
+            await self._delete_files(uploaded)
+            raise
+        return dict(input_data, files=files), uploaded
+
+    async def _delete_files(self, names):
+        """Best-effort removal of uploaded files; the Files API also expires them after 48 hours."""
+        for name in names:
+            try:
+                await self.client.aio.files.delete(name=name)
+            except Exception as e:
+                logger.warning(f"Could not delete uploaded file {name}: {e}")
 
-    async def stream_content(self, prompt: str) -> AsyncGenerator[str, None]:
+    async def close(self):
+        """Close the pooled HTTP connections."""
+        await self.client.aio.aclose()
+        await self.http_client.aclose()
+    
+    async def stream_content(self, prompt: str, lease=None) -> AsyncGenerator[str, None]:
         """
-        Asynchronously stream content from the LLM by offloading the synchronous call
-        to a separate thread.
+        Stream content from the LLM through the async client. Chunks are yielded
+        as they arrive, so the consumer's pace applies backpressure upstream.
+        Records time-to-first-token and inter-chunk latency; time-to-first-token
+        is also the latency sample for the lease's adaptive limit.
         """
-        # Offload synchronous LLM call to a thread.
-        print(prompt)
-        chunks = await asyncio.to_thread(self._generate_content_stream, prompt)
-        for chunk in chunks:
-            # Yield each chunk’s text followed by a newline.
-            yield chunk.text + "\n"
-    
-    
-    
\ No newline at end of file
+        start = time.perf_counter()
+        last = None
+        usage = None
+        try:
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.model,
+                contents=[prompt]
+            )
+            async for chunk in stream:
+                now = time.perf_counter()
+                if last is None:
+                    metrics.latency("stream_time_to_first_token").observe(now - start)
+                    if lease is not None:
+                        lease.record_latency(now - start)
+                else:
+                    metrics.latency("stream_inter_chunk").observe(now - last)
+                last = now
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                if chunk.text:
+                    # Yield each chunk’s text followed by a newline.
+                    yield chunk.text + "\n"
+        except Exception as e:
+            metrics.counter("gemini_streams", model=self.model, code=error_code(e)).inc()
+            if lease is not None:
+                record_error(lease, e)
+            raise
+        metrics.counter("gemini_streams", model=self.model, code="200").inc()
+        if lease is not None and usage:
+            lease.record_usage(usage.prompt_token_count or 0)
+
+
+class LLMPool(LLMProcessor):
+    """
+    Spreads calls over several processors (API keys and models). Each member is
+    a budget of its own in SemaphoreManager: pass `budgets` when acquiring and
+    the lease names the member the call must go to. Calls without a lease (e.g.
+    classification) go round-robin.
+    """
+
+    def __init__(self, members):
+        super().__init__(None)
+        self.members = members  # {name: processor}
+        self.budgets = list(members)
+        # Identifies the pool's answers, e.g. in response cache keys
+        self.model = "+".join(sorted({processor.model for processor in members.values()}))
+        self._round_robin = itertools.cycle(self.budgets)
+
+    def member(self, lease=None):
+        if lease is not None and lease.budget in self.members:
+            return self.members[lease.budget]
+        return self.members[next(self._round_robin)]
+
+    async def process_llm_request(self, input_data, lease=None, timeout=None, response_schema=None):
+        return await self.member(lease).process_llm_request(input_data, lease, timeout, response_schema)
+
+    async def stream_content(self, prompt: str, lease=None) -> AsyncGenerator[str, None]:
+        async for chunk in self.member(lease).stream_content(prompt, lease):
+            yield chunk
+
+    async def close(self):
+        await asyncio.gather(*[processor.close() for processor in self.members.values()])
+
+
+def create_llm_pool(members):
+    """One GeminiProcessor per pool member."""
+    return LLMPool({
+        member["name"]: GeminiProcessor(member["api_key"], model=member["model"])
+        for member in members
+    })
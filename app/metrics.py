@@ -0,0 +1,183 @@
+import re
+import time
+from collections import deque
+from threading import Lock
+
+# Prefix of every metric in the Prometheus exposition
+NAMESPACE = "llm_rate_limiter"
+
+
+class Counter:
+    """Monotonic in-process counter."""
+
+    kind = "counter"
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        return [["_total", self.labels, self.value]]
+
+
+class Gauge:
+    """In-process value that is set, e.g. from shared state when metrics are scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        return [["", self.labels, self.value]]
+
+
+class LatencyRecorder:
+    """Keeps a bounded window of recent latency samples and reports percentiles."""
+
+    kind = "summary"
+
+    def __init__(self, name, labels=None, window=2048):
+        self.name = name
+        self.labels = labels or {}
+        self.count = 0
+        self.total = 0.0
+        self.window = deque(maxlen=window)
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.window.append(seconds)
+
+    def time(self):
+        """Context manager that observes the duration of its block."""
+        return _Timer(self)
+
+    def percentile(self, pct):
+        with self._lock:
+            ordered = sorted(self.window)
+        if not ordered:
+            return 0.0
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "p50_ms": round(self.percentile(50) * 1000, 2),
+            "p99_ms": round(self.percentile(99) * 1000, 2),
+        }
+
+    def samples(self):
+        return [
+            ["", dict(self.labels, quantile="0.5"), self.percentile(50)],
+            ["", dict(self.labels, quantile="0.99"), self.percentile(99)],
+            ["_sum", self.labels, self.total],
+            ["_count", self.labels, self.count],
+        ]
+
+
+class _Timer:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.observe(time.perf_counter() - self.start)
+        return False
+
+
+_registry = {}
+
+
+def _get(cls, name, labels):
+    # Labels are part of the snapshot key in name order, e.g.
+    # "semaphore_acquire:input_type=text_only:outcome=granted", so keyword order does not matter
+    key = ":".join([name, *(f"{label}={value}" for label, value in sorted(labels.items()))])
+    if key not in _registry:
+        _registry[key] = cls(name, labels)
+    return _registry[key]
+
+
+def counter(name, **labels):
+    """Get or create the process-wide counter called `name` with these labels."""
+    return _get(Counter, name, labels)
+
+
+def gauge(name, **labels):
+    """Get or create the process-wide gauge called `name` with these labels."""
+    return _get(Gauge, name, labels)
+
+
+def latency(name, **labels):
+    """Get or create the process-wide latency recorder called `name` with these labels."""
+    return _get(LatencyRecorder, name, labels)
+
+
+def snapshot():
+    """Current value of every registered metric, keyed by name."""
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
+
+
+def families():
+    """
+    Every registered metric grouped by name the Prometheus way:
+    {name: {"type": ..., "samples": [[suffix, labels, value], ...]}}. Plain
+    JSON-serializable data, so workers can export it through Redis.
+    """
+    grouped = {}
+    for metric in _registry.values():
+        name = f"{metric.name}_seconds" if metric.kind == "summary" else metric.name
+        family = grouped.setdefault(name, {"type": metric.kind, "samples": []})
+        family["samples"].extend(metric.samples())
+    return grouped
+
+
+def merge_families(into, other, **labels):
+    """Add another process's families to `into`, tagging its samples with `labels`."""
+    for name, family in other.items():
+        merged = into.setdefault(name, {"type": family["type"], "samples": []})
+        merged["samples"].extend(
+            [suffix, dict(sample_labels, **labels), value] for suffix, sample_labels, value in family["samples"]
+        )
+    return into
+
+
+_INVALID_NAME = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(families):
+    """Prometheus text exposition format (0.0.4) of `families`."""
+    lines = []
+    for name, family in sorted(families.items()):
+        metric = _INVALID_NAME.sub("_", f"{NAMESPACE}_{name}")
+        lines.append(f"# TYPE {metric} {family['type']}")
+        for suffix, labels, value in family["samples"]:
+            rendered = ",".join(f'{_INVALID_NAME.sub("_", key)}="{_escape(val)}"' for key, val in labels.items())
+            selector = f"{{{rendered}}}" if rendered else ""
+            lines.append(f"{metric}{suffix}{selector} {float(value)!r}")
+    return "\n".join(lines) + "\n"
@@ -1,22 +1,245 @@
-import psycopg2
+"""
+Schema of the requests table and its daily partitions.
+
+    python3 -m app.models    # apply pending migrations; the API and worker also do this on startup
+
+`requests` is range-partitioned by `created_at`, one partition per day, so
+retention drops whole partitions instead of deleting rows. `input_data` is
+JSONB metadata (text and file name/type/size/sha256; file bytes live in the
+blob store, addressed by hash), and the response is the last, compressible
+column so status lookups do not have to detoast it.
+"""
+import ast
+import asyncio
+import json
+from datetime import date, datetime, timedelta
+import asyncpg
 from app.config import Config
+from app.utils import custom_logging
+
+logger = custom_logging(__name__)
 
-db_conn = psycopg2.connect(Config.DATABASE_URL)
-db_cursor = db_conn.cursor()
+# Serializes schema changes and partition maintenance across processes
+SCHEMA_LOCK_ID = 7_340_001
 
-# Create table if not exists
-db_cursor.execute("""
-    CREATE TABLE IF NOT EXISTS public.requests
+CREATE_REQUESTS = """
+CREATE TABLE IF NOT EXISTS public.requests
 (
     id uuid NOT NULL,
-    input_type character varying(50) COLLATE pg_catalog."default" NOT NULL,
-    input_data text COLLATE pg_catalog."default" NOT NULL,
-    status character varying(20) COLLATE pg_catalog."default" NOT NULL,
-    response text COLLATE pg_catalog."default",
-    created_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP,
-    updated_at timestamp without time zone DEFAULT now(),
-    CONSTRAINT requests_pkey PRIMARY KEY (id),
-    CONSTRAINT requests_status_check CHECK (status::text = ANY (ARRAY['queued'::character varying, 'processing'::character varying, 'completed'::character varying, 'failed'::character varying]::text[]))
+    created_at timestamp without time zone NOT NULL DEFAULT now(),
+    updated_at timestamp without time zone NOT NULL DEFAULT now(),
+    input_type character varying(50) NOT NULL,
+    status character varying(20) NOT NULL,
+    input_data jsonb NOT NULL,
+    error text,
+    response text {compression},
+    CONSTRAINT requests_pkey PRIMARY KEY (id, created_at),
+    CONSTRAINT requests_status_check CHECK (status IN ('queued', 'processing', 'completed', 'failed'))
+) PARTITION BY RANGE (created_at)
+"""
+
+CREATE_MIGRATIONS = """
+CREATE TABLE IF NOT EXISTS public.schema_migrations
+(
+    version integer PRIMARY KEY,
+    description text NOT NULL,
+    applied_at timestamp without time zone NOT NULL DEFAULT now()
 )
-""")
-db_conn.commit()
+"""
+
+CREATE_STATUS_INDEX = """
+CREATE INDEX IF NOT EXISTS requests_status_created_at_idx ON public.requests (status, created_at)
+"""
+
+
+def partition_name(day):
+    return f"requests_p{day:%Y%m%d}"
+
+
+async def is_partitioned(conn, table):
+    return await conn.fetchval(
+        """
+        SELECT c.relkind = 'p' FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND c.relname = $1
+        """,
+        table,
+    )
+
+
+async def create_schema(conn):
+    """Create the partitioned requests table, moving an old unpartitioned one aside first."""
+    partitioned = await is_partitioned(conn, "requests")
+    if partitioned is False:
+        logger.info("Renaming the unpartitioned requests table to requests_legacy")
+        await conn.execute("ALTER TABLE public.requests RENAME TO requests_legacy")
+        await conn.execute("ALTER TABLE public.requests_legacy RENAME CONSTRAINT requests_pkey TO requests_legacy_pkey")
+
+    # lz4 compresses large responses faster than the default pglz (PostgreSQL 14+)
+    compression = "COMPRESSION lz4" if conn.get_server_version().major >= 14 else ""
+    await conn.execute(CREATE_REQUESTS.format(compression=compression))
+    await conn.execute(CREATE_STATUS_INDEX)
+
+
+async def ensure_partitions(conn, start, days_ahead):
+    """Create daily partitions from `start` through `days_ahead` days from today."""
+    day = start
+    last = date.today() + timedelta(days=days_ahead)
+    while day <= last:
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS public.{partition_name(day)} PARTITION OF public.requests "
+            f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+        )
+        day += timedelta(days=1)
+
+
+async def drop_expired_partitions(conn, retention_days):
+    """Drop daily partitions that only hold rows older than `retention_days`. Returns their names."""
+    cutoff = date.today() - timedelta(days=retention_days)
+    names = await conn.fetch(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'requests' AND c.relname LIKE 'requests_p%'
+        """
+    )
+    dropped = []
+    for record in names:
+        name = record["relname"]
+        try:
+            day = datetime.strptime(name[len("requests_p"):], "%Y%m%d").date()
+        except ValueError:
+            continue
+        # The partition covers [day, day + 1); drop it once all of that is past the cutoff
+        if day + timedelta(days=1) <= cutoff:
+            await conn.execute(f"DROP TABLE IF EXISTS public.{name}")
+            dropped.append(name)
+    if dropped:
+        logger.info(f"Dropped expired request partitions: {', '.join(dropped)}")
+    return dropped
+
+
+async def maintain_partitions(conn, retention_days=Config.REQUEST_RETENTION_DAYS,
+                              days_ahead=Config.REQUEST_PARTITION_DAYS_AHEAD):
+    """Pre-create upcoming partitions and drop expired ones, holding the schema lock."""
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+        await ensure_partitions(conn, date.today() - timedelta(days=1), days_ahead)
+        return await drop_expired_partitions(conn, retention_days)
+
+
+def _legacy_input_data(text):
+    """Parse an old str(dict) input_data, keeping metadata and replacing file bytes by their hash."""
+    from app.blob_store import blob_ref
+
+    try:
+        input_data = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return {"text": text, "files": []}
+    if not isinstance(input_data, dict):
+        return {"text": str(input_data), "files": []}
+    files = []
+    for file in input_data.get("files") or []:
+        data = file.get("data")
+        entry = {key: value for key, value in file.items() if key not in ("data", "path")}
+        if isinstance(data, bytes):
+            entry.setdefault("size", len(data))
+            entry.setdefault("sha256", blob_ref(data))
+        files.append(entry)
+    return {"text": input_data.get("text"), "files": files}
+
+
+async def migrate_legacy(conn, retention_days=Config.REQUEST_RETENTION_DAYS, batch_size=1000):
+    """Copy rows within the retention window from requests_legacy into the new table."""
+    if await is_partitioned(conn, "requests_legacy") is None:
+        return 0
+    cutoff = datetime.combine(date.today() - timedelta(days=retention_days), datetime.min.time())
+    await ensure_partitions(conn, cutoff.date(), Config.REQUEST_PARTITION_DAYS_AHEAD)
+
+    moved = 0
+    last_created, last_id = cutoff, None
+    while True:
+        rows = await conn.fetch(
+            """
+            SELECT id, input_type, input_data, status, response, created_at, updated_at
+            FROM requests_legacy
+            WHERE (created_at, id) > ($1, $2::uuid) OR ($2::uuid IS NULL AND created_at >= $1)
+            ORDER BY created_at, id
+            LIMIT $3
+            """,
+            last_created, last_id, batch_size,
+        )
+        if not rows:
+            break
+        records = []
+        for row in rows:
+            response = None if row["response"] in (None, "None") else row["response"]
+            error = None
+            if row["status"] == "failed" and response:
+                try:
+                    error = ast.literal_eval(response).get("error")
+                except (ValueError, SyntaxError, AttributeError):
+                    error = response
+                response = None
+            records.append((
+                row["id"], row["created_at"], row["updated_at"] or row["created_at"], row["input_type"],
+                row["status"], json.dumps(_legacy_input_data(row["input_data"])), error, response,
+            ))
+        await conn.executemany(
+            """
+            INSERT INTO public.requests (id, created_at, updated_at, input_type, status, input_data, error, response)
+            VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7, $8)
+            ON CONFLICT DO NOTHING
+            """,
+            records,
+        )
+        moved += len(records)
+        last_created, last_id = rows[-1]["created_at"], rows[-1]["id"]
+    logger.info(f"Migrated {moved} rows from requests_legacy; drop it once verified")
+    return moved
+
+
+async def _partitioned_requests(conn):
+    await create_schema(conn)
+    await migrate_legacy(conn)
+
+
+# (version, description, coroutine taking a connection); append only
+MIGRATIONS = [
+    (1, "daily-partitioned requests table with JSONB input metadata", _partitioned_requests),
+]
+
+
+async def migrate(conn):
+    """
+    Apply pending migrations and pre-create partitions. Concurrent callers
+    (API replicas, workers) serialize on the schema lock, so each migration
+    runs exactly once; later callers find nothing to do.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+        await conn.execute(CREATE_MIGRATIONS)
+        applied = {row["version"] for row in await conn.fetch("SELECT version FROM public.schema_migrations")}
+        for version, description, apply in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {description}")
+            await apply(conn)
+            await conn.execute(
+                "INSERT INTO public.schema_migrations (version, description) VALUES ($1, $2)",
+                version, description,
+            )
+        await ensure_partitions(conn, date.today() - timedelta(days=1), Config.REQUEST_PARTITION_DAYS_AHEAD)
+
+
+async def main():
+    conn = await asyncpg.connect(Config.DATABASE_URL)
+    try:
+        await migrate(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
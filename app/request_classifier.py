@@ -1,17 +1,50 @@
 import asyncio
+import json
 import mimetypes
 import re
 from fastapi import File, UploadFile
 from typing import List, Optional, Tuple, Dict, Any
+from app.config import Config
+from app.classifier_model import LocalImageRequestModel
+from app.uploads import spool_upload, release_uploads
+from app.batcher import BATCH_ANSWER_SCHEMA, MicroBatcher, parse_batch_answers
+from app.utils import custom_logging
+from app import metrics, tracing
+
+logger = custom_logging(__name__)
 
 class RequestClassifier:
     IMAGE_GEN_KEYWORDS = [
         "generate an image", "create an image", "draw", "paint", "illustrate",
         "design a picture", "make an image of", "visualize", "art of", "sketch"
     ]
+    # Keywords that also have common non-image meanings ("draw a conclusion")
+    AMBIGUOUS_KEYWORDS = {"draw", "paint", "illustrate", "visualize", "art of", "sketch"}
+    # Nouns that make an ambiguous keyword an image request, or a keyword-free text worth a closer look
+    IMAGE_HINT_WORDS = [
+        "image", "images", "picture", "pictures", "photo", "photos", "drawing", "painting",
+        "illustration", "logo", "icon", "portrait", "wallpaper", "poster", "artwork", "render"
+    ]
+    # One alternation over every phrase, longest first, compiled once per process
+    _MATCHER = re.compile(
+        r"\b(?:" + "|".join(
+            re.escape(phrase) for phrase in sorted(IMAGE_GEN_KEYWORDS + IMAGE_HINT_WORDS, key=len, reverse=True)
+        ) + r")\b",
+        re.IGNORECASE,
+    )
 
-    def __init__(self, gemini_processor):
+    def __init__(
+        self, gemini_processor, local_model=None, confidence=Config.CLASSIFIER_CONFIDENCE, cache=None,
+        batch_max_items=1, batch_max_wait=0.01,
+    ):
         self.gemini_processor = gemini_processor
+        self.cache = cache  # Optional ClassificationCache for LLM decisions
+        self.local_model = local_model or LocalImageRequestModel.load(Config.CLASSIFIER_MODEL_PATH)
+        self.confidence = confidence
+        # Texts that reach the LLM tier within batch_max_wait seconds share one call
+        self.batcher = None
+        if batch_max_items > 1:
+            self.batcher = MicroBatcher("classifier", self._ask_llm_batch, batch_max_items, batch_max_wait)
 
     async def classify_request(self, text_data: Optional[str], files: List[UploadFile] = File([])) -> Tuple[str, Dict[str, Any]]:
         """
@@ -22,62 +55,148 @@ class RequestClassifier:
             file: Optional FastAPI UploadFile object
         
         Returns:
-            Tuple of (input_type, input_data)
+            Tuple of (input_type, input_data). File entries hold temp files;
+            the caller must call release_uploads(input_data) when done.
         """
+        with metrics.latency("classify").time(), tracing.span("classify"):
+            return await self._classify(text_data, files)
+
+    async def _classify(self, text_data, files):
         input_data = {"text": text_data, "files": []}
 
         if text_data and await self.is_requesting_image(text_data):
             return "image_generation", input_data
 
         if files:
-            for file in files:
-                content = await file.read()                
-                mime_type = file.content_type
-                if not mime_type:
-                    mime_type, _ = mimetypes.guess_type(file.filename)
-                
-                input_data["files"].append({
-                    "filename": file.filename,
-                    "type": mime_type or "application/octet-stream",
-                    "data": content
-                })
-                
-                await file.seek(0)
-            
+            try:
+                for file in files:
+                    mime_type = file.content_type
+                    if not mime_type:
+                        mime_type, _ = mimetypes.guess_type(file.filename)
+
+                    # Spooled to a temp file in chunks and memory-mapped, never read whole
+                    input_data["files"].append(await spool_upload(
+                        file, mime_type or "application/octet-stream",
+                        Config.UPLOAD_MAX_FILE_BYTES, Config.UPLOAD_CHUNK_SIZE, Config.UPLOAD_SPOOL_DIR
+                    ))
+                    await file.seek(0)
+            except BaseException:
+                release_uploads(input_data)
+                raise
+
             return "multi_modal", input_data
 
         return "text_only", input_data
 
     async def is_requesting_image(self, text: str) -> bool:
         """
-        Use the LLM to determine if the provided text requests image generation.
-        This function offloads the (synchronous) LLM call to a thread.
+        Determine if the provided text requests image generation, using the
+        cheapest tier that is confident:
+
+        1. keyword: a single pass of the precompiled keyword matcher.
+        2. model: the optional local TF-IDF model, if loaded.
+        3. llm: ask the LLM, only when both tiers above are unsure. Its
+           answers are cached, so repeated prompts skip the call.
 
         Args:
             text: The input text to check.
 
         Returns:
-            bool: True if the LLM indicates the text is requesting image generation, else False.
-        """        
+            bool: True if the text is requesting image generation, else False.
+        """
+        decision = self._match_keywords(text)
+        if decision is not None:
+            metrics.counter("classifier_decisions", tier="keyword").inc()
+            return decision
+
+        if self.local_model is not None:
+            probability = self.local_model.predict_proba(text)
+            if probability >= self.confidence:
+                metrics.counter("classifier_decisions", tier="model").inc()
+                return True
+            if probability <= 1 - self.confidence:
+                metrics.counter("classifier_decisions", tier="model").inc()
+                return False
+
+        if self.cache is not None:
+            decision = await self.cache.get(text)
+            if decision is not None:
+                metrics.counter("classifier_decisions", tier="cache").inc()
+                return decision
+
+        metrics.counter("classifier_decisions", tier="llm").inc()
+        decision = await self._ask_llm(text)
+        if self.cache is not None:
+            await self.cache.set(text, decision)
+        return decision
+
+    def _match_keywords(self, text: str) -> Optional[bool]:
+        """
+        Keyword tier. Returns True/False when confident, or None when the text
+        only contains ambiguous keywords or image-related nouns.
+        """
+        keyword, ambiguous, hint = False, False, False
+        for match in self._MATCHER.finditer(text):
+            phrase = match.group(0).lower()
+            if phrase in self.AMBIGUOUS_KEYWORDS:
+                ambiguous = True
+            elif phrase in self.IMAGE_GEN_KEYWORDS:
+                keyword = True
+            else:
+                hint = True
+
+        if keyword or (ambiguous and hint):
+            return True
+        if not ambiguous and not hint:
+            return False
+        return None
+
+    async def _ask_llm(self, text: str) -> bool:
+        """Use the LLM to decide, falling back to plain keyword matching if the call fails."""
+        try:
+            # Call the LLM processor 
+            with metrics.latency("classifier_llm").time():
+                if self.batcher is not None:
+                    decision = await self.batcher.submit(text)
+                else:
+                    decision = await self._ask_llm_single(text)
+            if decision is not None:
+                return decision
+            logger.warning("Batched LLM classification skipped a text. Falling back to keyword matching.")
+        except Exception as e:
+            logger.warning(f"LLM call failed: {e}. Falling back to keyword matching.")
+        # Fallback: any keyword at all, ambiguous or not
+        return any(
+            match.group(0).lower() in self.IMAGE_GEN_KEYWORDS
+            for match in self._MATCHER.finditer(text)
+        )
+
+    async def _ask_llm_single(self, text: str) -> bool:
         prompt = (
             "Based on the following text, determine if the user is requesting an image to be generated. "
             "Answer with 'yes' or 'no' only.\n\n"
             f"Text: {text}\n\n"
             "Answer:"
         )
-        # return any(
-        #         re.search(rf"\b{re.escape(keyword)}\b", text, re.IGNORECASE)
-        #         for keyword in self.IMAGE_GEN_KEYWORDS
-        #     )
-        try:
-            # Call the LLM processor 
-            response = await self.gemini_processor.process_llm_request({"text": prompt})
-            result = response.strip().lower() if response else ""
-            return result in ("yes", "y", "true", "1")
-        except Exception as e:
-            print(f"LLM call failed: {e}. Falling back to keyword matching.")
-            # Fallback: perform simple keyword matching
-            return any(
-                re.search(rf"\b{re.escape(keyword)}\b", text, re.IGNORECASE)
-                for keyword in self.IMAGE_GEN_KEYWORDS
-            )
\ No newline at end of file
+        response = await self.gemini_processor.process_llm_request({"text": prompt})
+        return self._is_yes(response)
+
+    async def _ask_llm_batch(self, texts: List[str]) -> List[Optional[bool]]:
+        """One structured-output call for several texts; None for texts the model skipped."""
+        if len(texts) == 1:
+            return [await self._ask_llm_single(texts[0])]
+        prompt = (
+            "For each of the following texts, determine if the user is requesting an image to be generated. "
+            "Return one entry per text with its id and the answer 'yes' or 'no'.\n\n"
+            + json.dumps([{"id": i, "text": text} for i, text in enumerate(texts)], ensure_ascii=False)
+        )
+        response = await self.gemini_processor.process_llm_request(
+            {"text": prompt}, response_schema=BATCH_ANSWER_SCHEMA
+        )
+        answers = parse_batch_answers(response, len(texts))
+        return [self._is_yes(answers[i]) if i in answers else None for i in range(len(texts))]
+
+    @staticmethod
+    def _is_yes(response: Optional[str]) -> bool:
+        result = response.strip().lower() if response else ""
+        return result in ("yes", "y", "true", "1")
@@ -1,49 +1,306 @@
+import asyncio
+import json
 import asyncpg
 from datetime import datetime
 from app.config import Config
+from app.models import SCHEMA_LOCK_ID, drop_expired_partitions, maintain_partitions
+from app.utils import custom_logging
+from app import metrics
+
+logger = custom_logging(__name__)
+
+# Failures worth retrying: the database or the connection to it is unavailable
+# for now. Anything else the database raises is about the rows themselves.
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.exceptions.InterfaceError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.TooManyConnectionsError,
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.TransactionRollbackError,
+)
+
+
+class RequestLogRejected(Exception):
+    """The database rejected a request log row (e.g. bad data, no partition for it); writing it again cannot succeed."""
+
+
+class RequestLogUnavailable(Exception):
+    """The database could not be reached to read the request log; the read may succeed if retried later."""
+
+def _loggable(input_data):
+    """Input as stored in the requests table: file metadata only, never the bytes."""
+    if not isinstance(input_data, dict):
+        return input_data
+    files = [
+        {key: value for key, value in file.items() if key not in ("data", "path")}
+        for file in input_data.get("files") or []
+    ]
+    return dict(input_data, files=files)
+
 
 class RequestLogger:
-    def __init__(self, db_pool):
+    """
+    Write-behind logger for the requests table.
+
+    save_request() puts the row on a bounded asyncio queue and returns; a
+    background task flushes queued rows in batches (when `batch_size` rows are
+    waiting or `flush_interval` seconds have passed) by COPYing them into a
+    temporary staging table and merging that into `requests` in one statement.
+    A full queue makes callers wait (backpressure), and close() drains it.
+
+    Rows not yet flushed are kept in an in-memory overlay, so get_request()
+    sees this process's own writes immediately.
+    """
+
+    STAGING_TABLE = "requests_staging"
+    COLUMNS = ("seq", "id", "created_at", "updated_at", "input_type", "status", "input_data", "error", "response")
+    # Writes without a created_at (entries queued before it was carried) can only be matched by id.
+    UPDATE_BY_ID_QUERY = """
+    UPDATE requests
+    SET status = s.status, error = s.error, response = s.response, updated_at = s.updated_at
+    FROM (
+        SELECT DISTINCT ON (id) * FROM requests_staging
+        WHERE created_at IS NULL
+        ORDER BY id, seq DESC
+    ) s
+    WHERE requests.id = s.id
+      AND (requests.status IN ('queued', 'processing') OR s.status NOT IN ('queued', 'processing'));
+    """
+    # A row never moves from a final status back to queued/processing, whatever order writes land in.
+    MERGE_QUERY = """
+    INSERT INTO requests (id, created_at, updated_at, input_type, status, input_data, error, response)
+    SELECT DISTINCT ON (id) id, created_at, updated_at, input_type, status, input_data::jsonb, error, response
+    FROM requests_staging
+    WHERE created_at IS NOT NULL
+    ORDER BY id, seq DESC
+    ON CONFLICT (id, created_at)
+    DO UPDATE SET
+        status = EXCLUDED.status,
+        error = EXCLUDED.error,
+        response = EXCLUDED.response,
+        updated_at = EXCLUDED.updated_at
+    WHERE requests.status IN ('queued', 'processing')
+       OR EXCLUDED.status NOT IN ('queued', 'processing');
+    """
+
+    def __init__(
+        self,
+        db_pool,
+        batch_size=Config.REQUEST_LOG_BATCH_SIZE,
+        flush_interval=Config.REQUEST_LOG_FLUSH_INTERVAL,
+        max_pending=Config.REQUEST_LOG_MAX_PENDING,
+        retry_timeout=Config.REQUEST_LOG_RETRY_TIMEOUT,
+    ):
         self.db_pool = db_pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_timeout = retry_timeout  # Seconds a batch is retried while the database is unavailable
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.overlay = {}  # request_id -> newest row not yet flushed
+        self._seq = 0
+        self._waiters = {}  # seq -> future resolved when that row is written
+        self._flush_task = None
+        self._maintenance_task = None
 
-    async def save_request(self, request_id, input_type, input_data, response_data, status="completed"):
-        """Insert a request and response into the DB with error handling."""
-        insert_query = """
-        INSERT INTO requests (id, input_type, input_data, status, response, created_at)
-        VALUES ($1, $2, $3, $4, $5, $6)
-        ON CONFLICT (id) 
-        DO UPDATE SET 
-            status = $4,
-            response = $5,
-            updated_at = $6;
+    def start(self):
+        """Start the background flush and partition maintenance tasks. Must be called from a running event loop."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self._maintenance_task is None:
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def save_request(self, request_id, input_type, input_data, response_data, status="completed",
+                           wait=False, created_at=None, error=None):
+        """
+        Queue an upsert of a request and its response. Returns once it is queued
+        (waiting only if the queue is full), or with `wait=True` once it is written.
+        The return value is the row as get_request() would report it.
+
+        `created_at` is the request's submit time and, with the ID, its key in the
+        partitioned table; every write for a request must pass the same value.
         """
-        await self._execute_query(
-            insert_query,
-            (request_id, input_type, str(input_data), status, str(response_data), datetime.now())
+        now = datetime.now()
+        self._seq += 1
+        row = (
+            self._seq, request_id, created_at, now, input_type, status,
+            json.dumps(_loggable(input_data), default=str), error,
+            None if response_data is None else str(response_data),
         )
+        written = None
+        if wait:
+            written = asyncio.get_running_loop().create_future()
+            self._waiters[self._seq] = written
+        self.overlay[str(request_id)] = row
+        await self.queue.put(row)
+        if written is not None:
+            await written
+        return self._record(row)
+
+    @staticmethod
+    def _record(row):
+        """A queued row in the shape get_request() returns."""
+        _, request_id, created_at, updated_at, input_type, status, input_data, error, response = row
+        return {
+            "request_id": str(request_id),
+            "input_type": input_type,
+            "input_data": json.loads(input_data),
+            "status": status,
+            "error": error,
+            "response": response,
+            "created_at": (created_at or updated_at).isoformat(),
+        }
+
+    async def close(self, timeout=Config.REQUEST_LOG_DRAIN_TIMEOUT):
+        """Flush every queued row, waiting up to `timeout` seconds, then stop the flush task."""
+        if self._flush_task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Request log drain timed out; rows for {len(self.overlay)} requests were not written")
+        self._flush_task.cancel()
+        self._maintenance_task.cancel()
+        await asyncio.gather(self._flush_task, self._maintenance_task, return_exceptions=True)
+        self._flush_task = None
+        self._maintenance_task = None
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush_with_retry(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _flush_with_retry(self, batch):
+        """
+        Write a batch. While the database is unavailable it is retried with
+        backoff for up to `retry_timeout` seconds, and meanwhile the queue fills
+        and callers are held back; then it is given up. Rows the database rejects
+        are isolated by splitting the batch and dropped, failing their waiters
+        with RequestLogRejected, so one bad row cannot stall the log.
+        """
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self.retry_timeout
+        attempt = 0
+        while True:
+            try:
+                with metrics.latency("request_log_flush").time():
+                    await self._flush(batch)
+                break
+            except asyncio.CancelledError:
+                raise
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                metrics.counter("request_log_flush_errors", error="transient").inc()
+                delay = min(2 ** attempt, 30)
+                if loop.time() + delay > give_up_at:
+                    logger.error(f"Giving up on {len(batch)} request log rows after {attempt} attempts: {e}")
+                    self._finish(batch, e)
+                    return
+                logger.error(f"Writing {len(batch)} request log rows failed (attempt {attempt}): {e}")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                metrics.counter("request_log_flush_errors", error="rejected").inc()
+                if len(batch) == 1:
+                    metrics.counter("request_log_rows_dropped").inc()
+                    logger.error(f"Dropping request log row for request {batch[0][1]}: {e}")
+                    self._finish(batch, RequestLogRejected(str(e)))
+                    return
+                # Write the good rows; halves keep their order, so later writes still win
+                middle = len(batch) // 2
+                await self._flush_with_retry(batch[:middle])
+                await self._flush_with_retry(batch[middle:])
+                return
+
+        metrics.counter("request_log_rows_written").inc(len(batch))
+        self._finish(batch)
+
+    def _finish(self, batch, error=None):
+        """Settle a batch's waiters, with `error` if it was not written."""
+        for row in batch:
+            # Keep the overlay entry if a newer write for the same request is still queued
+            if self.overlay.get(str(row[1])) is row:
+                del self.overlay[str(row[1])]
+            written = self._waiters.pop(row[0], None)
+            if written is not None and not written.done():
+                if error is None:
+                    written.set_result(None)
+                else:
+                    written.set_exception(error)
+
+    async def _flush(self, batch):
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    f"CREATE TEMP TABLE IF NOT EXISTS {self.STAGING_TABLE} ("
+                    "seq bigint, id uuid, created_at timestamp, updated_at timestamp, input_type varchar(50), "
+                    "status varchar(20), input_data text, error text, response text"
+                    ") ON COMMIT DELETE ROWS"
+                )
+                await conn.copy_records_to_table(self.STAGING_TABLE, records=batch, columns=self.COLUMNS)
+                if any(row[2] is None for row in batch):
+                    await conn.execute(self.UPDATE_BY_ID_QUERY)
+                await conn.execute(self.MERGE_QUERY)
+
+    async def _maintenance_loop(self):
+        """Keep partitions created ahead of time and drop the expired ones."""
+        while True:
+            try:
+                async with self.db_pool.acquire() as conn:
+                    await maintain_partitions(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Request partition maintenance failed: {e}")
+            await asyncio.sleep(Config.REQUEST_PARTITION_MAINTENANCE_INTERVAL)
 
     async def get_request(self, request_id):
-        """Fetch a request and response by ID, handling errors."""
-        select_query = "SELECT id, input_type, input_data, status, response, created_at FROM requests WHERE id = $1;"
+        """
+        Fetch a request and response by ID, or None if there is no such request.
+        Raises RequestLogUnavailable while the database cannot be reached.
+        """
+        row = self.overlay.get(str(request_id))
+        if row is not None:
+            return self._record(row)
+
+        select_query = """
+        SELECT id, input_type, input_data, status, error, response, created_at
+        FROM requests WHERE id = $1;
+        """
         result = await self._execute_query(select_query, (request_id,), fetchone=True)
         if result:
             return {
-                "request_id": result[0],
+                "request_id": str(result[0]),
                 "input_type": result[1],
-                "input_data": result[2],
+                "input_data": json.loads(result[2]),
                 "status": result[3],
-                "response": result[4],
-                "created_at": result[5].isoformat() if result[5] else None,
+                "error": result[4],
+                "response": result[5],
+                "created_at": result[6].isoformat() if result[6] else None,
             }
         return None
 
-    async def delete_old_requests(self, days=30):
-        """Cleanup old requests (default: older than 30 days)."""
-        delete_query = "DELETE FROM requests WHERE created_at < NOW() - INTERVAL %s DAY;"
-        await self._execute_query(delete_query, (days,), commit=True)
+    async def delete_old_requests(self, days=Config.REQUEST_RETENTION_DAYS):
+        """Drop the daily partitions holding only requests older than `days`."""
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+                return await drop_expired_partitions(conn, days)
 
     async def _execute_query(self, query, params=None, commit=False, fetchone=False):
-        """Utility function for executing DB queries safely."""
+        """Run a query on a pooled connection. Connection failures raise RequestLogUnavailable."""
         try:
             async with self.db_pool.acquire() as conn:
                 if fetchone:
@@ -51,6 +308,9 @@ class RequestLogger:
                 else:
                     await conn.execute(query, *params)
                     return None
+        except TRANSIENT_ERRORS as e:
+            logger.error(f"Database unavailable: {e}")
+            raise RequestLogUnavailable(str(e)) from e
         except Exception as e:
-            print(f"Database error: {e}")
-            return None
+            logger.error(f"Database error: {e}")
+            raise
@@ -0,0 +1,260 @@
+import ast
+import json
+import os
+import socket
+import time
+import msgpack
+import redis.asyncio as redis
+from app.utils import custom_logging
+from app import tracing
+
+logger = custom_logging(__name__)
+
+ENVELOPE_VERSION = 1
+
+DEFAULT_TENANT = "default"
+DEFAULT_PRIORITY = "normal"
+
+
+class RequestQueue:
+    """
+    Queue of rate-limited requests on Redis Streams.
+
+    Each input type has one stream per flow, i.e. per priority class and tenant
+    (`stream:{input_type}:{priority}:{tenant}`), registered in the sorted set
+    `flows:{input_type}` scored by the flow's last enqueue time. The worker's
+    scheduler reads the head of each flow and picks between them; the plain
+    `stream:{input_type}` of earlier versions is still drained as one more flow.
+
+    Each entry is a compact msgpack envelope with the request's metadata. File
+    bytes are stored once in the blob store and the envelope only carries their
+    content-addressed references, which the worker resolves when it needs them.
+
+    Workers read through a consumer group, so each entry is delivered to one
+    consumer and stays pending until it is acknowledged. Entries left pending by
+    a crashed worker are claimed by another one after `claim_idle_ms`.
+    """
+
+    KEY_PREFIX = "stream:"
+    FLOWS_PREFIX = "flows:"
+
+    # Forget a flow that has stayed empty since the cutoff; atomic so a racing enqueue is never lost
+    PRUNE_FLOW_LUA = """
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+    if score and tonumber(score) < tonumber(ARGV[2]) and redis.call('XLEN', KEYS[2]) == 0 then
+        redis.call('DEL', KEYS[2])
+        redis.call('ZREM', KEYS[1], ARGV[1])
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self, redis_url, blob_store, group="workers", consumer=None, claim_idle_ms=300000):
+        self.redis_url = redis_url
+        self.blob_store = blob_store
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.claim_idle_ms = claim_idle_ms
+        self.redis_client = None
+        self._claim_cursors = {}
+
+    async def initialize(self):
+        """Initialize a binary-safe Redis connection."""
+        if self.redis_client is None:
+            self.redis_client = await redis.from_url(self.redis_url)
+
+    def _stream_key(self, input_type):
+        return f"{self.KEY_PREFIX}{input_type}"
+
+    def _flows_key(self, input_type):
+        return f"{self.FLOWS_PREFIX}{input_type}"
+
+    def flow_key(self, input_type, priority, tenant):
+        return f"{self.KEY_PREFIX}{input_type}:{priority}:{tenant}"
+
+    def parse_flow(self, stream_key):
+        """(priority, tenant) of a flow's stream; the legacy per-type stream counts as the default flow."""
+        parts = stream_key.split(":", 3)
+        if len(parts) < 4:
+            return DEFAULT_PRIORITY, DEFAULT_TENANT
+        return parts[2], parts[3]
+
+    async def enqueue(self, input_type, req_id, input_data, created_at=None,
+                      tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY):
+        """Store the request's files as blobs and append its envelope to its flow's stream. Returns the entry ID."""
+        files = []
+        for file in input_data.get("files") or []:
+            ref = await self.blob_store.put(file["data"], file.get("sha256"))
+            files.append({
+                "filename": file.get("filename"),
+                "type": file.get("type"),
+                "ref": ref,
+                "sha256": ref,
+                "size": len(file["data"]),
+            })
+
+        now_ms = int(time.time() * 1000)
+        envelope = {
+            "v": ENVELOPE_VERSION,
+            "id": req_id,
+            "input_type": input_type,
+            "created_at": created_at.isoformat() if created_at else None,
+            "tenant": tenant,
+            "priority": priority,
+            "enqueued_at": now_ms,
+            "text": input_data.get("text"),
+            "files": files,
+            # Trace context of the submit, so the worker's span joins its trace
+            "trace": tracing.inject(),
+        }
+
+        stream_key = self.flow_key(input_type, priority, tenant)
+        # Registered with a fresh score before the entry is added, so pruning cannot drop it
+        if await self.redis_client.zadd(self._flows_key(input_type), {stream_key: now_ms}):
+            await self._create_group(stream_key)
+        return await self.redis_client.xadd(
+            stream_key, {"envelope": msgpack.packb(envelope, use_bin_type=True)}
+        )
+
+    async def _create_group(self, stream_key):
+        try:
+            await self.redis_client.xgroup_create(stream_key, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def ensure_group(self, input_type):
+        """Create the consumer groups (and streams) of known flows, and move entries left on the old list queue."""
+        stream_key = self._stream_key(input_type)
+        for flow in await self.flows(input_type):
+            await self._create_group(flow)
+
+        legacy_key = f"queue:{input_type}"
+        moved = 0
+        while True:
+            request_json = await self.redis_client.lpop(legacy_key)
+            if not request_json:
+                break
+            await self.redis_client.xadd(stream_key, {"payload": request_json})
+            moved += 1
+        if moved:
+            logger.info(f"Moved {moved} requests from {legacy_key} to {stream_key}")
+
+    async def flows(self, input_type):
+        """Stream keys of every flow of an input type, the legacy stream first."""
+        members = await self.redis_client.zrange(self._flows_key(input_type), 0, -1)
+        return [self._stream_key(input_type)] + [member.decode() for member in members]
+
+    async def prune_flows(self, input_type, idle_ms):
+        """Forget flows that are empty and have not been enqueued to for `idle_ms`. Returns how many."""
+        flows_key = self._flows_key(input_type)
+        cutoff = int(time.time() * 1000) - idle_ms
+        pruned = 0
+        for member in await self.redis_client.zrangebyscore(flows_key, "-inf", cutoff):
+            pruned += await self.redis_client.eval(self.PRUNE_FLOW_LUA, 2, flows_key, member, member, cutoff)
+        return pruned
+
+    async def read_heads(self, stream_keys, block_ms=None):
+        """
+        Read at most one new entry from each of the given streams, blocking up to
+        `block_ms` if none has any (None: do not block). Returns a list of
+        (stream_key, entry_id, envelope).
+        """
+        if not stream_keys:
+            return []
+        response = await self.redis_client.xreadgroup(
+            self.group, self.consumer, {key: ">" for key in stream_keys},
+            count=1, block=block_ms
+        )
+        entries = []
+        for stream_key, messages in response or []:
+            stream_key = stream_key.decode()
+            for entry_id, envelope in self._decode(messages):
+                entries.append((stream_key, entry_id, envelope))
+        return entries
+
+    async def claim_stale(self, stream_key, count):
+        """Take over entries another consumer left unacknowledged for longer than `claim_idle_ms`."""
+        cursor = self._claim_cursors.get(stream_key, "0-0")
+        response = await self.redis_client.xautoclaim(
+            stream_key, self.group, self.consumer, self.claim_idle_ms, start_id=cursor, count=count
+        )
+        next_cursor, messages = response[0].decode(), response[1]
+        self._claim_cursors[stream_key] = next_cursor
+        entries = self._decode(messages)
+        if entries:
+            logger.warning(f"Claimed {len(entries)} stale entries from {stream_key}")
+        return entries
+
+    async def touch(self, stream_key, entry_ids):
+        """Reset the idle time of entries this consumer has read but not started, so nobody claims them."""
+        if entry_ids:
+            await self.redis_client.xclaim(stream_key, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    async def ack(self, stream_key, entry_id, files=()):
+        """
+        Acknowledge a processed entry and remove it from its stream, then release
+        the blobs of its `files`. Only the consumer whose ack took effect releases
+        them, so an entry processed twice (claimed while still running) does not
+        drop references other entries hold.
+        """
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.xack(stream_key, self.group, entry_id)
+            pipe.xdel(stream_key, entry_id)
+            acked, _ = await pipe.execute()
+        if acked:
+            for file in files:
+                if "ref" in file:
+                    await self.blob_store.release(file["ref"])
+
+    async def depth(self, input_type):
+        """Entries not yet acknowledged across all flows, including ones being processed."""
+        flows = await self.flows(input_type)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for stream_key in flows:
+                pipe.xlen(stream_key)
+            return sum(await pipe.execute())
+
+    async def oldest_age(self, input_type):
+        """Seconds the oldest entry not yet acknowledged has been in any flow; 0 when all are empty."""
+        flows = await self.flows(input_type)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for stream_key in flows:
+                pipe.xrange(stream_key, count=1)
+            heads = await pipe.execute()
+        # Entry IDs start with the enqueue time in milliseconds
+        oldest = min((int(entries[0][0].split(b"-")[0]) for entries in heads if entries), default=None)
+        if oldest is None:
+            return 0.0
+        return max(0.0, time.time() - oldest / 1000)
+
+    async def cleanup(self):
+        """Cleanup resources when shutting down."""
+        if self.redis_client:
+            await self.redis_client.close()
+
+    def _decode(self, messages):
+        """Turn stream messages into (entry_id, envelope) pairs."""
+        entries = []
+        for entry_id, fields in messages:
+            # Entries deleted while pending are returned with no fields
+            if not fields:
+                continue
+            if b"envelope" in fields:
+                envelope = msgpack.unpackb(fields[b"envelope"], raw=False)
+            else:
+                envelope = self._decode_legacy(fields[b"payload"])
+            entries.append((entry_id.decode(), envelope))
+        return entries
+
+    def _decode_legacy(self, payload):
+        """Entries queued as JSON with a str(dict) input by older API processes; files are inline."""
+        request_data = json.loads(payload)
+        input_data = ast.literal_eval(request_data.get("input_data"))
+        return {
+            "v": 0,
+            "id": request_data.get("id"),
+            "input_type": request_data.get("input_type"),
+            "text": input_data.get("text"),
+            "files": input_data.get("files") or [],
+        }
@@ -0,0 +1,376 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import AsyncGenerator
+import httpx
+import redis.asyncio as redis
+from app.llm_processor import LLMProcessor
+from app.utils import custom_logging
+from app import metrics
+
+logger = custom_logging(__name__)
+
+
+def is_upstream_fault(error):
+    """Whether an error means the model's upstream is degraded: a 5xx, a timeout or a broken connection."""
+    from google.genai import errors
+
+    if isinstance(error, errors.APIError):
+        return error.code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitOpenError(TimeoutError):
+    """
+    The model's circuit is open, so the call was not sent. A TimeoutError, so
+    /submit queues the request as it does when no permit is free.
+    """
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"Circuit for '{model}' is open; retry in {retry_after:.1f} seconds")
+        self.model = model
+        self.retry_after = retry_after  # Seconds until a probe may be let through
+
+
+class CircuitBreaker:
+    """
+    Per-model circuit breaker whose state is shared by every process through
+    Redis (`circuit:{model}` hash, absent while closed and healthy).
+
+    closed: calls go through; `failure_threshold` upstream faults in a row
+    (successes reset the count) open the circuit. open: calls fail fast with
+    CircuitOpenError for `open_ms`. half-open: up to `probes` calls are let
+    through; a success closes the circuit, a fault opens it again. Probes that
+    never report back stop counting after another `open_ms`.
+    """
+
+    KEY_PREFIX = "circuit:"
+
+    ALLOW_LUA = """
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    local open_ms = tonumber(ARGV[1])
+    local c = redis.call('HMGET', KEYS[1], 'state', 'failures', 'until', 'probes')
+    local state, failures, until_ms, probes = c[1], tonumber(c[2]) or 0, tonumber(c[3]), tonumber(c[4]) or 0
+    if state == 'open' then
+        if now < until_ms then
+            return {0, until_ms - now, 1}
+        end
+        state, probes, until_ms = 'half_open', 0, now + open_ms
+        redis.call('HSET', KEYS[1], 'state', state, 'probes', 0, 'until', until_ms)
+    elseif state == 'half_open' and now >= until_ms then
+        probes, until_ms = 0, now + open_ms
+        redis.call('HSET', KEYS[1], 'probes', 0, 'until', until_ms)
+    end
+    if state == 'half_open' then
+        if probes >= tonumber(ARGV[2]) then
+            return {0, until_ms - now, 1}
+        end
+        redis.call('HINCRBY', KEYS[1], 'probes', 1)
+        redis.call('PEXPIRE', KEYS[1], ARGV[3])
+        return {1, 0, 1}
+    end
+    return {1, 0, failures > 0 and 1 or 0}
+    """
+
+    RECORD_LUA = """
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+    if ARGV[1] == '1' then
+        if state ~= 'open' then
+            redis.call('DEL', KEYS[1])
+            return 'closed'
+        end
+        return state
+    end
+    if state == 'open' then
+        return state
+    end
+    local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+    if state == 'half_open' or failures >= tonumber(ARGV[2]) then
+        redis.call('HSET', KEYS[1], 'state', 'open', 'until', now + tonumber(ARGV[3]), 'probes', 0, 'failures', 0)
+        redis.call('PEXPIRE', KEYS[1], ARGV[4])
+        return 'opened'
+    end
+    redis.call('PEXPIRE', KEYS[1], ARGV[4])
+    return state
+    """
+
+    def __init__(self, redis_url, failure_threshold=5, open_ms=30000, probes=1, failure_window_ms=60000):
+        self.redis_url = redis_url
+        self.failure_threshold = failure_threshold
+        self.open_ms = open_ms
+        self.probes = probes
+        # Failures older than this are forgotten; the key also outlives an open period and its probes
+        self.ttl_ms = max(failure_window_ms, 2 * open_ms)
+        self.redis_client = None
+        self.allow_script = None
+        self.record_script = None
+
+    async def initialize(self):
+        if self.redis_client is None:
+            self.redis_client = await redis.from_url(self.redis_url, decode_responses=True)
+            # Every upstream call runs both, so only their SHA is sent
+            self.allow_script = self.redis_client.register_script(self.ALLOW_LUA)
+            self.record_script = self.redis_client.register_script(self.RECORD_LUA)
+
+    def _key(self, model):
+        return f"{self.KEY_PREFIX}{model}"
+
+    async def allow(self, model):
+        """
+        Admit a call to `model`, or raise CircuitOpenError. Returns whether the
+        circuit has anything to forget on success (recent faults, or this call
+        is a half-open probe); if not, record() can skip the success.
+        """
+        if self.redis_client is None:
+            await self.initialize()
+
+        allowed, retry_ms, dirty = await self.allow_script(
+            keys=[self._key(model)], args=[self.open_ms, self.probes, self.ttl_ms]
+        )
+        if not allowed:
+            metrics.counter("circuit_rejected", model=model).inc()
+            raise CircuitOpenError(model, retry_ms / 1000)
+        return dirty == 1
+
+    async def record(self, model, ok):
+        """Report the outcome of an admitted call. Only upstream faults count as failures."""
+        state = await self.record_script(
+            keys=[self._key(model)], args=[int(ok), self.failure_threshold, self.open_ms, self.ttl_ms]
+        )
+        if state == "opened":
+            metrics.counter("circuit_opened", model=model).inc()
+            logger.warning(f"Circuit for '{model}' opened for {self.open_ms} ms after upstream failures")
+
+    async def states(self, models):
+        """Current state of each model's circuit: closed, open or half_open."""
+        if self.redis_client is None:
+            await self.initialize()
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for model in models:
+                pipe.hget(self._key(model), "state")
+            states = await pipe.execute()
+        return {model: state or "closed" for model, state in zip(models, states)}
+
+    async def cleanup(self):
+        if self.redis_client:
+            await self.redis_client.close()
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of recent calls in this process: within the last
+    `window` seconds at most `ratio` retries per call, plus `min_per_second`
+    so a quiet process can still retry. Keeps retries from multiplying the load
+    on an upstream that is already failing.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, window=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._calls = deque()
+        self._retries = deque()
+
+    def _prune(self, now):
+        cutoff = now - self.window
+        for events in (self._calls, self._retries):
+            while events and events[0] < cutoff:
+                events.popleft()
+
+    def record_call(self):
+        now = time.monotonic()
+        self._prune(now)
+        self._calls.append(now)
+
+    def try_spend(self):
+        """Take one retry from the budget; False if it is used up."""
+        now = time.monotonic()
+        self._prune(now)
+        if len(self._retries) >= self.ratio * len(self._calls) + self.min_per_second * self.window:
+            return False
+        self._retries.append(now)
+        return True
+
+
+class ResilientProcessor(LLMProcessor):
+    """
+    Wraps the LLM pool with fault handling, keeping its interface:
+
+    - circuit breaking per model: while a model's circuit is open, calls fail
+      fast with CircuitOpenError instead of holding a permit until they time out;
+    - retries of upstream faults (5xx, timeouts, broken connections) under the
+      same permit, with full-jitter exponential backoff, at most `max_retries`
+      per call and within the process's retry budget;
+    - optional hedging for leases of `hedge_input_types`: if the call has not
+      answered after the model's recent p`hedge_percentile` latency, a second
+      call is sent under a second permit taken only if one is free right now
+      (so the concurrency limits hold), and the first answer wins.
+
+    Streams are circuit broken but neither retried nor hedged.
+    """
+
+    HEDGE_MIN_SAMPLES = 50  # Latency samples needed before hedging a model's calls
+
+    def __init__(
+        self, processor, semaphore_manager, breaker=None, retry_budget=None, max_retries=2,
+        retry_base_delay=0.2, hedge_input_types=(), hedge_percentile=95, hedge_min_delay=0.2,
+    ):
+        super().__init__(None)
+        self.processor = processor
+        self.semaphore_manager = semaphore_manager
+        self.breaker = breaker
+        self.retry_budget = retry_budget or RetryBudget()
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay  # Seconds
+        self.hedge_input_types = set(hedge_input_types)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay  # Seconds
+        self.budgets = processor.budgets
+        self.model = processor.model
+        self.models = sorted({member.model for member in processor.members.values()})
+        self._hedge_delays = {}  # model -> (computed at, seconds or None)
+
+    def member(self, lease=None):
+        return self.processor.member(lease)
+
+    async def _admit(self, model, lease=None):
+        """
+        Let a call to `model` through the breaker. When it is rejected, `lease`
+        (if the permit was taken for this call alone) is marked unused, so its
+        rate charge is refunded and it stays out of the wait estimate on release.
+        """
+        if self.breaker is None:
+            return False
+        try:
+            return await self.breaker.allow(model)
+        except CircuitOpenError:
+            if lease is not None:
+                lease.record_unused()
+            raise
+
+    async def _report(self, model, error, dirty):
+        """
+        Feed an outcome to the breaker. Any answer from the upstream, even a
+        4xx, shows it is up; clean successes need no round trip.
+        """
+        if self.breaker is None:
+            return
+        if error is not None and is_upstream_fault(error):
+            await self.breaker.record(model, False)
+        elif dirty:
+            await self.breaker.record(model, True)
+
+    async def process_llm_request(self, input_data, lease=None, timeout=None, response_schema=None):
+        # Without a lease the pool would pick a member per call; pin one so the breaker sees its model
+        processor = self.processor.member(lease)
+        self.retry_budget.record_call()
+        retries = 0
+        while True:
+            # Only the first attempt's permit went unused if the circuit is open
+            dirty = await self._admit(processor.model, lease if retries == 0 else None)
+            if lease is not None:
+                # Ejection and the adaptive limit only see the attempt that ends the call
+                lease.clear_outcome()
+            try:
+                response = await self._call(processor, input_data, lease, timeout, response_schema)
+            except Exception as e:
+                await self._report(processor.model, e, dirty)
+                if retries >= self.max_retries or not is_upstream_fault(e):
+                    raise
+                if not self.retry_budget.try_spend():
+                    metrics.counter("retry_budget_exhausted").inc()
+                    raise
+                retries += 1
+                delay = random.uniform(0, self.retry_base_delay * 2 ** retries)
+                metrics.counter("gemini_retries", model=processor.model).inc()
+                logger.warning(f"Retrying call to '{processor.model}' in {delay:.2f} s after: {e}")
+                await asyncio.sleep(delay)
+                continue
+            await self._report(processor.model, None, dirty)
+            return response
+
+    async def _call(self, processor, input_data, lease, timeout, response_schema):
+        if lease is not None and lease.input_type in self.hedge_input_types:
+            delay = self.hedge_delay(processor.model)
+            if delay is not None:
+                return await self._hedged(processor, delay, input_data, lease, timeout, response_schema)
+        return await processor.process_llm_request(input_data, lease, timeout, response_schema)
+
+    def hedge_delay(self, model):
+        """Seconds to wait before hedging a call to `model`, or None while there are too few samples."""
+        now = time.monotonic()
+        computed_at, delay = self._hedge_delays.get(model, (None, None))
+        if computed_at is None or now - computed_at > 1:
+            recorder = metrics.latency("gemini_call", model=model)
+            delay = None
+            if recorder.count >= self.HEDGE_MIN_SAMPLES:
+                delay = max(self.hedge_min_delay, recorder.percentile(self.hedge_percentile))
+            self._hedge_delays[model] = (now, delay)
+        return delay
+
+    async def _hedged(self, processor, delay, input_data, lease, timeout, response_schema):
+        input_type = lease.input_type
+        primary = asyncio.create_task(processor.process_llm_request(input_data, lease, timeout, response_schema))
+        hedge, hedge_lease = None, None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+
+            # Never queue for the hedge: it only runs on a permit that is free right now
+            hedge_lease = await self.semaphore_manager.try_acquire_semaphore(
+                input_type, tokens=lease.tokens, budget=self.budgets
+            )
+            hedge_processor = self.processor.member(hedge_lease) if hedge_lease else None
+            if hedge_processor is None or (
+                hedge_processor.model != processor.model and await self._circuit_open(hedge_processor.model)
+            ):
+                metrics.counter("hedges_skipped", input_type=input_type).inc()
+                return await primary
+
+            metrics.counter("hedged_calls", input_type=input_type).inc()
+            hedge = asyncio.create_task(
+                hedge_processor.process_llm_request(input_data, hedge_lease, timeout, response_schema)
+            )
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None:
+                        if task is hedge:
+                            metrics.counter("hedge_wins", input_type=input_type).inc()
+                        return task.result()
+            # Both failed: surface the original call's error
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+            await asyncio.gather(*[task for task in (primary, hedge) if task is not None], return_exceptions=True)
+            if hedge_lease is not None:
+                await asyncio.shield(self.semaphore_manager.release_semaphore(hedge_lease))
+
+    async def _circuit_open(self, model):
+        if self.breaker is None:
+            return False
+        states = await self.breaker.states([model])
+        return states[model] != "closed"
+
+    async def stream_content(self, prompt: str, lease=None) -> AsyncGenerator[str, None]:
+        processor = self.processor.member(lease)
+        dirty = await self._admit(processor.model, lease)
+        try:
+            async for chunk in processor.stream_content(prompt, lease):
+                yield chunk
+        except Exception as e:
+            await self._report(processor.model, e, dirty)
+            raise
+        await self._report(processor.model, None, dirty)
+
+    async def close(self):
+        await self.processor.close()
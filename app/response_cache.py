@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import time
+import uuid
+import redis.asyncio as redis
+from app.blob_store import blob_ref
+from app.cache import TTLCache
+from app.utils import custom_logging
+from app import metrics
+
+logger = custom_logging(__name__)
+
+
+def content_hash(model, input_data):
+    """Hash of everything that determines the LLM's answer: model, text and file contents."""
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update((input_data.get("text") or "").encode("utf-8"))
+    for file in input_data.get("files") or []:
+        digest.update(b"\0")
+        digest.update((file.get("type") or "").encode("utf-8"))
+        # Queued files already carry their content address; avoid re-hashing their bytes.
+        digest.update((file.get("sha256") or blob_ref(file["data"])).encode("ascii"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Opt-in cache of LLM responses with single-flight request coalescing.
+
+    Identical requests (same model, text and file bytes) are answered from an
+    in-process LRU capped by total bytes, then from Redis with a per-input-type
+    TTL. Concurrent identical misses share a single upstream call: within a
+    process through a shared future, across processes through a Redis lock
+    whose holder publishes the result when it is done.
+    """
+
+    KEY_PREFIX = "llmcache:"
+
+    def __init__(self, redis_url, ttls, max_bytes, max_item_bytes, lock_ttl=120):
+        self.redis_url = redis_url
+        self.ttls = ttls  # {input_type: seconds}; 0 or missing disables caching for that type
+        self.max_item_bytes = max_item_bytes
+        self.lock_ttl = lock_ttl  # Seconds a leader may take before followers stop waiting for it
+        self.local = TTLCache(
+            "response_cache", maxsize=100000, ttl=max(ttls.values() or [1]),
+            max_bytes=max_bytes, sizeof=lambda value: len(value.encode("utf-8")),
+        )
+        self.redis_client = None
+        self._inflight = {}
+
+    async def initialize(self):
+        """Initialize the Redis connection."""
+        if self.redis_client is None:
+            self.redis_client = await redis.from_url(self.redis_url, decode_responses=True)
+
+    def _response_key(self, key):
+        return f"{self.KEY_PREFIX}response:{key}"
+
+    def _lock_key(self, key):
+        return f"{self.KEY_PREFIX}lock:{key}"
+
+    def _channel(self, key):
+        return f"{self.KEY_PREFIX}done:{key}"
+
+    async def get_or_compute(self, input_type, model, input_data, compute, max_wait=None):
+        """
+        Return the cached response for this request, or run `compute()` once for
+        all concurrent identical requests and cache its result.
+
+        `max_wait` bounds how many seconds a follower waits for another request
+        to compute it (default: as long as it takes, or the lock TTL across
+        processes); past it, TimeoutError is raised.
+        """
+        ttl = self.ttls.get(input_type) or 0
+        if ttl <= 0:
+            return await compute()
+
+        key = content_hash(model, input_data)
+        cached = self.local.get(key)
+        if cached is not None:
+            return cached
+
+        while key in self._inflight:
+            inflight = self._inflight[key]
+            metrics.counter("response_cache_coalesced").inc()
+            try:
+                return await asyncio.wait_for(asyncio.shield(inflight), max_wait)
+            except asyncio.TimeoutError:
+                metrics.counter("response_cache_wait_timeouts").inc()
+                raise TimeoutError(f"In-flight response {key} was not ready within {max_wait} seconds")
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # The leading request was cancelled; try again, possibly as the new leader.
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._fetch_or_lead(key, ttl, compute, max_wait)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark it retrieved so a future without followers does not log a warning
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _fetch_or_lead(self, key, ttl, compute, max_wait=None):
+        """Cross-process single flight through Redis."""
+        give_up_at = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            cached = await self.redis_client.get(self._response_key(key))
+            if cached is not None:
+                metrics.counter("response_cache_redis_hits").inc()
+                self.local.set(key, cached, ttl)
+                return cached
+
+            token = uuid.uuid4().hex
+            if await self.redis_client.set(self._lock_key(key), token, nx=True, ex=self.lock_ttl):
+                return await self._lead(key, ttl, token, compute)
+
+            # Another process is computing this response: wait for it to publish.
+            metrics.counter("response_cache_coalesced").inc()
+            timeout = self.lock_ttl
+            if give_up_at is not None:
+                timeout = min(timeout, give_up_at - time.monotonic())
+            if not await self._wait_for_leader(key, timeout):
+                if timeout < self.lock_ttl:
+                    metrics.counter("response_cache_wait_timeouts").inc()
+                    raise TimeoutError(f"In-flight response {key} was not ready within {max_wait} seconds")
+                logger.warning(f"Timed out waiting for in-flight response {key}; computing it here")
+                return await compute()
+
+    async def _lead(self, key, ttl, token, compute):
+        try:
+            result = await compute()
+            if result is not None:
+                self.local.set(key, result, ttl)
+                if len(result.encode("utf-8")) <= self.max_item_bytes:
+                    await self.redis_client.set(self._response_key(key), result, ex=ttl)
+            return result
+        finally:
+            # Release the lock only if it is still ours, then wake followers either way.
+            await self.redis_client.eval(
+                """
+                if redis.call('GET', KEYS[1]) == ARGV[1] then
+                    redis.call('DEL', KEYS[1])
+                end
+                return redis.call('PUBLISH', KEYS[2], 1)
+                """,
+                2, self._lock_key(key), self._channel(key), token
+            )
+
+    async def _wait_for_leader(self, key, timeout):
+        """Block up to `timeout` seconds until the leader publishes or its lock disappears. Returns False on timeout."""
+        pubsub = self.redis_client.pubsub()
+        try:
+            await pubsub.subscribe(self._channel(key))
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while loop.time() < deadline:
+                # Re-check after subscribing so a result published just before is not missed.
+                if not await self.redis_client.exists(self._lock_key(key)):
+                    return True
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=max(0, min(1.0, deadline - loop.time()))
+                )
+                if message is not None:
+                    return True
+            return False
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    async def cleanup(self):
+        """Cleanup resources when shutting down."""
+        if self.redis_client:
+            await self.redis_client.close()
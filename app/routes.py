@@ -1,102 +1,173 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, APIRouter
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import File, UploadFile, Form, HTTPException, APIRouter, Depends, Request, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from typing import List, Optional
 import uuid
-import asyncpg
+import asyncio
 import json
-import redis.asyncio as redis
+import math
+import re
+import time
+from datetime import datetime
 from app.config import Config
-from app.request_logger import RequestLogger
-from app.llm_processor import GeminiProcessor
-from app.request_classifier import RequestClassifier
-from app.semaphore_manager import SemaphoreManager
+from app.container import AppContainer
+from app.status_cache import FINAL_STATUSES
+from app.request_queue import DEFAULT_PRIORITY, DEFAULT_TENANT
+from app.llm_processor import estimate_tokens
+from app.resilience import CircuitOpenError
+from app.semaphore_manager import jittered
+from app.request_logger import RequestLogUnavailable
+from app.uploads import UploadTooLarge, release_uploads
 from app.utils import custom_logging
+from app import metrics
 from pydantic import BaseModel
 
 
 router = APIRouter()
-db_pool = None
-request_logger = None
-gemini_processor = GeminiProcessor(Config.GEMINI_API_KEY)
-request_classifier = RequestClassifier(gemini_processor=gemini_processor)
-semaphore_manager = SemaphoreManager(Config.REDIS_URL, Config.RATE_LIMITS, Config.SEMAPHORE_TIMEOUT)
+# Served at the root, where Prometheus scrapes by default
+prometheus_router = APIRouter()
 logger = custom_logging()
-redis_client = None
 
-@router.on_event("startup")
-async def startup_event():
-    """Initialize async resources when the application starts"""
-    global db_pool, request_logger, redis_client
-    
-    # Initialize database connection pool
-    db_pool = await asyncpg.create_pool(Config.DATABASE_URL)
-    request_logger = RequestLogger(db_pool)
-    
-    # Initialize Redis client
-    redis_client = await redis.from_url(Config.REDIS_URL, decode_responses=True)
-    
-    # Initialize semaphore manager
-    await semaphore_manager.initialize()
-
-@router.on_event("shutdown")
-async def shutdown_event():
-    """Clean up resources when the application shuts down"""
-    if db_pool:
-        await db_pool.close()
-    if redis_client:
-        await redis_client.close()
-    # Cleanup semaphore manager
-    await semaphore_manager.cleanup()
+
+def get_container(request: Request) -> AppContainer:
+    """Services built by the app's lifespan (see app.create_app)"""
+    return request.app.state.container
+
+TENANT_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+def request_flow(request: Request, priority: Optional[str]):
+    """Tenant (from the tenant header) and priority class a request is queued under; 400 if either is invalid"""
+    tenant = request.headers.get(Config.TENANT_HEADER, DEFAULT_TENANT)
+    if not TENANT_PATTERN.fullmatch(tenant):
+        raise HTTPException(status_code=400, detail=f"Invalid {Config.TENANT_HEADER} header")
+    priority = priority or request.headers.get("X-Priority", DEFAULT_PRIORITY)
+    if priority not in Config.PRIORITY_WEIGHTS:
+        raise HTTPException(
+            status_code=400, detail=f"priority must be one of: {', '.join(Config.PRIORITY_WEIGHTS)}"
+        )
+    return tenant, priority
+
+def request_deadline(request: Request):
+    """Monotonic time by which the client wants an answer (from the deadline header), or None; 400 if invalid"""
+    value = request.headers.get(Config.DEADLINE_HEADER)
+    if value is None:
+        return None
+    if not value.isdigit() or int(value) <= 0:
+        raise HTTPException(status_code=400, detail=f"{Config.DEADLINE_HEADER} must be a positive number of milliseconds")
+    return time.monotonic() + int(value) / 1000
+
+def admission_wait(deadline):
+    """Seconds to wait for a permit: SEMAPHORE_TIMEOUT, or less if the client's deadline comes first"""
+    if deadline is None:
+        return Config.SEMAPHORE_TIMEOUT
+    return max(0, min(Config.SEMAPHORE_TIMEOUT, deadline - time.monotonic()))
+
+def retry_after(seconds):
+    """Retry-After header for an estimated wait in seconds (none while unknown)"""
+    if seconds is None:
+        return {}
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
 
 class TextRequest(BaseModel):
     text: str
 
 @router.post("/submit")
 async def submit_request(
+    request: Request,
     text: Optional[str] = Form(None),
-    files: List[UploadFile] = File([])
+    files: List[UploadFile] = File([]),
+    priority: Optional[str] = Form(None),
+    container: AppContainer = Depends(get_container),
 ):
     if not files and not text:
         raise HTTPException(status_code=400, detail="Either text or a file must be provided")
+    tenant, priority = request_flow(request, priority)
+    deadline = request_deadline(request)
     
     req_id = str(uuid.uuid4())
+    created_at = datetime.now()
     
-    input_type, input_data = await request_classifier.classify_request(text, files)
-    logger.info(f"Processing request: {req_id} of type: {input_type}")
     try:
-        # Try to acquire the semaphore
-        await semaphore_manager.acquire_semaphore(input_type)
-        
+        input_type, input_data = await container.request_classifier.classify_request(text, files)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    logger.info(f"Processing request: {req_id} of type: {input_type}")
+
+    async def call_llm():
+        if container.prompt_batcher and container.prompt_batcher.accepts(input_type, input_data):
+            # Shares a permit and an upstream call with other short prompts arriving now
+            return await container.prompt_batcher.process(input_data, deadline)
+        # Try to acquire the semaphore; queued right away if the estimated wait is too long
+        lease = await container.semaphore_manager.acquire_semaphore(
+            input_type, tokens=estimate_tokens(input_data), budget=container.gemini_processor.budgets,
+            max_wait=admission_wait(deadline)
+        )
         try:
             # If successful, process the request immediately
-            response_data = await gemini_processor.process_llm_request(input_data)        
-            await request_logger.save_request(req_id, input_type, input_data, response_data)
-            
-            return {"request_id": req_id, "response": response_data}
-            
+            return await container.gemini_processor.process_llm_request(input_data, lease)
         finally:
             # Always release the semaphore if we acquired it
-            await semaphore_manager.release_semaphore(input_type)
+            await container.semaphore_manager.release_semaphore(lease)
+
+    try:
+        if container.response_cache:
+            # Identical requests share one upstream call and skip the semaphore on a hit
+            response_data = await container.response_cache.get_or_compute(
+                input_type, container.gemini_processor.model, input_data, call_llm,
+                # Without a client deadline, waiting for the leader beats a second upstream call
+                max_wait=None if deadline is None else max(0, deadline - time.monotonic())
+            )
+        else:
+            response_data = await call_llm()
+        record = await container.request_logger.save_request(
+            req_id, input_type, input_data, response_data, created_at=created_at
+        )
+        await container.status_cache.set(record)
         
-    except TimeoutError:
+        return {"request_id": req_id, "response": response_data}
+        
+    except TimeoutError as e:
+        # Workers serve the queue with the same permits, behind everything already queued
+        queue_wait = await container.semaphore_manager.estimate_wait(
+            input_type, ahead=await container.request_queue.depth(input_type),
+            tokens=estimate_tokens(input_data), budget=container.gemini_processor.budgets
+        )
+        # ...and no earlier than the semaphore or an open circuit would let it through
+        waits = [wait for wait in (queue_wait, getattr(e, "retry_after", None)) if wait is not None]
+        queue_wait = max(waits) if waits else None
+        if deadline is not None and queue_wait is not None and time.monotonic() + queue_wait > deadline:
+            # Queued, it would finish after the client stopped waiting
+            logger.warning(f"Request {req_id} rejected: estimated wait {queue_wait:.1f}s is past its deadline")
+            metrics.counter("deadline_rejections", input_type=input_type).inc()
+            return JSONResponse(
+                status_code=429,
+                # Spread out so rejected clients do not all retry at once
+                headers=retry_after(jittered(queue_wait)),
+                content={
+                    "request_id": req_id,
+                    "status": "rejected",
+                    "message": "Your request cannot be served within its deadline. Please try again after some time."
+                }
+            )
+
         # If semaphore acquisition fails, queue the request for later processing
         logger.warning(f"Request {req_id} rate-limited. Queuing for later processing.")
         
         # Save the request with 'queued' status
-        await request_logger.save_request(req_id, input_type, input_data, None, "queued")
+        record = await container.request_logger.save_request(
+            req_id, input_type, input_data, None, "queued", created_at=created_at
+        )
+        # Polls from any replica see the request before its row is flushed
+        await container.status_cache.set(record)
         
-        # Add to the appropriate Redis queue
-        queue_key = f"queue:{input_type}"
-        request_data = {
-            "id": req_id,
-            "input_type": input_type,
-            "input_data": str(input_data)
-        }
-        await redis_client.rpush(queue_key, json.dumps(request_data))
+        # Add to the tenant's stream in its priority class; file bytes go to the blob store
+        await container.request_queue.enqueue(
+            input_type, req_id, input_data, created_at, tenant=tenant, priority=priority
+        )
         
-        # Return a response indicating the request is queued
+        # Return a response indicating the request is queued, and when it is likely done
         return JSONResponse(
             status_code=202,
+            headers=retry_after(queue_wait),
             content={
                 "request_id": req_id,
                 "status": "queued",
@@ -108,44 +179,102 @@ async def submit_request(
         logger.error(f"Error processing request {req_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
 
+    finally:
+        # Remove the spooled upload files; queued requests keep their bytes in the blob store
+        release_uploads(input_data)
+
+async def lookup_status(container, request_id):
+    """Request state from the Redis hot cache, falling back to the request log (and caching it)"""
+    record = await container.status_cache.get(request_id)
+    if record is None:
+        record = await container.request_logger.get_request(request_id)
+        if record is not None:
+            await container.status_cache.set(record)
+    return record
+
 @router.get("/status/{request_id}")
-async def check_status(request_id: str):
-    """Endpoint to check the status of a request"""
+async def check_status(
+    request_id: str,
+    wait: float = Query(0, ge=0, description="Seconds to long-poll for a final status"),
+    container: AppContainer = Depends(get_container),
+):
+    """Endpoint to check the status of a request, optionally waiting for it to finish"""
     try:
-        request_data = await request_logger.get_request(request_id)
-        if not request_data:
-            raise HTTPException(status_code=404, detail="Request not found")
-            
-        return request_data
+        if wait:
+            request_data = await container.status_cache.wait(
+                request_id, min(wait, Config.STATUS_MAX_WAIT),
+                lambda request_id: lookup_status(container, request_id)
+            )
+        else:
+            request_data = await lookup_status(container, request_id)
+    except RequestLogUnavailable:
+        # Not a 404: the request may well exist
+        raise HTTPException(status_code=503, detail="Request status is temporarily unavailable", headers=retry_after(5))
     except Exception as e:
         logger.error(f"Error checking status for request {request_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    if not request_data:
+        raise HTTPException(status_code=404, detail="Request not found")
+    return request_data
+
+@router.get("/status/{request_id}/events")
+async def status_events(request_id: str, container: AppContainer = Depends(get_container)):
+    """
+    Server-Sent Events: a `status` event with the current state, then one with
+    the final state as soon as the worker finishes. Comments keep the connection alive.
+    """
+    try:
+        request_data = await lookup_status(container, request_id)
+    except RequestLogUnavailable:
+        raise HTTPException(status_code=503, detail="Request status is temporarily unavailable", headers=retry_after(5))
+    if not request_data:
+        raise HTTPException(status_code=404, detail="Request not found")
+
+    async def events():
+        record = request_data
+        yield f"event: status\ndata: {json.dumps(record, default=str)}\n\n"
+        while record["status"] not in FINAL_STATUSES:
+            record = await container.status_cache.wait(
+                request_id, Config.STATUS_SSE_KEEPALIVE,
+                lambda request_id: lookup_status(container, request_id)
+            )
+            if record is None:
+                break
+            if record["status"] in FINAL_STATUSES:
+                yield f"event: status\ndata: {json.dumps(record, default=str)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @router.post("/stream")
-async def stream_response(text: Optional[str] = Form(None)):
+async def stream_response(
+    request: Request,
+    text: Optional[str] = Form(None),
+    container: AppContainer = Depends(get_container),
+):
     """Endpoint for streaming content, supports text only for now"""
     if not text:
         raise HTTPException(status_code=400, detail="Text must be provided")
+    deadline = request_deadline(request)
     
     req_id = str(uuid.uuid4())
     
-    input_type, input_data = await request_classifier.classify_request(text, [])
+    input_type, input_data = await container.request_classifier.classify_request(text, [])
     logger.info(f"Processing request: {req_id} of type: {input_type}")
     try:
-        # Try to acquire the semaphore
-        await semaphore_manager.acquire_semaphore(input_type)
-        try:
-            async def generate_chunks():
-                async for chunk in gemini_processor.stream_content(text):
-                    yield chunk
-        finally:
-            # Always release the semaphore if we acquired it
-            await semaphore_manager.release_semaphore(input_type)
-    except TimeoutError:
+        # Try to acquire the semaphore; rejected right away if the estimated wait is too long
+        lease = await container.semaphore_manager.acquire_semaphore(
+            input_type, tokens=estimate_tokens(input_data), budget=container.gemini_processor.budgets,
+            max_wait=admission_wait(deadline)
+        )
+    except TimeoutError as e:
         # If semaphore acquisition fails, request has been rate limited
         logger.warning(f"Request {req_id} rate-limited")
         return JSONResponse(
             status_code=429,
+            headers=retry_after(getattr(e, "retry_after", None)),
             content={
                 "request_id": req_id,
                 "status": "rate_limited",
@@ -153,20 +282,109 @@ async def stream_response(text: Optional[str] = Form(None)):
             }
         )
     except Exception as e:
-        logger.error(f"Error checking status for request {req_id}: {str(e)}")
+        logger.error(f"Error streaming request {req_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    return StreamingResponse(generate_chunks(), media_type="text/plain")
+
+    async def generate_chunks():
+        """Owns the lease: it is released when the stream finishes, fails or the client disconnects."""
+        try:
+            async for chunk in container.gemini_processor.stream_content(text, lease):
+                yield chunk
+        finally:
+            # Shielded so a cancelled response task still returns the permit
+            await asyncio.shield(container.semaphore_manager.release_semaphore(lease))
+
+    chunks = generate_chunks()
+    try:
+        # Wait for the first chunk so upstream errors surface as a proper status code
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = ""
+    except CircuitOpenError as e:
+        logger.warning(f"Request {req_id} not streamed: {e}")
+        return JSONResponse(
+            status_code=503,
+            headers=retry_after(e.retry_after),
+            content={
+                "request_id": req_id,
+                "status": "unavailable",
+                "message": "The LLM is failing right now. Please try again after some time."
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error streaming request {req_id}: {str(e)}")
+        raise HTTPException(status_code=502, detail="Upstream LLM error")
+
+    async def stream_chunks():
+        try:
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(stream_chunks(), media_type="text/plain")
+
+async def refresh_shared_gauges(container):
+    """Set the gauges of state shared by every process: permits in use, limits, queue depth and age"""
+    limits = await container.semaphore_manager.current_limits()
+    in_use = await container.semaphore_manager.permits_in_use()
+    for input_type, limit in limits.items():
+        metrics.gauge("concurrency_limit", input_type=input_type).set(limit)
+        metrics.gauge("permits_in_use", input_type=input_type).set(in_use[input_type])
+        metrics.gauge("queue_depth", input_type=input_type).set(await container.request_queue.depth(input_type))
+        metrics.gauge("queue_oldest_age_seconds", input_type=input_type).set(
+            await container.request_queue.oldest_age(input_type)
+        )
+    if container.circuit_breaker:
+        states = await container.circuit_breaker.states(container.gemini_processor.models)
+        for model, state in states.items():
+            # 0 closed, 1 half-open, 2 open
+            metrics.gauge("circuit_state", model=model).set(("closed", "half_open", "open").index(state))
+    return limits
+
+@router.get("/metrics")
+async def get_metrics(container: AppContainer = Depends(get_container)):
+    """
+    In-process latency and counter metrics for this API process and its startup
+    timings, the current (adaptive) concurrency limits, and the latest metrics
+    each worker exported (per-tenant queue wait)
+    """
+    limits = await refresh_shared_gauges(container)
+    workers = {}
+    async for key in container.redis_client.scan_iter(match="metrics:worker:*"):
+        exported = await container.redis_client.get(key)
+        if exported:
+            workers[key[len("metrics:worker:"):]] = json.loads(exported)
+    return dict(
+        metrics.snapshot(), startup_ms=container.startup_timings,
+        concurrency_limits=limits, workers=workers
+    )
+
+@prometheus_router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(container: AppContainer = Depends(get_container)):
+    """
+    Prometheus exposition of this API process's metrics, the shared semaphore
+    and queue gauges, and each worker's latest export (labelled `worker`)
+    """
+    await refresh_shared_gauges(container)
+    families = metrics.families()
+    async for key in container.redis_client.scan_iter(match="metrics:families:*"):
+        exported = await container.redis_client.get(key)
+        if exported:
+            metrics.merge_families(families, json.loads(exported), worker=key[len("metrics:families:"):])
+    return PlainTextResponse(metrics.render_prometheus(families), media_type="text/plain; version=0.0.4")
 
 @router.get("/health")
-async def health_check():
+async def health_check(container: AppContainer = Depends(get_container)):
     """Health check endpoint"""
     try:
         # Check database connection
-        async with db_pool.acquire() as conn:
+        async with container.db_pool.acquire() as conn:
             await conn.execute("SELECT 1")
         
         # Check Redis connection
-        await redis_client.ping()
+        await container.redis_client.ping()
         
         return {"status": "healthy"}
     except Exception as e:
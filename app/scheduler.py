@@ -0,0 +1,58 @@
+class FairScheduler:
+    """
+    Start-time fair queuing across flows (one per priority class and tenant).
+
+    Each flow holds at most one buffered head entry. Serving a flow advances its
+    virtual finish tag by 1 / weight, and the backlogged flow with the smallest
+    start tag max(virtual_time, finish) goes next, so over any busy period every
+    backlogged flow gets dispatches in proportion to its weight. A flow that was
+    idle starts at the current virtual time and cannot bank credit.
+
+    Starvation bound: once a flow f is backlogged, each other backlogged flow g
+    is served at most ceil(weight(g) / weight(f)) + 1 times before f is served.
+    """
+
+    def __init__(self, weight):
+        self.weight = weight  # flow -> positive weight
+        self.virtual_time = 0.0
+        self._finish = {}  # flow -> finish tag of its last dispatch
+        self._heads = {}  # flow -> buffered head entry
+        self._order = {}  # flow -> arrival counter, breaks ties first-come first-served
+        self._arrivals = 0
+
+    def __len__(self):
+        return len(self._heads)
+
+    def backlogged(self, flow):
+        return flow in self._heads
+
+    def push(self, flow, entry):
+        """Buffer a flow's head entry. A flow holds one entry at a time."""
+        if flow in self._heads:
+            raise ValueError(f"Flow {flow} already has a buffered entry")
+        self._arrivals += 1
+        self._heads[flow] = entry
+        self._order[flow] = self._arrivals
+
+    def pop(self):
+        """Take the entry that goes next as (flow, entry), or None if nothing is buffered."""
+        if not self._heads:
+            return None
+        flow = min(self._heads, key=lambda f: (self._start_tag(f), self._order[f]))
+        start = self._start_tag(flow)
+        self.virtual_time = start
+        self._finish[flow] = start + 1.0 / self.weight(flow)
+        del self._order[flow]
+        return flow, self._heads.pop(flow)
+
+    def entries(self):
+        """Buffered (flow, entry) pairs."""
+        return list(self._heads.items())
+
+    def forget_idle(self):
+        """Drop finish tags that can no longer matter, so tags of departed flows do not pile up."""
+        for flow in [f for f, finish in self._finish.items() if finish <= self.virtual_time and f not in self._heads]:
+            del self._finish[flow]
+
+    def _start_tag(self, flow):
+        return max(self.virtual_time, self._finish.get(flow, 0.0))
@@ -1,108 +1,1190 @@
 import time
+import uuid
+import json
+import random
 import asyncio
 import redis.asyncio as redis
 from app.utils import custom_logging
+from app import metrics, tracing
 
 logger = custom_logging(__name__)
 
+# Shared Lua helpers. Each permit is a lease: a member of the holders sorted set
+# scored by its expiry in milliseconds (Redis server time). Expired leases are
+# reaped before every admission decision, so permits held by crashed processes
+# come back on their own.
+#
+# Requests-per-minute and tokens-per-minute quotas are token buckets stored as
+# {tokens, ts} hashes that refill continuously at capacity per minute. charge()
+# takes from both buckets only if both can pay, otherwise it returns the number
+# of milliseconds until they could. A capacity of 0 disables a bucket.
+#
+# A request may be served by any of several budgets (pool members: an API key
+# and model each), passed as a JSON list of {name, holders, rpm_key, rpm,
+# tpm_key, tpm, limit, ejected}. route() picks the least-loaded one, by
+# held member permits over the member's `limit` (0 = no member limit), among
+# those with a free member permit whose buckets can pay, and charges it.
+# Members whose `ejected` key exists are skipped unless every member is ejected.
+#
+# dispatch() hands free permits to queued waiters in FIFO order. A waiter is
+# only eligible while its marker hash exists; markers of waiters that timed out
+# or died expire on their own and are skipped here. The marker carries the
+# waiter's candidate budgets so one is routed to and charged when the permit is
+# handed over; the chosen budget's name is what the waiter is woken with.
+#
+# With adaptive limits, an input type's capacity is read from its
+# {limit, baseline_ms, decreased_at} hash, shared by every replica, and falls
+# back to the configured limit while the hash is absent. adapt() is AIMD driven
+# by each released lease: the limit is multiplied by `backoff` when the upstream
+# throttled (429/503 or a timeout) or the call took more than `tolerance` times
+# the smoothed baseline latency, at most once per baseline latency so one burst
+# of failures counts once. Otherwise it grows by 1 / limit per success, i.e. by
+# one per limit's worth of calls, but only while demand uses at least half of it.
+# The baseline follows faster calls quickly and slower ones slowly. The hash
+# expires after an hour without releases, which restores the configured limit.
+#
+# Every release also feeds how long the permit was held into a moving average
+# per input type ({ms} hash, shared by every replica). estimate_wait() turns it
+# into the expected wait of a new caller: the callers that would be ahead of it
+# once free permits are taken, served `limit` at a time. rate_wait() is the
+# matching wait on the rate budgets: until the candidates' RPM and TPM buckets
+# have refilled enough for those callers too.
+LEASE_LUA = """
+local function now_ms()
+    local t = redis.call('TIME')
+    return tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+end
+
+local function bucket_level(key, capacity, now)
+    if capacity <= 0 then
+        return nil
+    end
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - ts) * capacity / 60000)
+end
+
+local function bucket_store(key, tokens, now)
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', key, 120000)
+end
+
+local function charge(rpm_key, rpm, tpm_key, tpm, cost, now, dry_run)
+    local wait = 0
+    local rpm_level = bucket_level(rpm_key, rpm, now)
+    if rpm_level and rpm_level < 1 then
+        wait = math.ceil((1 - rpm_level) * 60000 / rpm)
+    end
+    local tpm_level = bucket_level(tpm_key, tpm, now)
+    if tpm_level then
+        cost = math.min(cost, tpm)
+        if tpm_level < cost then
+            wait = math.max(wait, math.ceil((cost - tpm_level) * 60000 / tpm))
+        end
+    end
+    if wait > 0 or dry_run then
+        return wait
+    end
+    if rpm_level then
+        bucket_store(rpm_key, rpm_level - 1, now)
+    end
+    if tpm_level then
+        bucket_store(tpm_key, tpm_level - cost, now)
+    end
+    return 0
+end
+
+local function route(members, cost, now)
+    local healthy = {}
+    for _, m in ipairs(members) do
+        if redis.call('EXISTS', m.ejected) == 0 then
+            table.insert(healthy, m)
+        end
+    end
+    if #healthy == 0 then
+        healthy = members
+    end
+    local best, best_load
+    local wait = 0
+    for _, m in ipairs(healthy) do
+        redis.call('ZREMRANGEBYSCORE', m.holders, '-inf', now)
+        local busy = redis.call('ZCARD', m.holders)
+        if m.limit <= 0 or busy < m.limit then
+            local w = charge(m.rpm_key, m.rpm, m.tpm_key, m.tpm, cost, now, true)
+            if w > 0 then
+                if wait == 0 or w < wait then
+                    wait = w
+                end
+            else
+                local load = busy
+                if m.limit > 0 then
+                    load = busy / m.limit
+                end
+                if not best or load < best_load then
+                    best, best_load = m, load
+                end
+            end
+        end
+    end
+    if best then
+        charge(best.rpm_key, best.rpm, best.tpm_key, best.tpm, cost, now, false)
+    end
+    return best, wait
+end
+
+local function grant(holders, member, token, expiry)
+    redis.call('ZADD', holders, expiry, token)
+    if member then
+        redis.call('ZADD', member.holders, expiry, token)
+        return member.name
+    end
+    return ''
+end
+
+local function rate_wait(members, cost, queued, now)
+    local healthy = {}
+    for _, m in ipairs(members) do
+        if redis.call('EXISTS', m.ejected) == 0 then
+            table.insert(healthy, m)
+        end
+    end
+    if #healthy == 0 then
+        healthy = members
+    end
+    if #healthy == 0 then
+        return 0
+    end
+    -- The caller is served after the `queued` callers ahead of it, all charged
+    -- about `cost` tokens, by whichever member's buckets refill first
+    local need = queued + 1
+    local rpm_level, rpm_rate, tpm_level, tpm_rate = 0, 0, 0, 0
+    local rpm_open, tpm_open = false, false
+    for _, m in ipairs(healthy) do
+        local level = bucket_level(m.rpm_key, m.rpm, now)
+        if level then
+            rpm_level, rpm_rate = rpm_level + level, rpm_rate + m.rpm
+        else
+            rpm_open = true
+        end
+        level = bucket_level(m.tpm_key, m.tpm, now)
+        if level then
+            tpm_level, tpm_rate = tpm_level + level, tpm_rate + m.tpm
+        else
+            tpm_open = true
+        end
+    end
+    local wait = 0
+    if not rpm_open then
+        wait = math.ceil((need - rpm_level) * 60000 / rpm_rate)
+    end
+    if not tpm_open then
+        wait = math.max(wait, math.ceil((need * cost - tpm_level) * 60000 / tpm_rate))
+    end
+    return math.max(wait, 0)
+end
+
+local function current_limit(key, limit, adaptive)
+    if adaptive == 1 then
+        local adapted = tonumber(redis.call('HGET', key, 'limit'))
+        if adapted then
+            return math.floor(adapted)
+        end
+    end
+    return limit
+end
+
+local function adapt(key, limit, demand, latency_ms, overloaded, floor, ceiling, backoff, tolerance, now)
+    local state = redis.call('HMGET', key, 'limit', 'baseline_ms', 'decreased_at')
+    local current = tonumber(state[1]) or limit
+    local baseline = tonumber(state[2])
+    local decreased_at = tonumber(state[3]) or 0
+    local congested = overloaded == 1
+    if latency_ms >= 0 then
+        if not baseline then
+            baseline = latency_ms
+        else
+            if latency_ms > baseline * tolerance then
+                congested = true
+            end
+            local alpha = latency_ms < baseline and 0.2 or 0.02
+            baseline = baseline + (latency_ms - baseline) * alpha
+        end
+        redis.call('HSET', key, 'baseline_ms', baseline)
+    end
+    if congested then
+        if now - decreased_at >= (baseline or 1000) then
+            current = current * backoff
+            decreased_at = now
+        end
+    elseif demand * 2 >= current then
+        current = current + 1 / current
+    end
+    current = math.max(floor, math.min(ceiling, current))
+    redis.call('HSET', key, 'limit', current, 'decreased_at', decreased_at)
+    redis.call('PEXPIRE', key, 3600000)
+    return math.floor(current)
+end
+
+local function record_service(key, hold_ms, samples)
+    local service = tonumber(redis.call('HGET', key, 'ms'))
+    for _ = 1, samples do
+        service = service and service + (hold_ms - service) * 0.1 or hold_ms
+    end
+    if service then
+        redis.call('HSET', key, 'ms', service)
+        redis.call('PEXPIRE', key, 3600000)
+    end
+end
+
+local function estimate_wait(key, holders, waiters, limit, ahead)
+    local service = tonumber(redis.call('HGET', key, 'ms'))
+    if not service then
+        return -1
+    end
+    local queued = redis.call('LLEN', waiters) + ahead + 1 - math.max(0, limit - redis.call('ZCARD', holders))
+    if queued <= 0 then
+        return 0
+    end
+    return math.ceil(queued * service / math.max(limit, 1))
+end
+
+local function dispatch(holders, waiters, prefix, limit, lease_ttl, now)
+    redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+    local available = limit - redis.call('ZCARD', holders)
+    local wait = 0
+    while available > 0 do
+        local token = redis.call('LINDEX', waiters, 0)
+        if not token then
+            break
+        end
+        local marker = prefix .. 'waiter:' .. token
+        local w = redis.call('HMGET', marker, 'wake_ttl', 'members', 'cost')
+        if w[1] then
+            local members = cjson.decode(w[2])
+            local member
+            if #members > 0 then
+                member, wait = route(members, tonumber(w[3]), now)
+                if not member then
+                    break
+                end
+            end
+            redis.call('DEL', marker)
+            local name = grant(holders, member, token, now + lease_ttl)
+            available = available - 1
+            local wake = prefix .. 'wake:' .. token
+            redis.call('RPUSH', wake, name)
+            redis.call('PEXPIRE', wake, w[1])
+        end
+        redis.call('LPOP', waiters)
+    end
+    return available, wait
+end
+"""
+
+
+class Lease:
+    """A permit held on one input type's semaphore, charged against an optional rate budget."""
+
+    def __init__(self, input_type, lease_id, budget=None, tokens=0):
+        self.input_type = input_type
+        self.lease_id = lease_id
+        self.budget = budget
+        self.tokens = tokens  # Estimated tokens charged at acquire time
+        self.used_tokens = None  # Actual tokens reported by the LLM, if known
+        self.latency = None  # Seconds the upstream took to answer, if known
+        self.overloaded = False  # The upstream throttled or timed out
+        self.failed = False  # The budget's upstream failed in a way that counts against its health
+        self.heartbeat_task = None
+        self.block = None  # The LocalPermits it was lent from, if any
+        self.acquired_at = time.monotonic()  # None if it never served a call
+        self.unused = False  # No call was sent under it
+
+    def record_usage(self, tokens):
+        """Record the real token count so the estimate is corrected on release."""
+        self.used_tokens = tokens
+
+    def record_latency(self, seconds):
+        """Record how long the upstream took, fed to the adaptive limit on release."""
+        self.latency = seconds
+
+    def record_overload(self):
+        """Record that the upstream throttled (429/503) or timed out, which lowers the adaptive limit."""
+        self.overloaded = True
+
+    def record_failure(self):
+        """Record an upstream failure of the lease's budget; enough in a row eject it for a while."""
+        self.failed = True
+
+    def clear_outcome(self):
+        """Forget the recorded outcome before the call is sent again, so only the last attempt counts."""
+        self.latency = None
+        self.overloaded = False
+        self.failed = False
+
+    def record_unused(self):
+        """Record that no call was sent: the request and its tokens are refunded and it is kept out of the wait estimate."""
+        self.clear_outcome()
+        self.used_tokens = 0
+        self.unused = True
+        self.acquired_at = None
+
+
+def jittered(seconds):
+    """
+    `seconds` plus up to a fifth of it (at least a second) at random, so callers
+    turned away together do not all come back at the same moment. None stays None.
+    """
+    if seconds is None:
+        return None
+    return seconds + random.uniform(0, max(1.0, seconds / 5))
+
+
+class SemaphoreTimeout(TimeoutError):
+    """
+    No permit was granted in time. `shed` if the caller was turned away without
+    waiting because the estimated wait exceeded what it could wait; `retry_after`
+    is the estimated wait in seconds, None while unknown.
+    """
+
+    def __init__(self, message, retry_after=None, shed=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.shed = shed
+
+
+class LocalPermits:
+    """
+    Permits of one input type reserved by this process. Each is a lease in the
+    shared holders set, so it counts against the global limit like any other;
+    calls borrow and return them without a Redis round trip, and one task keeps
+    the whole block alive.
+    """
+
+    def __init__(self, input_type):
+        self.input_type = input_type
+        self.block_id = uuid.uuid4().hex
+        self.reserved = set()  # Lease ids held in Redis for this block
+        self.free = []  # Reserved lease ids not lent out
+        self.reserving = 0  # Permits being reserved right now
+        self.sequence = 0
+        self.last_used = time.monotonic()
+        self.valid_until = 0.0  # Monotonic time the block's leases were last known to be alive until
+        # Outcomes of the calls served since the last sync, for the adaptive limit
+        self.samples = 0
+        self.latency_sum = 0.0
+        self.overloaded = False
+        self.holds = 0
+        self.hold_sum = 0.0
+        self.task = None
+
+    def new_ids(self, count):
+        start = self.sequence
+        self.sequence += count
+        return [f"{self.block_id}:{n}" for n in range(start, start + count)]
+
+
 class SemaphoreManager:
-    def __init__(self, redis_url, rate_limits, timeout):
+    KEY_PREFIX = "semaphore:"
+    BUCKET_PREFIX = "ratelimit:"
+
+    # Registered once per connection and run with EVALSHA, so a call only sends
+    # its keys and arguments.
+
+    # Take a free permit and charge the rate budget, or enqueue as a waiter
+    # (unless ARGV[9] is 0, or the estimated wait is over ARGV[10] ms: status 2).
+    ACQUIRE_LUA = LEASE_LUA + """
+    local now = now_ms()
+    local lease_ttl = tonumber(ARGV[4])
+    local limit = current_limit(KEYS[4], tonumber(ARGV[3]), tonumber(ARGV[8]))
+    local available, wait = dispatch(KEYS[1], KEYS[2], ARGV[1], limit, lease_ttl, now)
+    if available > 0 and redis.call('LLEN', KEYS[2]) == 0 then
+        local members = cjson.decode(ARGV[6])
+        local member
+        if #members > 0 then
+            member, wait = route(members, tonumber(ARGV[7]), now)
+        end
+        if member or #members == 0 then
+            return {1, available - 1, grant(KEYS[1], member, ARGV[2], now + lease_ttl), 0}
+        end
+    end
+    local estimate = estimate_wait(KEYS[5], KEYS[1], KEYS[2], limit, 0)
+    -- Waiting for a permit, the caller may still find the budgets' buckets drained by the waiters ahead
+    local refill = rate_wait(cjson.decode(ARGV[6]), tonumber(ARGV[7]), redis.call('LLEN', KEYS[2]), now)
+    if refill > 0 then
+        estimate = math.max(estimate, refill)
+    end
+    if ARGV[9] == '0' then
+        return {0, wait, '', estimate}
+    end
+    local max_wait = tonumber(ARGV[10])
+    if max_wait >= 0 and estimate > max_wait then
+        return {2, wait, '', estimate}
+    end
+    redis.call('HSET', KEYS[3], 'wake_ttl', ARGV[5], 'members', ARGV[6], 'cost', ARGV[7])
+    redis.call('PEXPIRE', KEYS[3], ARGV[5])
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+    return {0, wait, '', estimate}
+    """
+
+    EXTEND_LUA = LEASE_LUA + """
+    if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+        local expiry = now_ms() + tonumber(ARGV[2])
+        redis.call('ZADD', KEYS[1], 'XX', expiry, ARGV[1])
+        redis.call('ZADD', KEYS[2], 'XX', expiry, ARGV[1])
+        return 1
+    end
+    return 0
+    """
+
+    ESTIMATE_LUA = LEASE_LUA + """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms())
+    local limit = current_limit(KEYS[3], tonumber(ARGV[1]), tonumber(ARGV[2]))
+    local estimate = estimate_wait(KEYS[4], KEYS[1], KEYS[2], limit, tonumber(ARGV[3]))
+    local queued = redis.call('LLEN', KEYS[2]) + tonumber(ARGV[3])
+    local wait = rate_wait(cjson.decode(ARGV[4]), tonumber(ARGV[5]), queued, now_ms())
+    if wait > 0 then
+        estimate = math.max(estimate, wait)
+    end
+    return estimate
+    """
+
+    AVAILABLE_LUA = LEASE_LUA + """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms())
+    local limit = current_limit(KEYS[3], tonumber(ARGV[1]), tonumber(ARGV[2]))
+    local available = limit - redis.call('ZCARD', KEYS[1]) - redis.call('LLEN', KEYS[2])
+    return math.max(available, 0)
+    """
+
+    POLL_LUA = LEASE_LUA + """
+    local limit = current_limit(KEYS[4], tonumber(ARGV[2]), tonumber(ARGV[4]))
+    local available, wait = dispatch(KEYS[1], KEYS[2], ARGV[1], limit, tonumber(ARGV[3]), now_ms())
+    local granted = redis.call('LPOP', KEYS[3])
+    if granted then
+        return {1, 0, granted}
+    end
+    return {0, wait, ''}
+    """
+
+    CANCEL_LUA = """
+    local removed = redis.call('DEL', KEYS[2])
+    redis.call('LREM', KEYS[1], 0, ARGV[1])
+    if removed == 1 then
+        return {0, ''}
+    end
+    local granted = redis.call('LPOP', KEYS[3])
+    if granted then
+        return {1, granted}
+    end
+    -- The hand-off may already have been popped by a wait that was then cancelled
+    if redis.call('ZSCORE', KEYS[4], ARGV[1]) then
+        for _, member in ipairs(cjson.decode(ARGV[2])) do
+            if redis.call('ZSCORE', member.holders, ARGV[1]) then
+                return {1, member.name}
+            end
+        end
+        return {1, ''}
+    end
+    return {0, ''}
+    """
+
+    RELEASE_LUA = LEASE_LUA + """
+    local now = now_ms()
+    local demand = redis.call('ZCARD', KEYS[1]) + redis.call('LLEN', KEYS[2])
+    redis.call('ZREM', KEYS[1], ARGV[2])
+    redis.call('ZREM', KEYS[5], ARGV[2])
+    local ejected = 0
+    if ARGV[14] == '1' then
+        local failures = redis.call('INCR', KEYS[6])
+        redis.call('PEXPIRE', KEYS[6], ARGV[16])
+        if failures >= tonumber(ARGV[15]) then
+            redis.call('SET', KEYS[7], 1, 'PX', ARGV[16])
+            redis.call('DEL', KEYS[6])
+            ejected = 1
+        end
+    elseif tonumber(ARGV[8]) >= 0 then
+        redis.call('DEL', KEYS[6])
+    end
+    if tonumber(ARGV[18]) >= 0 then
+        record_service(KEYS[8], tonumber(ARGV[18]), 1)
+    end
+    if ARGV[19] == '1' then
+        local rpm = tonumber(ARGV[20])
+        local level = bucket_level(KEYS[9], rpm, now)
+        if level then
+            bucket_store(KEYS[9], math.min(rpm, level + 1), now)
+        end
+    end
+    local tpm = tonumber(ARGV[5])
+    local refund = tonumber(ARGV[6])
+    if refund ~= 0 then
+        local level = bucket_level(KEYS[3], tpm, now)
+        if level then
+            bucket_store(KEYS[3], math.min(tpm, level + refund), now)
+        end
+    end
+    local limit = current_limit(KEYS[4], tonumber(ARGV[3]), tonumber(ARGV[7]))
+    local latency_ms = tonumber(ARGV[8])
+    local overloaded = tonumber(ARGV[9])
+    if tonumber(ARGV[7]) == 1 and (latency_ms >= 0 or overloaded == 1) then
+        limit = adapt(KEYS[4], tonumber(ARGV[3]), demand, latency_ms, overloaded,
+            tonumber(ARGV[10]), tonumber(ARGV[11]), tonumber(ARGV[12]), tonumber(ARGV[13]), now)
+    end
+    local available = dispatch(KEYS[1], KEYS[2], ARGV[1], limit, tonumber(ARGV[4]), now)
+    for _, other in ipairs(cjson.decode(ARGV[17])) do
+        local other_limit = current_limit(other.limit_key, other.limit, tonumber(ARGV[7]))
+        dispatch(other.holders, other.waiters, ARGV[1], other_limit, tonumber(ARGV[4]), now)
+    end
+    return {available, limit, ejected}
+    """
+
+    # Reserve up to #ARGV[4] permits for a local block, as leases named by the
+    # caller, only while nobody is queued for them.
+    RESERVE_LUA = LEASE_LUA + """
+    local now = now_ms()
+    local lease_ttl = tonumber(ARGV[3])
+    local limit = current_limit(KEYS[3], tonumber(ARGV[2]), tonumber(ARGV[5]))
+    local available = dispatch(KEYS[1], KEYS[2], ARGV[1], limit, lease_ttl, now)
+    if redis.call('LLEN', KEYS[2]) > 0 then
+        return 0
+    end
+    local ids = cjson.decode(ARGV[4])
+    local reserved = math.max(0, math.min(available, #ids))
+    for i = 1, reserved do
+        redis.call('ZADD', KEYS[1], now + lease_ttl, ids[i])
+    end
+    return reserved
+    """
+
+    # Extend a local block's leases, apply the outcomes of the calls it served
+    # to the adaptive limit, and give free permits back when the block went
+    # idle, other processes are queued, or the limit dropped below what is held.
+    # Returns the ids given back and the ids that had already expired.
+    SYNC_BLOCK_LUA = LEASE_LUA + """
+    local now = now_ms()
+    local lease_ttl = tonumber(ARGV[3])
+    local adaptive = tonumber(ARGV[4])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    local lost = {}
+    for _, id in ipairs(cjson.decode(ARGV[5])) do
+        if redis.call('ZADD', KEYS[1], 'XX', 'CH', now + lease_ttl, id) == 0 and not redis.call('ZSCORE', KEYS[1], id) then
+            table.insert(lost, id)
+        end
+    end
+    local limit = current_limit(KEYS[3], tonumber(ARGV[2]), adaptive)
+    local samples = tonumber(ARGV[8])
+    if adaptive == 1 and (samples > 0 or ARGV[10] == '1') then
+        local demand = redis.call('ZCARD', KEYS[1]) + redis.call('LLEN', KEYS[2])
+        local floor, ceiling, backoff, tolerance = tonumber(ARGV[11]), tonumber(ARGV[12]), tonumber(ARGV[13]), tonumber(ARGV[14])
+        if ARGV[10] == '1' then
+            limit = adapt(KEYS[3], tonumber(ARGV[2]), demand, -1, 1, floor, ceiling, backoff, tolerance, now)
+        end
+        for _ = 1, samples do
+            limit = adapt(KEYS[3], tonumber(ARGV[2]), demand, tonumber(ARGV[9]), 0, floor, ceiling, backoff, tolerance, now)
+        end
+    end
+    record_service(KEYS[4], tonumber(ARGV[16]), tonumber(ARGV[15]))
+    local give_back = ARGV[7] == '1' or redis.call('LLEN', KEYS[2]) > 0
+    local over = redis.call('ZCARD', KEYS[1]) - limit
+    local returned = {}
+    for _, id in ipairs(cjson.decode(ARGV[6])) do
+        if give_back or over > 0 then
+            redis.call('ZREM', KEYS[1], id)
+            table.insert(returned, id)
+            over = over - 1
+        end
+    end
+    if #returned > 0 then
+        dispatch(KEYS[1], KEYS[2], ARGV[1], limit, lease_ttl, now)
+    end
+    return {returned, lost}
+    """
+
+    def __init__(
+        self, redis_url, rate_limits, timeout, lease_ttl=30, quotas=None,
+        limit_bounds=None, backoff=0.9, latency_tolerance=2.0,
+        failure_threshold=5, ejection_ms=30000, local_permits=0, local_idle_ms=500,
+    ):
         self.redis_url = redis_url
-        self.rate_limits = rate_limits 
+        self.rate_limits = rate_limits  # Fixed limits, or the starting limits when adaptive
         self.timeout = timeout  # Timeout in seconds for acquiring a semaphore
+        self.lease_ttl = lease_ttl  # Seconds a lease stays valid without a heartbeat
+        # {budget: {"rpm": int, "tpm": int, "concurrency": int}}, e.g. per model or pool member
+        self.quotas = quotas or {}
+        # {input_type: {"min": int, "max": int}}; None keeps the limits fixed
+        self.limit_bounds = limit_bounds
+        self.backoff = backoff  # Factor the adaptive limit is multiplied by on congestion
+        self.latency_tolerance = latency_tolerance  # Latency over this times the baseline is congestion
+        self.failure_threshold = failure_threshold  # Consecutive failures that eject a budget
+        self.ejection_ms = ejection_ms  # How long an ejected budget is skipped by routing
+        # Permits per input type this process may reserve and lend out locally; 0 disables
+        self.local_permits = local_permits
+        self.local_idle = local_idle_ms / 1000  # Seconds before unused local permits are given back
+        self.blocks = {}  # {input_type: LocalPermits}
         self.redis_client = None
-        self.reset_task = None
+        self.scripts = {}
 
     async def initialize(self):
-        """Initialize the Redis connection and reset semaphores."""
+        """Initialize the Redis connection."""
+        # Semaphore state is never reset here: other API and worker processes
+        # may be holding leases, and expired ones are reaped by the scripts.
         if self.redis_client is None:
             self.redis_client = await redis.from_url(self.redis_url, decode_responses=True)
-            await self.reset_semaphores()
-            # Optionally, start the periodic reset task.
-            # self.reset_task = asyncio.create_task(self._reset_periodically())
+            self.scripts = {
+                name: self.redis_client.register_script(script)
+                for name, script in (
+                    ("acquire", self.ACQUIRE_LUA), ("extend", self.EXTEND_LUA), ("estimate", self.ESTIMATE_LUA),
+                    ("available", self.AVAILABLE_LUA), ("poll", self.POLL_LUA),
+                    ("cancel", self.CANCEL_LUA), ("release", self.RELEASE_LUA),
+                    ("reserve", self.RESERVE_LUA), ("sync_block", self.SYNC_BLOCK_LUA),
+                )
+            }
 
-    async def acquire_semaphore(self, input_type):
-        """Acquire a semaphore for the given input type using an atomic Lua script."""
-        if self.redis_client is None:
-            await self.initialize()
-            
-        start_time = time.time()
-
-        # Lua script to atomically check the value and decrement if available.
-        lua_script = """
-        local current = tonumber(redis.call('GET', KEYS[1]))
-        if current and current > 0 then
-            return redis.call('DECR', KEYS[1])
-        else
-            return -1
-        end
-        """
+    def _holders_key(self, input_type):
+        return f"{self.KEY_PREFIX}{input_type}:holders"
 
-        while time.time() - start_time < self.timeout:
-            result = await self.redis_client.eval(lua_script, 1, input_type)
-            if result != -1:
-                logger.info(f"Acquired semaphore for '{input_type}'. New value: {result}")
-                return  # Acquired successfully
-            # Wait briefly before retrying
-            await asyncio.sleep(1)
-        
-        raise TimeoutError(f"Could not acquire semaphore for '{input_type}' within {self.timeout} seconds")
-
-    async def release_semaphore(self, input_type):
-        """Release the Redis semaphore by incrementing the counter only if it is below the max limit."""
-        if self.redis_client is None:
-            await self.initialize()
-            
+    def _waiters_key(self, input_type):
+        return f"{self.KEY_PREFIX}{input_type}:waiters"
+
+    def _limit_key(self, input_type):
+        return f"{self.KEY_PREFIX}{input_type}:limit"
+
+    def _service_key(self, input_type):
+        return f"{self.KEY_PREFIX}{input_type}:service"
+
+    def _wake_key(self, token):
+        return f"{self.KEY_PREFIX}wake:{token}"
+
+    def _marker_key(self, token):
+        return f"{self.KEY_PREFIX}waiter:{token}"
+
+    def _bucket_key(self, budget, kind):
+        return f"{self.BUCKET_PREFIX}{budget}:{kind}"
+
+    def _budget_key(self, budget, kind):
+        return f"{self.KEY_PREFIX}budget:{budget}:{kind}"
+
+    def _quota(self, budget, kind):
+        return int(self.quotas.get(budget, {}).get(kind) or 0)
+
+    @staticmethod
+    def _budget_names(budget):
+        return [budget] if isinstance(budget, str) else list(budget or [])
+
+    def _candidates(self, budget):
+        """JSON list of the budgets a request may be routed to, as read by route()."""
+        return json.dumps([
+            {
+                "name": name,
+                "holders": self._budget_key(name, "holders"),
+                "ejected": self._budget_key(name, "ejected"),
+                "rpm_key": self._bucket_key(name, "rpm"),
+                "rpm": self._quota(name, "rpm"),
+                "tpm_key": self._bucket_key(name, "tpm"),
+                "tpm": self._quota(name, "tpm"),
+                "limit": self._quota(name, "concurrency"),
+            }
+            for name in self._budget_names(budget)
+        ])
+
+    def _limit(self, input_type):
         max_limit = self.rate_limits.get(input_type)
         if max_limit is None:
             # Optionally, handle the case where input_type is not defined.
             max_limit = 1  # Fallback maximum
-        
-        lua_script = """
-        local current = tonumber(redis.call('GET', KEYS[1]))
-        local max = tonumber(ARGV[1])
-        if current and current < max then
-            return redis.call('INCR', KEYS[1])
-        else
-            return current or 0
-        end
+        return max_limit
+
+    @property
+    def adaptive(self):
+        return self.limit_bounds is not None
+
+    def _bounds(self, input_type):
+        """Floor and ceiling of an input type's adaptive limit."""
+        bounds = self.limit_bounds.get(input_type, {})
+        floor = max(1, int(bounds.get("min", 1)))
+        return floor, max(floor, int(bounds.get("max", self._limit(input_type))))
+
+    def max_limit(self, input_type):
+        """The most permits an input type can ever have: its ceiling when adaptive."""
+        if self.adaptive:
+            return self._bounds(input_type)[1]
+        return self._limit(input_type)
+
+    async def current_limits(self):
+        """Capacity of every input type's semaphore right now, as shared in Redis."""
+        if self.redis_client is None:
+            await self.initialize()
+
+        limits = dict(self.rate_limits)
+        if self.adaptive:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for input_type in self.rate_limits:
+                    pipe.hget(self._limit_key(input_type), "limit")
+                adapted = await pipe.execute()
+            for input_type, limit in zip(self.rate_limits, adapted):
+                if limit is not None:
+                    limits[input_type] = int(float(limit))
+        return limits
+
+    async def permits_in_use(self):
+        """Leases held right now per input type, by every process sharing this Redis."""
+        if self.redis_client is None:
+            await self.initialize()
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for input_type in self.rate_limits:
+                pipe.zcard(self._holders_key(input_type))
+            held = await pipe.execute()
+        return dict(zip(self.rate_limits, held))
+
+    async def acquire_semaphore(self, input_type, tokens=0, budget=None, max_wait=None):
         """
-        new_value = await self.redis_client.eval(lua_script, 1, input_type, max_limit)
-        logger.info(f"Released semaphore for '{input_type}'. New value: {new_value}")
+        Acquire a lease on the semaphore for the given input type.
+
+        The concurrency check and the RPM/TPM buckets of `budget` (usually the
+        model name) are evaluated in the same script, so a permit is only taken
+        when the upstream quota can also pay for it. Given several budgets (pool
+        members), the least-loaded healthy one that can pay is chosen and charged,
+        and one of its own permits is taken too; `Lease.budget` names it.
+
+        If the request cannot be admitted the caller joins a FIFO wait list in
+        Redis and blocks on its own wake key, which `release_semaphore` pushes to
+        as soon as a permit is handed over. This works across all API and worker
+        processes. While blocked on a rate budget the waiter re-checks when the
+        buckets are expected to have refilled.
+
+        With `local_permits`, calls no shared rate budget has to see (no budget,
+        or a single one without quotas) are first served from a block of
+        permits this process reserved, without a Redis round trip. The block
+        only grows while nobody is queued, and its free permits go back to the
+        pool once idle for `local_idle_ms` or when other processes queue.
+
+        With `max_wait`, the caller waits at most that long, and is turned away
+        at once if the estimated wait is already longer: the callers ahead of it
+        (holders past the limit and queued waiters) times the recent average
+        time a permit is held, over the limit. Rate budget waits count too.
+
+        Args:
+            input_type: Semaphore to take a permit from.
+            tokens: Estimated tokens the call will consume.
+            budget: Key into `quotas`, or a list of them to route between; None skips the rate check.
+            max_wait: Seconds the caller can wait, at most `timeout`; None waits `timeout` without estimating.
+
+        Returns:
+            Lease: pass it to `release_semaphore`. It is kept alive by a heartbeat
+            until released.
+
+        Raises:
+            SemaphoreTimeout: no permit in time, or (`shed`) none expected in time.
+        """
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with tracing.span("semaphore.acquire", input_type=input_type):
+                lease = await self._acquire(input_type, tokens, budget, max_wait=max_wait)
+            outcome = "granted"
+            return lease
+        except SemaphoreTimeout as e:
+            outcome = "shed" if e.shed else "timeout"
+            raise
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            metrics.latency("semaphore_acquire_wait", input_type=input_type).observe(time.perf_counter() - started)
+            metrics.counter("semaphore_acquire", input_type=input_type, outcome=outcome).inc()
+
+    async def try_acquire_semaphore(self, input_type, tokens=0, budget=None):
+        """
+        Take a permit only if one can be granted right now, without joining the
+        wait queue (e.g. for a hedged call). Returns a Lease, or None.
+        """
+        lease = await self._acquire(input_type, tokens, budget, wait=False)
+        outcome = "granted" if lease is not None else "unavailable"
+        metrics.counter("semaphore_try_acquire", input_type=input_type, outcome=outcome).inc()
+        return lease
+
+    async def _acquire(self, input_type, tokens, budget, wait=True, max_wait=None):
+        if self.redis_client is None:
+            await self.initialize()
+
+        if self._lendable(budget):
+            lease = await self._borrow(input_type, budget, tokens)
+            if lease is not None:
+                return lease
+
+        timeout = self.timeout if max_wait is None else max(0, min(self.timeout, max_wait))
+        deadline = time.monotonic() + timeout
+        lease_id = uuid.uuid4().hex
+        # Marker outlives the wait slightly so a late hand-off is still observable.
+        wait_ms = int(self.timeout * 1000) + 1000
+
+        status, value, granted, estimate = await self.scripts["acquire"](
+            keys=[
+                self._holders_key(input_type), self._waiters_key(input_type), self._marker_key(lease_id),
+                self._limit_key(input_type), self._service_key(input_type),
+            ],
+            args=[
+                self.KEY_PREFIX, lease_id, self._limit(input_type), int(self.lease_ttl * 1000), wait_ms,
+                self._candidates(budget), int(tokens), int(self.adaptive), int(wait),
+                -1 if max_wait is None else int(timeout * 1000),
+            ],
+        )
+        if status == 1:
+            logger.debug(f"Acquired semaphore for '{input_type}'. Remaining permits: {value}")
+            return self._start_lease(input_type, lease_id, granted, tokens)
+        if not wait:
+            return None
+        if status == 2:
+            raise SemaphoreTimeout(
+                f"Estimated wait for '{input_type}' of {estimate} ms exceeds {timeout} seconds",
+                jittered(estimate / 1000), shed=True
+            )
+
+        try:
+            retry_ms = value  # Non-zero while blocked on a rate budget rather than a permit
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait_for = min(remaining, retry_ms / 1000) if retry_ms else remaining
+                woken = await self.redis_client.blpop(self._wake_key(lease_id), timeout=max(wait_for, 0.01))
+                if woken:
+                    logger.debug(f"Acquired semaphore for '{input_type}' from wait queue")
+                    return self._start_lease(input_type, lease_id, woken[1], tokens)
+                if not retry_ms:
+                    break
+                # Buckets should have refilled: let the queue head try again.
+                granted, retry_ms = await self._poll_wait(input_type, lease_id)
+                if granted is not None:
+                    logger.debug(f"Acquired semaphore for '{input_type}' from wait queue")
+                    return self._start_lease(input_type, lease_id, granted, tokens)
+            # Timed out: leave the queue, unless a release handed us a permit meanwhile.
+            granted = await self._cancel_wait(input_type, lease_id, budget)
+            if granted is not None:
+                logger.debug(f"Acquired semaphore for '{input_type}' from wait queue")
+                return self._start_lease(input_type, lease_id, granted, tokens)
+        except asyncio.CancelledError:
+            # Never leak a permit that was handed to a waiter that went away.
+            granted = await asyncio.shield(self._cancel_wait(input_type, lease_id, budget))
+            if granted is not None:
+                lease = Lease(input_type, lease_id, granted or None, tokens)
+                lease.acquired_at = None
+                await asyncio.shield(self.release_semaphore(lease))
+            raise
+
+        estimate = await self.estimate_wait(input_type, tokens=tokens, budget=budget)
+        if retry_ms:
+            # Still blocked on a rate budget when the wait ran out
+            estimate = max(estimate or 0, retry_ms / 1000)
+        raise SemaphoreTimeout(
+            f"Could not acquire semaphore for '{input_type}' within {timeout} seconds", jittered(estimate)
+        )
+
+    def _start_lease(self, input_type, lease_id, budget, tokens):
+        # Grants without a budget carry an empty name
+        lease = Lease(input_type, lease_id, budget or None, tokens)
+        lease.heartbeat_task = asyncio.create_task(self._heartbeat(lease))
+        return lease
 
-    async def _reset_periodically(self):
-        """Async task that resets Redis rate limits at fixed intervals."""
+    def _lendable(self, budget):
+        """Whether a call can use local permits: only if no rate budget has to be charged or routed for it."""
+        budgets = self._budget_names(budget)
+        return self.local_permits > 0 and len(budgets) <= 1 and not any(
+            self._quota(name, kind) for name in budgets for kind in ("rpm", "tpm", "concurrency")
+        )
+
+    async def _borrow(self, input_type, budget, tokens):
+        """Lend a permit from this process's block, reserving more if it is empty. None if there are none to lend."""
+        block = self.blocks.get(input_type)
+        if block is None:
+            block = self.blocks[input_type] = LocalPermits(input_type)
+        wanted = self.local_permits - len(block.reserved) - block.reserving
+        if not block.free and wanted > 0:
+            block.reserving += wanted
+            try:
+                await self._reserve(block, wanted)
+            finally:
+                block.reserving -= wanted
+        # Leases that may have expired unextended (e.g. Redis was unreachable) are not lent out
+        if not block.free or time.monotonic() >= block.valid_until:
+            metrics.counter("local_permits", input_type=input_type, outcome="miss").inc()
+            return None
+        metrics.counter("local_permits", input_type=input_type, outcome="hit").inc()
+        block.last_used = time.monotonic()
+        # At most one budget, without quotas: it only names the pool member to call
+        name = next(iter(self._budget_names(budget)), None)
+        lease = Lease(input_type, block.free.pop(), name, tokens)
+        lease.block = block
+        return lease
+
+    async def _reserve(self, block, count):
+        input_type = block.input_type
+        started = time.monotonic()
+        ids = block.new_ids(count)
+        reserved = await self.scripts["reserve"](
+            keys=[self._holders_key(input_type), self._waiters_key(input_type), self._limit_key(input_type)],
+            args=[
+                self.KEY_PREFIX, self._limit(input_type), int(self.lease_ttl * 1000), json.dumps(ids),
+                int(self.adaptive),
+            ],
+        )
+        if not reserved:
+            return
+        if not block.reserved:
+            block.valid_until = started + self.lease_ttl
+        block.reserved.update(ids[:reserved])
+        block.free.extend(ids[:reserved])
+        logger.debug(f"Reserved {reserved} local permits for '{input_type}'")
+        if block.task is None:
+            block.task = asyncio.create_task(self._maintain(block))
+
+    def _give_back(self, lease):
+        """Return a lent permit to its block; its outcome is applied to the adaptive limit on the next sync."""
+        block, lease.block = lease.block, None
+        if self.adaptive:
+            if lease.overloaded:
+                block.overloaded = True
+            elif lease.latency is not None:
+                block.samples += 1
+                block.latency_sum += lease.latency
+        if lease.acquired_at is not None:
+            block.holds += 1
+            block.hold_sum += time.monotonic() - lease.acquired_at
+        # Permits the block lost while lent are dropped
+        if lease.lease_id in block.reserved:
+            block.free.append(lease.lease_id)
+        block.last_used = time.monotonic()
+
+    async def _maintain(self, block):
+        """Keep a block's leases alive and hand back its idle permits, until it holds none."""
+        interval = min(self.local_idle, self.lease_ttl / 3)
+        try:
+            while block.reserved:
+                await asyncio.sleep(interval)
+                try:
+                    await self._sync_block(block, idle=time.monotonic() - block.last_used >= self.local_idle)
+                except Exception as e:
+                    logger.error(f"Error syncing local permits for '{block.input_type}': {e}")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            block.task = None
+
+    async def _sync_block(self, block, idle):
+        input_type = block.input_type
+        started = time.monotonic()
+        # Free permits may be given back, so they are not lent out while the script runs
+        candidates, block.free = block.free, []
+        samples, latency_sum, overloaded = block.samples, block.latency_sum, block.overloaded
+        holds, hold_sum = block.holds, block.hold_sum
+        block.samples, block.latency_sum, block.overloaded = 0, 0.0, False
+        block.holds, block.hold_sum = 0, 0.0
+        floor, ceiling = self._bounds(input_type) if self.adaptive else (0, 0)
+        try:
+            returned, lost = await self.scripts["sync_block"](
+                keys=[
+                    self._holders_key(input_type), self._waiters_key(input_type), self._limit_key(input_type),
+                    self._service_key(input_type),
+                ],
+                args=[
+                    self.KEY_PREFIX, self._limit(input_type), int(self.lease_ttl * 1000), int(self.adaptive),
+                    json.dumps(sorted(block.reserved)), json.dumps(candidates), int(idle),
+                    samples, latency_sum * 1000 / samples if samples else -1, int(overloaded),
+                    floor, ceiling, self.backoff, self.latency_tolerance,
+                    holds, hold_sum * 1000 / holds if holds else -1,
+                ],
+            )
+        except BaseException:
+            block.free.extend(candidates)
+            raise
+        gone = set(returned) | set(lost)
+        block.reserved -= gone
+        block.free.extend(lease_id for lease_id in candidates if lease_id not in gone)
+        block.valid_until = started + self.lease_ttl
+        if lost:
+            logger.warning(f"{len(lost)} local permits for '{input_type}' expired before they were extended")
+        if returned:
+            logger.debug(f"Returned {len(returned)} local permits for '{input_type}'")
+
+    async def _heartbeat(self, lease):
+        """Keep a lease alive for long-running calls."""
+        interval = self.lease_ttl / 3
         try:
             while True:
-                await asyncio.sleep(60)  # Reset every 60 seconds
-                await self.reset_semaphores()
+                await asyncio.sleep(interval)
+                if not await self.extend_lease(lease):
+                    logger.warning(f"Lease {lease.lease_id} for '{lease.input_type}' expired before it was extended")
+                    return
         except asyncio.CancelledError:
-            # Handle task cancellation gracefully
             pass
         except Exception as e:
-            logger.error(f"Error in reset task: {e}")
-            await asyncio.sleep(5)
-            self.reset_task = asyncio.create_task(self._reset_periodically())
+            logger.error(f"Error extending lease {lease.lease_id}: {e}")
+
+    async def extend_lease(self, lease):
+        """Push the expiry of a held lease forward. Returns False if the lease was already reaped."""
+        extended = await self.scripts["extend"](
+            keys=[self._holders_key(lease.input_type), self._budget_key(lease.budget, "holders")],
+            args=[lease.lease_id, int(self.lease_ttl * 1000)],
+        )
+        return extended == 1
+
+    async def estimate_wait(self, input_type, ahead=0, tokens=0, budget=None):
+        """
+        Seconds a new caller would wait for a permit with `ahead` more callers
+        in front of it (e.g. queued requests), or None while no permit has been
+        held recently to estimate from. With a `budget`, at least until its RPM
+        and TPM buckets have refilled enough for a request of `tokens`.
+        """
+        if self.redis_client is None:
+            await self.initialize()
+
+        estimate = await self.scripts["estimate"](
+            keys=[
+                self._holders_key(input_type), self._waiters_key(input_type), self._limit_key(input_type),
+                self._service_key(input_type),
+            ],
+            args=[self._limit(input_type), int(self.adaptive), int(ahead), self._candidates(budget), int(tokens)],
+        )
+        return None if estimate < 0 else estimate / 1000
+
+    async def available_permits(self, input_type):
+        """Permits that could be granted right now, after reaping expired leases and serving queued waiters."""
+        if self.redis_client is None:
+            await self.initialize()
+
+        return await self.scripts["available"](
+            keys=[self._holders_key(input_type), self._waiters_key(input_type), self._limit_key(input_type)],
+            args=[self._limit(input_type), int(self.adaptive)],
+        )
+
+    async def _poll_wait(self, input_type, token):
+        """
+        Re-run dispatch for a waiter blocked on a rate budget. Returns (budget,
+        retry_ms), where budget is the granted budget's name ('' for none) or None.
+        """
+        status, retry_ms, granted = await self.scripts["poll"](
+            keys=[
+                self._holders_key(input_type), self._waiters_key(input_type), self._wake_key(token),
+                self._limit_key(input_type),
+            ],
+            args=[self.KEY_PREFIX, self._limit(input_type), int(self.lease_ttl * 1000), int(self.adaptive)],
+        )
+        return (granted if status == 1 else None), retry_ms
+
+    async def _cancel_wait(self, input_type, token, budget):
+        """
+        Remove a waiter from the queue. Returns the name of the budget it had
+        already been granted ('' for none), or None if it had no permit. A
+        permit counts as granted while the waiter is among the holders, even
+        if its hand-off was consumed by a wait that never returned.
+        """
+        status, granted = await self.scripts["cancel"](
+            keys=[
+                self._waiters_key(input_type), self._marker_key(token), self._wake_key(token),
+                self._holders_key(input_type),
+            ],
+            args=[token, self._candidates(budget)],
+        )
+        return granted if status == 1 else None
+
+    @staticmethod
+    def _hold_ms(lease):
+        """How long the lease was held, for the wait estimate; -1 if it never served a call."""
+        if lease.acquired_at is None:
+            return -1
+        return (time.monotonic() - lease.acquired_at) * 1000
+
+    async def release_semaphore(self, lease):
+        """
+        Release a lease. The TPM bucket is corrected by the difference between
+        the estimated and the recorded token usage (an unused lease also gets
+        its request back in the RPM bucket), and with adaptive limits the
+        recorded latency or overload adjusts the input type's limit. A recorded
+        failure counts toward ejecting the lease's budget; a success resets the
+        count. Then the permit goes straight to the oldest live waiter if there
+        is one, otherwise it returns to the pool. A freed budget permit may be
+        what waiters of other input types need, so their queues are served too.
+        """
+        if self.redis_client is None:
+            await self.initialize()
+
+        if lease.heartbeat_task:
+            lease.heartbeat_task.cancel()
+            lease.heartbeat_task = None
+
+        refund = 0
+        if lease.used_tokens is not None:
+            refund = int(lease.tokens) - int(lease.used_tokens)
+
+        input_type = lease.input_type
+        if lease.overloaded:
+            metrics.counter("upstream_overload", input_type=input_type).inc()
+        if lease.block is not None:
+            self._give_back(lease)
+            return
+        # Leases without a recorded outcome (e.g. failed for other reasons) leave the limit alone
+        latency_ms = -1 if lease.latency is None else lease.latency * 1000
+        floor, ceiling = self._bounds(input_type) if self.adaptive else (0, 0)
+        others = []
+        if self._quota(lease.budget, "concurrency"):
+            others = [
+                {"holders": self._holders_key(other), "waiters": self._waiters_key(other),
+                 "limit_key": self._limit_key(other), "limit": self._limit(other)}
+                for other in self.rate_limits if other != input_type
+            ]
+
+        budget = lease.budget
+        available, limit, ejected = await self.scripts["release"](
+            keys=[
+                self._holders_key(input_type), self._waiters_key(input_type), self._bucket_key(budget, "tpm"),
+                self._limit_key(input_type), self._budget_key(budget, "holders"),
+                self._budget_key(budget, "failures"), self._budget_key(budget, "ejected"),
+                self._service_key(input_type), self._bucket_key(budget, "rpm"),
+            ],
+            args=[
+                self.KEY_PREFIX, lease.lease_id, self._limit(input_type), int(self.lease_ttl * 1000),
+                self._quota(budget, "tpm"), refund, int(self.adaptive), latency_ms, int(lease.overloaded),
+                floor, ceiling, self.backoff, self.latency_tolerance,
+                int(lease.failed and budget is not None), self.failure_threshold, self.ejection_ms,
+                json.dumps(others), self._hold_ms(lease), int(lease.unused), self._quota(budget, "rpm"),
+            ],
+        )
+        logger.debug(f"Released semaphore for '{input_type}'. Remaining permits: {available} of {limit}")
+        if ejected:
+            metrics.counter("budget_ejections", budget=budget).inc()
+            logger.warning(
+                f"Ejected '{budget}' for {self.ejection_ms} ms after {self.failure_threshold} consecutive failures"
+            )
 
     async def reset_semaphores(self):
-        """Reset all rate limits in Redis according to predefined values."""
+        """Drop all leases, waiters, adapted limits and ejections. Only for maintenance; never run while requests are in flight."""
         if self.redis_client is None:
             await self.initialize()
-            
+
         # Use pipeline for atomic updates
         async with self.redis_client.pipeline() as pipe:
-            for input_type, limit in self.rate_limits.items():
-                pipe.set(input_type, limit)
+            for input_type in self.rate_limits:
+                pipe.delete(
+                    self._holders_key(input_type), self._waiters_key(input_type), self._limit_key(input_type)
+                )
+            for budget in self.quotas:
+                pipe.delete(
+                    self._budget_key(budget, "holders"), self._budget_key(budget, "failures"),
+                    self._budget_key(budget, "ejected")
+                )
             await pipe.execute()
 
     async def cleanup(self):
         """Cleanup resources when shutting down."""
-        if self.reset_task:
-            self.reset_task.cancel()
-            try:
-                await self.reset_task
-            except asyncio.CancelledError:
-                pass
-        
+        for block in self.blocks.values():
+            if block.task:
+                block.task.cancel()
+            if block.free:
+                try:
+                    await self._sync_block(block, idle=True)
+                except Exception as e:
+                    logger.error(f"Error returning local permits for '{block.input_type}': {e}")
+        self.blocks = {}
         if self.redis_client:
             await self.redis_client.close()
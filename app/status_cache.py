@@ -0,0 +1,127 @@
+import asyncio
+import json
+import redis.asyncio as redis
+from app.utils import custom_logging
+from app import metrics
+
+logger = custom_logging(__name__)
+
+FINAL_STATUSES = ("completed", "failed")
+
+
+class StatusCache:
+    """
+    Recent request states in Redis, so status polls rarely reach Postgres.
+
+    The API writes a request's state on submit and the worker when it finishes;
+    each entry expires after `ttl` seconds. Final states are also published on
+    `status:done:{id}`. One pattern subscription per process fans those
+    notifications out to local waiters, so any number of long-polling or SSE
+    clients share a single Redis connection.
+    """
+
+    KEY_PREFIX = "status:"
+    CHANNEL_PREFIX = "status:done:"
+
+    def __init__(self, redis_url, ttl, max_response_bytes):
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.max_response_bytes = max_response_bytes  # Larger responses are left to the database
+        self.redis_client = None
+        self._waiters = {}  # request_id -> set of futures
+        self._listener = None
+
+    async def initialize(self):
+        """Initialize the Redis connection."""
+        if self.redis_client is None:
+            self.redis_client = await redis.from_url(self.redis_url, decode_responses=True)
+
+    def _key(self, request_id):
+        return f"{self.KEY_PREFIX}{request_id}"
+
+    async def get(self, request_id):
+        """Cached state of a request, or None."""
+        cached = await self.redis_client.get(self._key(request_id))
+        if cached is None:
+            metrics.counter("status_cache_misses").inc()
+            return None
+        metrics.counter("status_cache_hits").inc()
+        return json.loads(cached)
+
+    async def set(self, record):
+        """Cache a request's state (as RequestLogger reports it); announce it if final."""
+        request_id = record["request_id"]
+        response = record.get("response")
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            if response is None or len(response.encode("utf-8")) <= self.max_response_bytes:
+                pipe.set(self._key(request_id), json.dumps(record, default=str), ex=self.ttl)
+            else:
+                # Do not leave an older, non-final state behind for the next poll
+                pipe.delete(self._key(request_id))
+            if record["status"] in FINAL_STATUSES:
+                pipe.publish(f"{self.CHANNEL_PREFIX}{request_id}", record["status"])
+            await pipe.execute()
+
+    async def wait(self, request_id, timeout, lookup):
+        """
+        Return the request's state as soon as it is final, or its latest state
+        after `timeout` seconds. `lookup(request_id)` reads it on a cache miss.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._ensure_listener()
+        future = loop.create_future()
+        self._waiters.setdefault(request_id, set()).add(future)
+        try:
+            while True:
+                # Checked after registering, so a completion published in between is not missed
+                record = await self.get(request_id) or await lookup(request_id)
+                remaining = deadline - loop.time()
+                if record is None or record["status"] in FINAL_STATUSES or remaining <= 0:
+                    return record
+                # Re-check periodically in case a notification was lost while the listener reconnected
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), min(remaining, 5))
+                except asyncio.TimeoutError:
+                    continue
+                future = loop.create_future()
+                self._waiters.setdefault(request_id, set()).add(future)
+        finally:
+            waiters = self._waiters.get(request_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[request_id]
+
+    def _ensure_listener(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        """Wake local waiters for every final state published by any process."""
+        while True:
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{self.CHANNEL_PREFIX}*")
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    request_id = message["channel"][len(self.CHANNEL_PREFIX):]
+                    for future in self._waiters.pop(request_id, ()):
+                        if not future.done():
+                            future.set_result(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Status notification listener failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def cleanup(self):
+        """Cleanup resources when shutting down."""
+        if self._listener:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+        if self.redis_client:
+            await self.redis_client.close()
@@ -0,0 +1,88 @@
+import os
+from contextlib import nullcontext
+from app.config import Config
+from app.utils import custom_logging
+
+logger = custom_logging(__name__)
+
+# Optional OpenTelemetry tracing (TRACING_ENABLED=true, with opentelemetry-sdk and
+# opentelemetry-exporter-otlp installed). A request's spans form one trace from
+# /submit through the queue to the worker: the trace context travels in the
+# queued envelope. While tracing is off every helper here is a no-op, and the
+# opentelemetry packages are never imported.
+
+_tracer = None
+
+
+def configure(service_name):
+    """Export spans over OTLP (OTEL_EXPORTER_OTLP_ENDPOINT) from this process. Safe to call again."""
+    global _tracer
+    if not Config.TRACING_ENABLED or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("TRACING_ENABLED is set but opentelemetry-sdk/opentelemetry-exporter-otlp are not installed")
+        return
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", service_name)})
+    )
+    # Spans are exported in batches from a background thread, never on the event loop
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("llm-rate-limiter")
+
+
+def instrument_app(app):
+    """Server spans for every API request, parents of the spans below (needs opentelemetry-instrumentation-fastapi)."""
+    if not Config.TRACING_ENABLED:
+        return
+    try:
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    except ImportError:
+        logger.warning("opentelemetry-instrumentation-fastapi is not installed; API spans start at the semaphore")
+        return
+    FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics,health")
+
+
+def span(name, parent=None, **attributes):
+    """
+    Context manager for a span in the current trace, or under `parent` (a
+    carrier from inject(), e.g. read from a queued envelope).
+    """
+    if _tracer is None:
+        return nullcontext()
+    context = None
+    if parent:
+        from opentelemetry import propagate
+
+        context = propagate.extract(parent)
+    attributes = {key: value for key, value in attributes.items() if value is not None}
+    return _tracer.start_as_current_span(name, context=context, attributes=attributes)
+
+
+def inject():
+    """The current trace context as a dict that can travel with a queued request; {} while tracing is off."""
+    if _tracer is None:
+        return {}
+    from opentelemetry import propagate
+
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier
+
+
+def shutdown():
+    """Export the spans still buffered."""
+    global _tracer
+    if _tracer is None:
+        return
+    from opentelemetry import trace
+
+    trace.get_tracer_provider().shutdown()
+    _tracer = None
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds its size limit."""
+
+
+def map_file(path):
+    """Read-only memoryview over a file's bytes; pages are loaded only when touched."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+async def spool_upload(upload, mime_type, max_bytes, chunk_size, directory=None):
+    """
+    Copy an UploadFile to a private temp file in `chunk_size` pieces, hashing as
+    it goes and failing as soon as it grows past `max_bytes`.
+
+    Returns a file entry whose "data" is a memory map of the spooled file, so the
+    upload is never held in memory as a whole. Release it with release_uploads().
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(prefix="upload-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"File {upload.filename} is larger than {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        data = map_file(path)
+    except BaseException:
+        os.unlink(path)
+        raise
+
+    return {
+        "filename": upload.filename,
+        "type": mime_type,
+        "size": size,
+        "sha256": digest.hexdigest(),
+        "path": path,
+        "data": data,
+    }
+
+
+def release_uploads(input_data):
+    """Unmap and delete the temp files behind spooled file entries."""
+    for file in input_data.get("files") or []:
+        path = file.pop("path", None)
+        if path is None:
+            continue
+        data = file.pop("data", None)
+        if isinstance(data, memoryview):
+            mapped = data.obj
+            data.release()
+            if isinstance(mapped, mmap.mmap):
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Still exported elsewhere; the mapping is freed with its last view
+                    pass
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject request bodies larger than `max_bytes` with 413 before they are parsed.
+
+    A Content-Length over the limit is refused without reading the body; chunked
+    bodies are counted as they are received and cut off once they pass it.
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await self._reject(send)
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise UploadTooLarge(f"Request body is larger than {self.max_bytes} bytes")
+            return message
+
+        async def limited_send(message):
+            nonlocal response_started
+            if exceeded:
+                # The framework turns the aborted body into its own error; answer 413 instead
+                if message["type"] == "http.response.start" and not response_started:
+                    response_started = True
+                    await self._reject(send)
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except UploadTooLarge:
+            if response_started:
+                raise
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"Request body is larger than {self.max_bytes} bytes"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
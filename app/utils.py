@@ -1,16 +1,32 @@
-
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
+# Every logger only puts records on this queue; one listener thread formats
+# them and writes to stdout, so logging never blocks the event loop on I/O.
+_log_queue = queue.SimpleQueue()
+_listener = None
+
+def _queue_handler() -> logging.Handler:
+    global _listener
+    if _listener is None:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        stream_handler.setFormatter(formatter)
+        _listener = logging.handlers.QueueListener(_log_queue, stream_handler)
+        _listener.start()
+        # Write out queued records on exit
+        atexit.register(_listener.stop)
+    return logging.handlers.QueueHandler(_log_queue)
+
 def custom_logging(name: str = __name__) -> logging.Logger:
     logger = logging.getLogger(name)
     # Only add handlers if they haven't been added already.
     if not logger.handlers:
         logger.setLevel(logging.INFO)
-        stream_handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
+        logger.addHandler(_queue_handler())
         # Prevent log propagation to avoid duplicate logs from the root logger.
         logger.propagate = False
     return logger
@@ -4,159 +4,460 @@ import asyncio
 import time
 import random
 import json
+from datetime import datetime
 from app.config import Config
-from app.llm_processor import GeminiProcessor
+from app.llm_processor import create_llm_pool, estimate_tokens, member_quotas, pool_members
+from app.models import migrate
 from app.semaphore_manager import SemaphoreManager
+from app.resilience import CircuitBreaker, CircuitOpenError, ResilientProcessor, RetryBudget
+from app.batcher import PromptBatcher
+from app.response_cache import ResponseCache
+from app.request_queue import RequestQueue
+from app.request_logger import RequestLogger, RequestLogRejected
+from app.blob_store import create_blob_store, resolve_files
+from app.status_cache import StatusCache
+from app.scheduler import FairScheduler
+from app import metrics, tracing
 from app.utils import custom_logging
 
 class AsyncWorker:
+    CLAIM_INTERVAL = 30  # Seconds between checks for stale pending entries
+    FLOW_REFRESH_MS = 1000  # Longest an idle worker waits before looking for new flows
+
     def __init__(self):
         self.db_pool = None
+        self.request_logger = None
         self.redis_client = None
-        self.gemini_processor = GeminiProcessor(Config.GEMINI_API_KEY)
+        self.gemini_processor = None
         self.logger = custom_logging()
         self.semaphore_manager = None
+        self.circuit_breaker = None
+        self.prompt_batcher = None
+        self.response_cache = None
+        self.blob_store = None
+        self.request_queue = None
+        self.status_cache = None
+        self.stopping = asyncio.Event()
         
     async def initialize(self):
         """Initialize database and Redis connections"""
+        started = time.perf_counter()
+        tracing.configure("llm-rate-limiter-worker")
         self.db_pool = await asyncpg.create_pool(Config.DATABASE_URL)
+        if Config.RUN_MIGRATIONS:
+            async with self.db_pool.acquire() as conn:
+                await migrate(conn)
+        members = pool_members()
+        self.request_logger = RequestLogger(self.db_pool)
+        self.request_logger.start()
         self.redis_client = await redis.from_url(Config.REDIS_URL, decode_responses=True)
-        self.semaphore_manager = SemaphoreManager(Config.REDIS_URL, Config.RATE_LIMITS, 10)  # Longer timeout for worker
+        self.blob_store = create_blob_store(
+            Config.BLOB_STORE, Config.REDIS_URL, Config.BLOB_TTL, Config.BLOB_STORE_PATH
+        )
+        await self.blob_store.initialize()
+        self.request_queue = RequestQueue(
+            Config.REDIS_URL, self.blob_store, Config.QUEUE_CONSUMER_GROUP,
+            claim_idle_ms=Config.QUEUE_CLAIM_IDLE_MS
+        )
+        await self.request_queue.initialize()
+        self.status_cache = StatusCache(
+            Config.REDIS_URL, Config.STATUS_CACHE_TTL, Config.STATUS_CACHE_MAX_RESPONSE_BYTES
+        )
+        await self.status_cache.initialize()
+        self.semaphore_manager = SemaphoreManager(
+            Config.REDIS_URL, Config.RATE_LIMITS, 10, Config.SEMAPHORE_LEASE_TTL, member_quotas(members),
+            Config.CONCURRENCY_LIMIT_BOUNDS if Config.ADAPTIVE_CONCURRENCY else None,
+            Config.ADAPTIVE_BACKOFF, Config.ADAPTIVE_LATENCY_TOLERANCE,
+            Config.MEMBER_FAILURE_THRESHOLD, Config.MEMBER_EJECTION_MS,
+            Config.LOCAL_PERMIT_BLOCK, Config.LOCAL_PERMIT_IDLE_MS
+        )  # Longer timeout for worker
         await self.semaphore_manager.initialize()
+        if Config.CIRCUIT_BREAKER_ENABLED:
+            self.circuit_breaker = CircuitBreaker(
+                Config.REDIS_URL, Config.CIRCUIT_FAILURE_THRESHOLD, Config.CIRCUIT_OPEN_MS,
+                Config.CIRCUIT_HALF_OPEN_PROBES
+            )
+            await self.circuit_breaker.initialize()
+        self.gemini_processor = ResilientProcessor(
+            create_llm_pool(members), self.semaphore_manager, self.circuit_breaker,
+            RetryBudget(Config.RETRY_BUDGET_RATIO, Config.RETRY_BUDGET_MIN_PER_SECOND),
+            Config.UPSTREAM_MAX_RETRIES, Config.RETRY_BASE_DELAY_MS / 1000,
+            Config.HEDGE_INPUT_TYPES, Config.HEDGE_PERCENTILE, Config.HEDGE_MIN_DELAY_MS / 1000,
+        )
+        if Config.PROMPT_BATCHING_ENABLED:
+            self.prompt_batcher = PromptBatcher(
+                self.gemini_processor, self.semaphore_manager, Config.BATCH_MAX_ITEMS,
+                Config.BATCH_MAX_WAIT_MS / 1000, Config.BATCH_MAX_PROMPT_CHARS
+            )
+        if Config.RESPONSE_CACHE_ENABLED:
+            self.response_cache = ResponseCache(
+                Config.REDIS_URL, Config.RESPONSE_CACHE_TTLS,
+                Config.RESPONSE_CACHE_MAX_BYTES, Config.RESPONSE_CACHE_MAX_ITEM_BYTES
+            )
+            await self.response_cache.initialize()
+        self.logger.info(f"Worker startup finished in {(time.perf_counter() - started) * 1000:.1f} ms")
         
-    async def process_request(self, req_id, input_type, input_data):
+    async def process_request(self, req_id, input_type, input_data, created_at=None):
         """Process a single request using the semaphore manager"""
         self.logger.info(f"Processing queued request {req_id} of type {input_type}")
-        # time.sleep(10)
+        started = time.perf_counter()
+        status = "completed"
         try:
-            # Try to acquire the semaphore with exponential backoff
-            max_attempts = 5
-            for attempt in range(max_attempts):
-                try:
-                    # Attempt to acquire the semaphore
-                    await self.semaphore_manager.acquire_semaphore(input_type)
-                    
-                    # If we get here, we've acquired the semaphore
-                    self.logger.info(f"Acquired semaphore for request {req_id} on attempt {attempt+1}")
-                    
-                    # Process the request
-                    response = await self.gemini_processor.process_llm_request(input_data)
-                    
-                    # Update the request status in the database
-                    await self.update_request_status(req_id, "completed", response)
-                    
-                    self.logger.info(f"Successfully processed request {req_id}")
-                    
-                    # Release the semaphore
-                    await self.semaphore_manager.release_semaphore(input_type)
-                    return
-                    
-                except TimeoutError:
-                    # If we couldn't acquire the semaphore, back off and retry
-                    backoff_time = min(2 ** attempt + random.uniform(0, 1), 60)
-                    self.logger.info(f"Failed to acquire semaphore on attempt {attempt+1}, backing off for {backoff_time:.2f} seconds")
-                    await asyncio.sleep(backoff_time)
-            
+            if self.response_cache:
+                # Identical requests share one upstream call and skip the semaphore on a hit
+                response = await self.response_cache.get_or_compute(
+                    input_type, self.gemini_processor.model, input_data,
+                    lambda: self.call_llm(req_id, input_type, input_data)
+                )
+            else:
+                response = await self.call_llm(req_id, input_type, input_data)
+
+            # Update the request status in the database
+            await self.update_request_status(req_id, input_type, input_data, created_at, "completed", response)
+            self.logger.info(f"Successfully processed request {req_id}")
+
+        except CircuitOpenError as e:
+            # A TimeoutError too, but the model was down rather than the permits busy
+            status = "circuit_open"
+            self.logger.error(f"Gave up on request {req_id}: {e}")
+            await self.update_request_status(req_id, input_type, input_data, created_at, "failed", error=str(e))
+
+        except TimeoutError:
             # If we've exhausted all attempts, log an error and update the request status
-            self.logger.error(f"Failed to acquire semaphore for request {req_id} after {max_attempts} attempts")
+            status = "timeout"
+            self.logger.error(f"Failed to acquire semaphore for request {req_id}")
             await self.update_request_status(
                 req_id,
+                input_type,
+                input_data,
+                created_at,
                 "failed",
-                {"error": "Failed to acquire resources after multiple attempts"}
+                error="Failed to acquire resources after multiple attempts"
             )
-            
+
         except Exception as e:
+            status = "failed"
             self.logger.error(f"Error processing request {req_id}: {str(e)}")
             # Update with error status
             await self.update_request_status(
                 req_id,
+                input_type,
+                input_data,
+                created_at,
                 "failed",
-                {"error": str(e)}
+                error=str(e)
             )
-            
-            # Make sure to release the semaphore if we acquired it
+
+        finally:
+            metrics.latency("worker_process", input_type=input_type).observe(time.perf_counter() - started)
+            metrics.counter("worker_requests", input_type=input_type, status=status).inc()
+
+    async def call_llm(self, req_id, input_type, input_data):
+        """
+        Acquire a permit with exponential backoff, then call the LLM. Raises
+        TimeoutError if no permit is granted. While the model's circuit is open
+        the request waits for it to half-open instead of failing, for up to
+        WORKER_CIRCUIT_MAX_WAIT seconds in all. Queued work is never shed: when
+        the semaphore turns it away up front it waits the estimated time, and
+        that does not count as an attempt.
+        """
+        max_attempts = 5
+        batched = self.prompt_batcher is not None and self.prompt_batcher.accepts(input_type, input_data)
+        attempt = 0
+        circuit_give_up_at = time.monotonic() + Config.WORKER_CIRCUIT_MAX_WAIT
+        while attempt < max_attempts:
             try:
-                await self.semaphore_manager.release_semaphore(input_type)
-            except:
-                pass
+                if batched:
+                    # Short prompts share a permit and an upstream call with other entries dispatched now
+                    return await self.prompt_batcher.process(input_data)
+                # Attempt to acquire the semaphore; without max_wait the wait is never shed
+                lease = await self.semaphore_manager.acquire_semaphore(
+                    input_type, tokens=estimate_tokens(input_data), budget=self.gemini_processor.budgets,
+                    max_wait=None
+                )
+            except CircuitOpenError as e:
+                await self.wait_for_circuit(req_id, e, circuit_give_up_at)
+                continue
+            except TimeoutError as e:
+                retry_after = getattr(e, "retry_after", None)
+                if getattr(e, "shed", False) and retry_after is not None:
+                    # Turned away before waiting: the permits or rate budget are behind, not broken
+                    self.logger.info(f"Request {req_id} shed by the semaphore, retrying in {retry_after:.2f} seconds")
+                    await asyncio.sleep(retry_after)
+                    continue
+                # If we couldn't acquire the semaphore, back off and retry, no sooner than a permit is expected
+                backoff_time = min(max(2 ** attempt + random.uniform(0, 1), retry_after or 0), 60)
+                attempt += 1
+                self.logger.info(f"Failed to acquire semaphore on attempt {attempt}, backing off for {backoff_time:.2f} seconds")
+                await asyncio.sleep(backoff_time)
+                continue
 
-    async def update_request_status(self, req_id, status, response_data):
-        """Update request status and response in the database"""
-        async with self.db_pool.acquire() as conn:
-            await conn.execute(
-                """
-                UPDATE requests 
-                SET status=$1, response=$2, updated_at=NOW() 
-                WHERE id=$3
-                """,
-                status, str(response_data), req_id
-            )
+            # If we get here, we've acquired the semaphore
+            self.logger.info(f"Acquired semaphore for request {req_id} on attempt {attempt+1}")
+            try:
+                # File bytes are only loaded once the request is about to be sent
+                request_input = await resolve_files(input_data, self.blob_store)
+                return await self.gemini_processor.process_llm_request(request_input, lease)
+            except CircuitOpenError as e:
+                circuit_open = e
+            finally:
+                # Release the semaphore
+                await self.semaphore_manager.release_semaphore(lease)
+            # Waits without the permit
+            await self.wait_for_circuit(req_id, circuit_open, circuit_give_up_at)
+
+        raise TimeoutError(f"Could not acquire semaphore for request {req_id} after {max_attempts} attempts")
+
+    async def wait_for_circuit(self, req_id, error, give_up_at):
+        """
+        Sleep until the open circuit lets probes through, spread out so waiting
+        requests do not retry at once. Re-raises `error` if that is past `give_up_at`.
+        """
+        delay = error.retry_after + random.uniform(0, 1)
+        if time.monotonic() + delay > give_up_at:
+            self.logger.warning(f"Request {req_id} gave up waiting for the circuit of '{error.model}'")
+            raise error
+        self.logger.info(f"Request {req_id} waits {delay:.1f} s for the circuit of '{error.model}' to half-open")
+        await asyncio.sleep(delay)
+
+    async def update_request_status(self, req_id, input_type, input_data, created_at, status, response_data=None, error=None):
+        """Write the request's new status and response, then notify clients waiting on it"""
+        # Batched with other in-flight requests' writes
+        record = await self.request_logger.save_request(
+            req_id, input_type, input_data, response_data, status,
+            wait=True, created_at=created_at, error=error
+        )
+        try:
+            await self.status_cache.set(record)
+        except Exception as e:
+            # The database has the result; pollers fall back to it when the cache entry expires
+            self.logger.warning(f"Could not update cached status of request {req_id}: {str(e)}")
+
+    async def process_entry(self, input_type, stream_key, entry_id, envelope):
+        """Process one stream entry and acknowledge it once its result is stored"""
+        try:
+            req_id = envelope.get("id")
+            # Files are blob references (or inline bytes for legacy entries) resolved in call_llm
+            input_data = {"text": envelope.get("text"), "files": envelope.get("files") or []}
+            # The submit time keys the request's row; entries from older API processes lack it
+            created_at = envelope.get("created_at")
+            created_at = datetime.fromisoformat(created_at) if created_at else None
+
+            # Process the request, in the trace of the submit that queued it
+            with tracing.span(
+                "worker.process", parent=envelope.get("trace"), request_id=req_id, input_type=input_type,
+                tenant=envelope.get("tenant"), priority=envelope.get("priority"),
+            ):
+                try:
+                    await self.process_request(req_id, input_type, input_data, created_at)
+                except RequestLogRejected as e:
+                    # Redelivering would only call the LLM again for a row that can never be stored
+                    self.logger.error(f"Status of request {req_id} could not be stored; acknowledging anyway: {e}")
+
+            # Only acknowledge after the database update, so a crash redelivers the entry
+            await self.request_queue.ack(stream_key, entry_id, envelope.get("files") or [])
+
+        except Exception as e:
+            self.logger.error(f"Error processing queued request {entry_id}: {str(e)}")
+
+    def flow_weight(self, stream_key):
+        """A flow's share of the worker: its priority class's weight times its tenant's weight"""
+        priority, tenant = self.request_queue.parse_flow(stream_key)
+        return Config.PRIORITY_WEIGHTS.get(priority, 1) * Config.TENANT_WEIGHTS.get(tenant, 1)
+
+    def dispatch(self, input_type, stream_key, entry_id, envelope, in_flight):
+        """Start processing an entry the scheduler picked, recording how long it waited in the queue"""
+        priority, tenant = self.request_queue.parse_flow(stream_key)
+        enqueued_at = envelope.get("enqueued_at")
+        if enqueued_at:
+            waited = max(0.0, time.time() - enqueued_at / 1000)
+            metrics.latency("queue_wait_by_tenant", input_type=input_type, tenant=tenant).observe(waited)
+            metrics.latency("queue_wait_by_priority", input_type=input_type, priority=priority).observe(waited)
+        task = asyncio.create_task(self.process_entry(input_type, stream_key, entry_id, envelope))
+        in_flight[task] = (stream_key, entry_id)
+        task.add_done_callback(lambda task: in_flight.pop(task, None))
 
     async def process_queue(self, input_type):
-        """Process all requests in a queue"""
-        queue_key = f"queue:{input_type}"
-        
-        # Get the queue length
-        queue_length = await self.redis_client.llen(queue_key)
-        if queue_length > 0:
-            self.logger.info(f"Found {queue_length} requests in {input_type} queue")
-        
-        # Process each request in the queue
-        while True:
-            # Pop a request from the queue (non-blocking)
-            request_json = await self.redis_client.lpop(queue_key)
-            if not request_json:
+        """
+        Consume an input type's flows until the worker is stopped.
+
+        Each flow (one per tenant and priority class) has at most one entry read
+        ahead, and a FairScheduler decides which flow's head runs next, so a
+        backlogged tenant cannot starve the others. Runs up to the input type's
+        largest possible limit concurrently and only dispatches as many entries
+        as there are permits free right now, so it follows the adaptive limit. On stop, in-flight requests
+        are drained; read-ahead entries stay pending and are claimed by another worker.
+        """
+        await self.request_queue.ensure_group(input_type)
+        pool_size = self.semaphore_manager.max_limit(input_type)
+        scheduler = FairScheduler(self.flow_weight)
+        in_flight = {}  # task -> (stream_key, entry_id) it is processing
+        last_claim = 0
+
+        while not self.stopping.is_set():
+            try:
+                if len(in_flight) >= pool_size:
+                    await asyncio.wait(set(in_flight), return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                flows = await self.request_queue.flows(input_type)
+                # Periodic housekeeping: keep read-ahead entries ours, take over ones left by crashed workers
+                if time.monotonic() - last_claim > self.CLAIM_INTERVAL:
+                    last_claim = time.monotonic()
+                    await self.maintain_flows(input_type, flows, scheduler, in_flight, pool_size)
+                    continue
+
+                # Read the head of every flow that has none buffered; only wait if nothing is buffered at all
+                empty = [stream_key for stream_key in flows if not scheduler.backlogged(stream_key)]
+                if len(scheduler):
+                    heads = await self.request_queue.read_heads(empty)
+                else:
+                    heads = await self._read_until_stopped(empty)
+                for stream_key, entry_id, envelope in heads:
+                    scheduler.push(stream_key, (entry_id, envelope))
+                if not len(scheduler):
+                    continue
+
+                count = min(pool_size - len(in_flight), await self.semaphore_manager.available_permits(input_type))
+                if count <= 0:
+                    if in_flight:
+                        # Our own requests hold the permits; wait for one to finish
+                        await asyncio.wait(set(in_flight), timeout=1, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    # Permits are held elsewhere: take one entry and queue for a permit
+                    count = 1
+
+                for _ in range(count):
+                    picked = scheduler.pop()
+                    if picked is None:
+                        break
+                    stream_key, (entry_id, envelope) = picked
+                    self.dispatch(input_type, stream_key, entry_id, envelope, in_flight)
+                    # Refill the flow just served so it competes for the next permit at its new tag
+                    for head in await self.request_queue.read_heads([stream_key]):
+                        scheduler.push(head[0], head[1:])
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Error reading {input_type} queue: {str(e)}")
+                await asyncio.sleep(1)
+
+        if in_flight:
+            self.logger.info(f"Draining {len(in_flight)} in-flight {input_type} requests")
+            _, pending = await asyncio.wait(set(in_flight), timeout=Config.WORKER_DRAIN_TIMEOUT)
+            # Unfinished entries stay pending in the stream and are claimed by another worker
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def maintain_flows(self, input_type, flows, scheduler, in_flight, pool_size):
+        """
+        Reset the idle time of read-ahead and in-flight entries so they are not
+        claimed from us (and run twice), run entries other workers left pending
+        past QUEUE_CLAIM_IDLE_MS (they have waited longest, so they skip the
+        scheduler), and forget idle flows.
+        """
+        ours = {}
+        for stream_key, (entry_id, _) in scheduler.entries():
+            ours.setdefault(stream_key, []).append(entry_id)
+        for stream_key, entry_id in list(in_flight.values()):
+            ours.setdefault(stream_key, []).append(entry_id)
+        for stream_key, entry_ids in ours.items():
+            await self.request_queue.touch(stream_key, entry_ids)
+        for stream_key in flows:
+            free = pool_size - len(in_flight)
+            if free <= 0:
                 break
-                
+            for entry_id, envelope in await self.request_queue.claim_stale(stream_key, free):
+                self.dispatch(input_type, stream_key, entry_id, envelope, in_flight)
+        await self.request_queue.prune_flows(input_type, Config.QUEUE_FLOW_IDLE_MS)
+        scheduler.forget_idle()
+
+    async def _read_until_stopped(self, stream_keys):
+        """Block on the flows for new entries, returning early with none if the worker is stopped."""
+        # Bounded so flows created while we wait are picked up soon
+        block_ms = min(Config.QUEUE_BLOCK_MS, self.FLOW_REFRESH_MS)
+        read_task = asyncio.create_task(self.request_queue.read_heads(stream_keys, block_ms))
+        stop_task = asyncio.create_task(self.stopping.wait())
+        try:
+            await asyncio.wait({read_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stop_task.cancel()
+        if not read_task.done():
+            # Anything delivered to the cancelled read stays pending and is claimed later
+            read_task.cancel()
+            await asyncio.gather(read_task, return_exceptions=True)
+            return []
+        return read_task.result()
+
+    async def export_metrics(self):
+        """
+        Publish this worker's metrics (queue wait per tenant and priority,
+        processing time, upstream calls) for the API's /llm/metrics and /metrics
+        """
+        key = f"metrics:worker:{self.request_queue.consumer}"
+        families_key = f"metrics:families:{self.request_queue.consumer}"
+        while not self.stopping.is_set():
             try:
-                # Parse the request data
-                request_data = json.loads(request_json)
-                req_id = request_data.get("id")
-                input_type = request_data.get("input_type")
-                input_data_str = request_data.get("input_data")
-                
-                # Convert input_data back to a dictionary if needed
-                try:
-                    import ast
-                    input_data = ast.literal_eval(input_data_str)  # Safer than eval
-                except:
-                    input_data = input_data_str
-                
-                # Process the request
-                await self.process_request(req_id, input_type, input_data)
-                
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    pipe.set(key, json.dumps(metrics.snapshot()), ex=3 * Config.WORKER_METRICS_INTERVAL)
+                    pipe.set(families_key, json.dumps(metrics.families()), ex=3 * Config.WORKER_METRICS_INTERVAL)
+                    await pipe.execute()
             except Exception as e:
-                self.logger.error(f"Error processing queued request: {str(e)}")
+                self.logger.warning(f"Could not export worker metrics: {str(e)}")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), Config.WORKER_METRICS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Stop taking new requests; run() returns once in-flight ones are drained."""
+        self.logger.info("Stopping worker: no new requests will be read")
+        self.stopping.set()
 
     async def run(self):
         """Main worker loop"""
         self.logger.info("Starting async worker")
         await self.initialize()
-        
-        while True:
-            # Process each queue type
-            tasks = []
-            for input_type in Config.RATE_LIMITS.keys():
-                tasks.append(self.process_queue(input_type))
-                
-            # Wait for all queue processing to complete
-            await asyncio.gather(*tasks)
-            
-            # Sleep to avoid busy waiting
-            await asyncio.sleep(1)
+
+        # One consumer loop per input type
+        await asyncio.gather(self.export_metrics(), *[
+            self.process_queue(input_type) for input_type in Config.RATE_LIMITS.keys()
+        ])
+        self.logger.info("Worker drained")
 
     async def cleanup(self):
         """Cleanup resources"""
+        if self.request_logger:
+            # Write out buffered status updates before the pool goes away
+            await self.request_logger.close()
         if self.db_pool:
             await self.db_pool.close()
         if self.redis_client:
             await self.redis_client.close()
         if self.semaphore_manager:
             await self.semaphore_manager.cleanup()
+        if self.request_queue:
+            await self.request_queue.cleanup()
+        if self.blob_store:
+            await self.blob_store.cleanup()
+        if self.status_cache:
+            await self.status_cache.cleanup()
+        if self.response_cache:
+            await self.response_cache.cleanup()
+        if self.circuit_breaker:
+            await self.circuit_breaker.cleanup()
+        if self.gemini_processor:
+            await self.gemini_processor.close()
+        tracing.shutdown()
 
 async def main():
     worker = AsyncWorker()
-    await worker.run()
+    try:
+        await worker.run()
+    finally:
+        await worker.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compare two load-test result files (benchmarks.load_test --output) and flag regressions.
+
+Throughput (`rps`) and permit utilization regress when they drop, latencies
+(`*_ms`) and durations (`*_s`) when they grow, by more than --threshold
+percent. Exits with status 1 if anything regressed, so it can gate CI.
+
+    python3 -m benchmarks.compare baseline.json current.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(results, prefix=""):
+    """Numeric leaves of a results dict as {"latency.ok.p99_ms": value}."""
+    values = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def direction(name):
+    """+1 if higher is better, -1 if lower is better, 0 for metrics that are only reported."""
+    leaf = name.rsplit(".", 1)[-1]
+    if leaf == "rps" or name.startswith("permit_utilization."):
+        return 1
+    if leaf.endswith("_ms") or leaf.endswith("_s"):
+        return -1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Percent change that counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get("scenario") != current.get("scenario"):
+        raise SystemExit(f"Scenarios differ: {baseline.get('scenario')} vs {current.get('scenario')}")
+
+    before, after = flatten(baseline["results"]), flatten(current["results"])
+    regressions = []
+    print(f"{'metric':<40} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name], after[name]
+        change = (new - old) / old * 100 if old else 0.0
+        regressed = direction(name) * change < -args.threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<40} {old:>12} {new:>12} {change:>+8.1f}%{'  REGRESSION' if regressed else ''}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:g}%: {', '.join(regressions)}")
+        sys.exit(1)
+    print(f"\nNo regressions over {args.threshold:g}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Minimal stand-in for the Gemini REST API, for load tests that must not hit the real service.
+
+Serves `generateContent` and `streamGenerateContent` (SSE) for any model with a
+configurable latency (plus random jitter), streaming chunk timing and error
+rate: a fraction of calls is answered with `--error-status` (429 by default)
+instead. Calls asking for JSON output get one {id, answer} entry per item of
+a batched prompt. Point the app at it with GEMINI_BASE_URL:
+
+    python3 -m benchmarks.fake_gemini --port 8089 --latency 0.2 --error-rate 0.05
+    GEMINI_BASE_URL=http://127.0.0.1:8089 GEMINI_API_KEY=fake python3 run_app.py
+"""
+import argparse
+import asyncio
+import json
+import random
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_fake_gemini(latency=0.2, chunks=3, chunk_interval=0.05, error_rate=0.0, error_status=429, jitter=0.0):
+    app = FastAPI(title="Fake Gemini")
+    app.state.calls = 0  # Upstream calls served, including errors
+
+    def delay():
+        return max(0.0, latency + random.uniform(-jitter, jitter))
+
+    def fail():
+        """Answer with an upstream error the way Gemini does, for a fraction of calls."""
+        if random.random() < error_rate:
+            status = "RESOURCE_EXHAUSTED" if error_status == 429 else "UNAVAILABLE"
+            body = {"error": {"code": error_status, "message": "Fake upstream error", "status": status}}
+            return JSONResponse(status_code=error_status, content=body)
+        return None
+
+    def response_body(text, prompt_tokens):
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": text}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": len(text) // 4,
+                "totalTokenCount": prompt_tokens + len(text) // 4,
+            },
+            "modelVersion": "fake",
+        }
+
+    def prompt_text(body):
+        return "".join(
+            part.get("text", "")
+            for content in body.get("contents", [])
+            for part in content.get("parts", [])
+        )
+
+    def answer(model, body):
+        """Plain text, or for JSON output one {id, answer} per item of the JSON list ending the prompt."""
+        config = body.get("generationConfig") or {}
+        if config.get("responseMimeType") != "application/json":
+            return f"Fake answer from {model}"
+        text = prompt_text(body)
+        try:
+            items = json.loads(text[text.index("["):])
+        except ValueError:
+            items = []
+        return json.dumps([{"id": item.get("id"), "answer": "no"} for item in items if isinstance(item, dict)])
+
+    @app.post("/{api_version}/models/{model_action}")
+    async def generate(api_version: str, model_action: str, request: Request):
+        model, _, action = model_action.partition(":")
+        body = await request.json()
+        tokens = max(1, len(prompt_text(body)) // 4)
+        app.state.calls += 1
+
+        if action == "generateContent":
+            await asyncio.sleep(delay())
+            return fail() or response_body(answer(model, body), tokens)
+
+        if action == "streamGenerateContent":
+            error = fail()
+            if error is not None:
+                return error
+
+            async def events():
+                await asyncio.sleep(delay())
+                for i in range(chunks):
+                    if i:
+                        await asyncio.sleep(chunk_interval)
+                    yield f"data: {json.dumps(response_body(f'chunk {i} ', tokens))}\r\n\r\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        raise HTTPException(status_code=404, detail=f"Unsupported action '{action}'")
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first byte")
+    parser.add_argument("--chunks", type=int, default=3, help="Chunks per streamed response")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="Seconds between streamed chunks")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency varies uniformly by up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with an error")
+    parser.add_argument("--error-status", type=int, default=429, help="Status code of those errors, e.g. 429 or 503")
+    args = parser.parse_args()
+
+    uvicorn.run(
+        create_fake_gemini(
+            args.latency, args.chunks, args.chunk_interval, args.error_rate, args.error_status, args.jitter
+        ),
+        host=args.host, port=args.port, log_level="warning",
+    )
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Load-test the rate limiter end to end against the local fake Gemini.
+
+Scenarios:
+  submit  POST /llm/submit at a fixed concurrency: RPS, latency p50/p99 of
+          answered and queued requests, and permit utilization.
+  stream  POST /llm/stream: time to first chunk and total time p50/p99, how
+          many were rate limited, and permit utilization.
+  worker  Enqueue a burst of requests over several tenants and run a worker
+          until all are done: queue drain time, RPS, enqueue-to-done latency
+          p50/p99, and permit utilization.
+
+The fake Gemini server (benchmarks/fake_gemini.py), the API and the worker all
+run in this process. Redis is REDIS_URL or an in-process fakeredis
+(`--redis fake`), and the request log is DATABASE_URL or an in-memory table
+(`--db memory`); see benchmarks/standins.py. Results are printed and, with
+--output, saved as JSON for benchmarks.compare.
+
+    python3 -m benchmarks.load_test submit --requests 500 --concurrency 50 --redis fake --db memory --output submit.json
+    python3 -m benchmarks.load_test stream --requests 200 --latency 0.3 --chunk-interval 0.02
+    python3 -m benchmarks.load_test worker --requests 300 --tenants 5 --error-rate 0.05 --error-status 503
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+import uvicorn
+
+
+def prompt(i):
+    # Distinct texts so the response cache cannot answer them; no image words, so they classify as text_only
+    return f"Benchmark prompt {i}: explain what a semaphore is in one sentence."
+
+
+def configure(args):
+    """
+    Environment for the app, set before anything under app/ is imported:
+    Config and GeminiProcessor's defaults are read at import time.
+    """
+    os.environ["GEMINI_BASE_URL"] = f"http://127.0.0.1:{args.gemini_port}"
+    os.environ.setdefault("GEMINI_API_KEY", "fake")
+    if args.redis == "fake":
+        os.environ["REDIS_URL"] = "redis://fakeredis"
+    if args.db == "memory":
+        os.environ["DATABASE_URL"] = "postgresql://memory"
+    os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+    from benchmarks.standins import use_fake_redis, use_memory_db
+
+    if args.redis == "fake":
+        use_fake_redis()
+    if args.db == "memory":
+        use_memory_db()
+
+
+async def serve(app, port):
+    """Run an ASGI app on a local port in this event loop; returns the server and its task."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            await task  # Startup failed; raise its error
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def shutdown(server, task):
+    server.should_exit = True
+    await task
+
+
+class PermitSampler:
+    """Samples held permits against each input type's current limit while a scenario runs."""
+
+    def __init__(self, semaphore_manager, interval=0.05):
+        self.semaphore_manager = semaphore_manager
+        self.interval = interval
+        self.samples = defaultdict(list)  # input_type -> utilization samples (0..1)
+
+    async def run(self, stop):
+        manager = self.semaphore_manager
+        while not stop.is_set():
+            limits = await manager.current_limits()
+            for input_type, limit in limits.items():
+                held = await manager.redis_client.zcard(manager._holders_key(input_type))
+                self.samples[input_type].append(held / limit if limit else 0.0)
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def summary(self):
+        return {
+            input_type: {"mean": round(statistics.mean(values), 3), "max": round(max(values), 3)}
+            for input_type, values in self.samples.items() if values and max(values) > 0
+        }
+
+
+def latency_stats(values):
+    from benchmarks.semaphore_acquire import percentile
+
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p99_ms": round(percentile(values, 99) * 1000, 1),
+    }
+
+
+async def drive(requests, concurrency, send):
+    """Run send(i) for every request with at most `concurrency` in flight. Returns (outcomes, timings, seconds)."""
+    limiter = asyncio.Semaphore(concurrency)
+    outcomes = Counter()
+    timings = defaultdict(list)  # metric -> seconds
+
+    async def one(i):
+        async with limiter:
+            try:
+                outcome, measured = await send(i)
+            except Exception as e:
+                outcome, measured = type(e).__name__, {}
+            outcomes[outcome] += 1
+            for metric, seconds in measured.items():
+                timings[metric].append(seconds)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return outcomes, timings, time.perf_counter() - start
+
+
+async def sampled(semaphore_manager, coro):
+    """Await `coro` while sampling permit utilization. Returns (its result, utilization summary)."""
+    sampler = PermitSampler(semaphore_manager)
+    stop = asyncio.Event()
+    sampling = asyncio.create_task(sampler.run(stop))
+    try:
+        result = await coro
+    finally:
+        stop.set()
+        await sampling
+    return result, sampler.summary()
+
+
+async def run_http(args, send):
+    """Serve the API in this process and drive `send(client, i)` against it."""
+    from app import create_app
+
+    application = create_app()
+    server, task = await serve(application, args.app_port)
+    try:
+        container = application.state.container
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}", timeout=120) as client:
+            (outcomes, timings, elapsed), utilization = await sampled(
+                container.semaphore_manager,
+                drive(args.requests, args.concurrency, lambda i: send(client, i)),
+            )
+    finally:
+        await shutdown(server, task)
+
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(sum(outcomes.values()) / elapsed, 1) if elapsed else 0.0,
+        "outcomes": dict(outcomes),
+        "latency": {metric: latency_stats(values) for metric, values in sorted(timings.items())},
+        "permit_utilization": utilization,
+    }
+
+
+async def submit_one(client, i):
+    start = time.perf_counter()
+    response = await client.post("/llm/submit", data={"text": prompt(i)}, headers={"X-Tenant-ID": f"t{i % 5}"})
+    elapsed = time.perf_counter() - start
+    outcome = {200: "ok", 202: "queued"}.get(response.status_code, f"http_{response.status_code}")
+    return outcome, {outcome: elapsed}
+
+
+async def stream_one(client, i):
+    start = time.perf_counter()
+    first = None
+    async with client.stream("POST", "/llm/stream", data={"text": prompt(i)}) as response:
+        async for chunk in response.aiter_bytes():
+            if first is None and chunk:
+                first = time.perf_counter() - start
+        total = time.perf_counter() - start
+    if response.status_code == 429:
+        return "rate_limited", {}
+    if response.status_code != 200:
+        return f"http_{response.status_code}", {}
+    return "ok", {"first_chunk": first if first is not None else total, "total": total}
+
+
+async def run_worker(args):
+    """Enqueue a burst of requests and time a worker draining them."""
+    from app.config import Config
+    from app.blob_store import create_blob_store
+    from app.request_queue import RequestQueue
+    from app.status_cache import FINAL_STATUSES
+    from app.worker import AsyncWorker
+
+    worker = AsyncWorker()
+    # What run() does, with startup kept out of the measured drain time
+    await worker.initialize()
+    running = asyncio.gather(worker.export_metrics(), *[
+        worker.process_queue(input_type) for input_type in Config.RATE_LIMITS.keys()
+    ])
+
+    blob_store = create_blob_store(Config.BLOB_STORE, Config.REDIS_URL, Config.BLOB_TTL, Config.BLOB_STORE_PATH)
+    await blob_store.initialize()
+    queue = RequestQueue(Config.REDIS_URL, blob_store, Config.QUEUE_CONSUMER_GROUP)
+    await queue.initialize()
+
+    async def drain():
+        enqueued = {}
+        start = time.perf_counter()
+        for i in range(args.requests):
+            req_id = str(uuid.uuid4())
+            enqueued[req_id] = time.perf_counter()
+            await queue.enqueue(
+                "text_only", req_id, {"text": prompt(i), "files": []}, datetime.now(), tenant=f"t{i % args.tenants}"
+            )
+
+        outcomes, done = Counter(), []
+        pending = list(enqueued)
+        while pending:
+            cached = await worker.redis_client.mget([f"status:{req_id}" for req_id in pending])
+            now = time.perf_counter()
+            still_pending = []
+            for req_id, record in zip(pending, cached):
+                status = json.loads(record)["status"] if record else None
+                if status in FINAL_STATUSES:
+                    outcomes[status] += 1
+                    done.append(now - enqueued[req_id])
+                else:
+                    still_pending.append(req_id)
+            pending = still_pending
+            if pending:
+                await asyncio.sleep(0.02)
+        return outcomes, done, time.perf_counter() - start
+
+    try:
+        (outcomes, done, elapsed), utilization = await sampled(worker.semaphore_manager, drain())
+    finally:
+        worker.stop()
+        await running
+        await worker.cleanup()
+        await queue.cleanup()
+        await blob_store.cleanup()
+
+    return {
+        "drain_s": round(elapsed, 3),
+        "rps": round(args.requests / elapsed, 1) if elapsed else 0.0,
+        "outcomes": dict(outcomes),
+        "latency": {"enqueue_to_done": latency_stats(done)},
+        "permit_utilization": utilization,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=["submit", "stream", "worker"])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="Clients in flight (submit, stream)")
+    parser.add_argument("--tenants", type=int, default=5, help="Tenants the worker burst is spread over")
+    parser.add_argument("--redis", choices=["fake", "url"], default="fake", help="fakeredis, or REDIS_URL")
+    parser.add_argument("--db", choices=["memory", "url"], default="memory", help="In-memory log, or DATABASE_URL")
+    parser.add_argument("--latency", type=float, default=0.2, help="Fake upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform latency jitter in seconds")
+    parser.add_argument("--chunks", type=int, default=3, help="Chunks per streamed response")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="Seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream calls that fail")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--gemini-port", type=int, default=8089)
+    parser.add_argument("--app-port", type=int, default=8090)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    configure(args)
+    from benchmarks.fake_gemini import create_fake_gemini
+
+    fake = create_fake_gemini(
+        args.latency, args.chunks, args.chunk_interval, args.error_rate, args.error_status, args.jitter
+    )
+    server, task = await serve(fake, args.gemini_port)
+    try:
+        if args.scenario == "submit":
+            results = await run_http(args, submit_one)
+        elif args.scenario == "stream":
+            results = await run_http(args, stream_one)
+        else:
+            results = await run_worker(args)
+    finally:
+        await shutdown(server, task)
+    results["upstream_calls"] = fake.state.calls
+
+    report = {
+        "scenario": args.scenario,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("scenario", "output")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "results": results,
+    }
+    print(json.dumps(report["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Measure GeminiProcessor throughput against the local fake Gemini server.
+
+Starts benchmarks.fake_gemini in-process and fires concurrent
+process_llm_request calls through the async client, then through the previous
+implementation (sync client on a worker thread followed by a blocking
+time.sleep) for comparison.
+
+    python3 -m benchmarks.processor_throughput --requests 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from google import genai
+from google.genai import types
+from app.llm_processor import GeminiProcessor, parse_request
+from benchmarks.fake_gemini import create_fake_gemini
+from benchmarks.semaphore_acquire import percentile
+
+
+class ThreadedGeminiProcessor(GeminiProcessor):
+    """The previous implementation: sync client in a thread plus a blocking sleep."""
+
+    def __init__(self, api_key, base_url, blocking_sleep):
+        super().__init__(api_key, base_url=base_url)
+        self.blocking_sleep = blocking_sleep
+        self.sync_client = genai.Client(
+            api_key=api_key, http_options=types.HttpOptions(base_url=base_url)
+        )
+
+    async def process_llm_request(self, input_data, lease=None, timeout=None):
+        response = await asyncio.to_thread(
+            self.sync_client.models.generate_content,
+            model=self.model,
+            contents=parse_request(input_data),
+        )
+        time.sleep(self.blocking_sleep)
+        return response.text
+
+
+async def run_load(processor, requests, concurrency):
+    limiter = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def one(i):
+        async with limiter:
+            start = time.perf_counter()
+            try:
+                await processor.process_llm_request({"text": f"benchmark prompt {i}"})
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(e)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+    return {
+        "ok": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="Fake upstream latency in seconds")
+    parser.add_argument("--blocking-sleep", type=float, default=2.0, help="time.sleep in the threaded path")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--mode", choices=["both", "threaded", "async"], default="both")
+    args = parser.parse_args()
+
+    server = uvicorn.Server(uvicorn.Config(
+        create_fake_gemini(args.latency), host="127.0.0.1", port=args.port, log_level="warning"
+    ))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    modes = {
+        "threaded": lambda: ThreadedGeminiProcessor("fake", base_url, args.blocking_sleep),
+        "async": lambda: GeminiProcessor("fake", base_url=base_url),
+    }
+    selected = modes if args.mode == "both" else {args.mode: modes[args.mode]}
+
+    print(f"{'mode':<10}{'ok':>8}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    try:
+        for name, factory in selected.items():
+            processor = factory()
+            stats = await run_load(processor, args.requests, args.concurrency)
+            await processor.close()
+            print(
+                f"{name:<10}{stats['ok']:>8}{stats['errors']:>8}{stats['rps']:>10.1f}"
+                f"{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+            )
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Measure SemaphoreManager acquire latency under contention.
+
+Runs N concurrent clients that repeatedly acquire a permit, hold it for a
+fixed service time and release it. Compares the notification-driven wait
+queue against the previous 1-second polling acquire, and against permits lent
+from a local block (--local-block permits reserved by the process).
+
+    python3 -m benchmarks.semaphore_acquire --clients 20 --limit 5 --hold 0.05
+"""
+import argparse
+import asyncio
+import functools
+import statistics
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Config
+from app.semaphore_manager import SemaphoreManager
+
+
+class PollingSemaphoreManager(SemaphoreManager):
+    """The original counter semaphore: retry the Lua script once per second."""
+
+    async def initialize(self):
+        await super().initialize()
+        for input_type, limit in self.rate_limits.items():
+            await self.redis_client.set(f"poll:{input_type}", limit)
+
+    async def acquire_semaphore(self, input_type):
+        if self.redis_client is None:
+            await self.initialize()
+
+        start_time = time.time()
+        lua_script = """
+        local current = tonumber(redis.call('GET', KEYS[1]))
+        if current and current > 0 then
+            return redis.call('DECR', KEYS[1])
+        else
+            return -1
+        end
+        """
+        while time.time() - start_time < self.timeout:
+            result = await self.redis_client.eval(lua_script, 1, f"poll:{input_type}")
+            if result != -1:
+                return input_type
+            await asyncio.sleep(1)
+
+        raise TimeoutError(f"Could not acquire semaphore for '{input_type}' within {self.timeout} seconds")
+
+    async def release_semaphore(self, input_type):
+        lua_script = """
+        local current = tonumber(redis.call('GET', KEYS[1]))
+        if current and current < tonumber(ARGV[1]) then
+            return redis.call('INCR', KEYS[1])
+        end
+        return current or 0
+        """
+        await self.redis_client.eval(lua_script, 1, f"poll:{input_type}", self.rate_limits[input_type])
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_client(manager, input_type, iterations, hold, latencies, timeouts):
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            lease = await manager.acquire_semaphore(input_type)
+        except TimeoutError:
+            timeouts.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+        try:
+            await asyncio.sleep(hold)
+        finally:
+            await manager.release_semaphore(lease)
+
+
+async def run_mode(manager_cls, args):
+    input_type = "benchmark"
+    manager = manager_cls(args.redis_url, {input_type: args.limit}, args.timeout)
+    await manager.initialize()
+    await manager.reset_semaphores()
+
+    latencies, timeouts = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(manager, input_type, args.iterations, args.hold, latencies, timeouts)
+        for _ in range(args.clients)
+    ])
+    elapsed = time.perf_counter() - start
+    await manager.cleanup()
+
+    return {
+        "acquired": len(latencies),
+        "timeouts": len(timeouts),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": (statistics.mean(latencies) if latencies else 0.0) * 1000,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=Config.REDIS_URL or "redis://localhost:6379/0")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--hold", type=float, default=0.05, help="Seconds each permit is held")
+    parser.add_argument("--timeout", type=float, default=Config.SEMAPHORE_TIMEOUT)
+    parser.add_argument("--local-block", type=int, default=0, help="Local permit block size; defaults to --limit")
+    parser.add_argument("--mode", choices=["all", "poll", "notify", "local"], default="all")
+    args = parser.parse_args()
+
+    modes = {
+        "poll": PollingSemaphoreManager,
+        "notify": SemaphoreManager,
+        "local": functools.partial(SemaphoreManager, local_permits=args.local_block or args.limit),
+    }
+    selected = modes if args.mode == "all" else {args.mode: modes[args.mode]}
+
+    print(f"{'mode':<8}{'acquired':>10}{'timeouts':>10}{'p50 ms':>10}{'p99 ms':>10}{'acq/s':>10}")
+    for name, manager_cls in selected.items():
+        stats = await run_mode(manager_cls, args)
+        print(
+            f"{name:<8}{stats['acquired']:>10}{stats['timeouts']:>10}"
+            f"{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['throughput']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
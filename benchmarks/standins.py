@@ -0,0 +1,95 @@
+"""
+In-process stand-ins for Redis and Postgres, so load tests run without either.
+
+Call use_fake_redis() / use_memory_db() before the app's services are built:
+
+- use_fake_redis(): every `redis.asyncio.from_url` client talks to one shared
+  fakeredis server. Needs fakeredis with Lua support, as the semaphore and
+  queue scripts are Lua (`pip install -r requirements-dev.txt`).
+- use_memory_db(): the request log keeps its table in memory. Rows still go
+  through RequestLogger's write-behind queue and batching; only the COPY and
+  merge into Postgres are replaced. Migrations are skipped.
+"""
+import redis.asyncio
+from app.config import Config
+from app.request_logger import RequestLogger
+
+
+def use_fake_redis():
+    """Point every Redis client at one in-process fakeredis server."""
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit('--redis fake needs fakeredis with Lua support: pip install -r requirements-dev.txt')
+
+    server = fakeredis.FakeServer()
+
+    async def from_url(url=None, **kwargs):
+        return fakeredis.FakeAsyncRedis(server=server, **kwargs)
+
+    # Services call redis.from_url on the module, so patching it covers all of them
+    redis.asyncio.from_url = from_url
+    return server
+
+
+class MemoryRequestLogger(RequestLogger):
+    """RequestLogger whose flushed rows land in a process-wide dict instead of Postgres."""
+
+    table = {}  # request_id -> record, shared by the API and worker in one process
+
+    async def _flush(self, batch):
+        for row in batch:
+            record = self._record(row)
+            current = self.table.get(record["request_id"])
+            # Same rule as the merge query: a final status is never overwritten by queued/processing
+            if current is None or current["status"] in ("queued", "processing") or \
+                    record["status"] not in ("queued", "processing"):
+                self.table[record["request_id"]] = record
+
+    async def _maintenance_loop(self):
+        pass
+
+    async def get_request(self, request_id):
+        row = self.overlay.get(str(request_id))
+        if row is not None:
+            return self._record(row)
+        return self.table.get(str(request_id))
+
+
+class _MemoryConnection:
+    async def execute(self, query, *args):
+        return None
+
+
+class _Acquire:
+    async def __aenter__(self):
+        return _MemoryConnection()
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class MemoryPool:
+    """Enough of an asyncpg pool for the health check; the request log never uses it."""
+
+    def acquire(self):
+        return _Acquire()
+
+    async def close(self):
+        pass
+
+
+def use_memory_db():
+    """Build the API and worker with the in-memory request log and no database pool."""
+    import asyncpg
+    import app.request_logger
+    import app.worker
+
+    async def create_pool(*args, **kwargs):
+        return MemoryPool()
+
+    asyncpg.create_pool = create_pool
+    app.request_logger.RequestLogger = MemoryRequestLogger
+    app.worker.RequestLogger = MemoryRequestLogger
+    Config.RUN_MIGRATIONS = False
+    return MemoryRequestLogger.table
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Measure API cold start: importing the app, and running its lifespan startup.
+
+Each run is a fresh interpreter, like a new uvicorn worker or a reload.
+Importing and building the app needs no services; with --lifespan the
+container is also started against DATABASE_URL and REDIS_URL and its
+per-step timings (database, migrations, llm_client, classifier, redis) are
+reported.
+
+    python3 -m benchmarks.startup_time --runs 5 --lifespan
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+import app
+application = app.create_app()
+result = {"import_ms": round((time.perf_counter() - start) * 1000, 1),
+          "genai_imported": "google.genai" in sys.modules}
+if LIFESPAN:
+    async def run():
+        async with app.lifespan(application):
+            result.update(application.state.container.startup_timings)
+    asyncio.run(run())
+print(json.dumps(result))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--lifespan", action="store_true", help="Also start the services (needs Postgres and Redis)")
+    args = parser.parse_args()
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD.replace("LIFESPAN", str(args.lifespan))],
+            capture_output=True, text=True, check=True, cwd=ROOT,
+        ).stdout.strip().splitlines()[-1]
+        results.append(json.loads(output))
+
+    steps = [key for key in results[0] if key != "genai_imported"]
+    print(f"{'step':<14}{'median ms':>12}{'max ms':>10}")
+    for step in steps:
+        values = sorted(result[step] for result in results)
+        print(f"{step:<14}{values[len(values) // 2]:>12.1f}{values[-1]:>10.1f}")
+    print(f"google.genai imported by create_app(): {results[0]['genai_imported']}")
+
+
+if __name__ == "__main__":
+    main()
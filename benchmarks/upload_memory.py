@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measure peak RSS of handling one multi-modal upload, buffered vs spooled.
+
+Each case runs in a fresh subprocess so ru_maxrss only reflects that case.
+"buffered" is the previous path: the whole UploadFile read into bytes, then
+stringified into the DB row and the queue entry. "spooled" is the current
+path: spool_upload to a memory-mapped temp file, metadata-only DB row, and
+inline bytes only for files under GEMINI_INLINE_MAX_BYTES (larger files are
+sent to the Files API from disk).
+
+    python3 -m benchmarks.upload_memory --sizes 10 100
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starlette.datastructures import UploadFile
+from app.config import Config
+from app.llm_processor import parse_request
+from app.request_logger import _loggable
+from app.uploads import spool_upload, release_uploads
+
+MB = 1024 * 1024
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_upload(size_mb):
+    """An UploadFile spooled to disk like Starlette's multipart parser does, filled chunk by chunk."""
+    spool = tempfile.SpooledTemporaryFile(max_size=MB)
+    for _ in range(size_mb):
+        spool.write(os.urandom(MB))
+    spool.seek(0)
+    return UploadFile(spool, size=size_mb * MB, filename="upload.bin")
+
+
+async def buffered(upload):
+    content = await upload.read()
+    input_data = {"text": "describe this", "files": [{"filename": upload.filename, "type": "application/pdf", "data": content}]}
+    parse_request(input_data)
+    row = str(input_data)
+    queue_entry = str(input_data)
+    return len(row) + len(queue_entry)
+
+
+async def spooled(upload):
+    file = await spool_upload(upload, "application/pdf", Config.UPLOAD_MAX_FILE_BYTES, Config.UPLOAD_CHUNK_SIZE)
+    input_data = {"text": "describe this", "files": [file]}
+    try:
+        if file["size"] <= Config.GEMINI_INLINE_MAX_BYTES:
+            parse_request(input_data)
+        return len(str(_loggable(input_data)))
+    finally:
+        release_uploads(input_data)
+
+
+def run_case(mode, size_mb):
+    upload = make_upload(size_mb)
+    before = peak_rss_mb()
+    asyncio.run({"buffered": buffered, "spooled": spooled}[mode](upload))
+    print(f"{peak_rss_mb() - before:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100], help="Upload sizes in MB")
+    parser.add_argument("--case", nargs=2, metavar=("MODE", "SIZE_MB"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case[0], int(args.case[1]))
+        return
+
+    print(f"{'size MB':<10}{'mode':<10}{'peak RSS growth MB':>20}")
+    for size_mb in args.sizes:
+        for mode in ("buffered", "spooled"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.upload_memory", "--case", mode, str(size_mb)],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            ).stdout.strip().splitlines()[-1]
+            print(f"{size_mb:<10}{mode:<10}{float(output):>20.1f}")
+
+
+if __name__ == "__main__":
+    main()
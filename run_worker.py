@@ -16,7 +16,13 @@ worker = None
 async def shutdown(signal, loop):
     """Cleanup tasks tied to the service's shutdown."""
     logger.info(f"Received exit signal {signal.name}...")
-    
+
+    # First signal: stop reading new requests and let in-flight ones finish.
+    if worker is not None and not worker.stopping.is_set():
+        worker.stop()
+        return
+
+    # Second signal: give up on draining.
     tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     
     logger.info(f"Cancelling {len(tasks)} outstanding tasks")
@@ -57,6 +63,10 @@ async def main():
     except Exception as e:
         logger.error(f"Error in worker process: {e}")
         raise
+    finally:
+        if worker is not None:
+            await worker.cleanup()
+        logger.info("Shutdown complete.")
 
 if __name__ == "__main__":
     try:
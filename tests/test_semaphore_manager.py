@@ -0,0 +1,193 @@
+"""
+SemaphoreManager's Lua lease state machine against an in-process fakeredis
+(the scripts need fakeredis[lua] from requirements-dev.txt; skipped without it).
+Each test builds its own server, so no state is shared between tests.
+"""
+import asyncio
+import json
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from app import semaphore_manager
+from app.semaphore_manager import Lease, SemaphoreManager, SemaphoreTimeout
+
+INPUT_TYPE = "text_only"
+
+
+def run(test):
+    """Run an async test body on a fresh event loop with a fresh fake Redis server."""
+    server = fakeredis.FakeServer()
+
+    async def from_url(url=None, **kwargs):
+        return fakeredis.FakeAsyncRedis(server=server, **kwargs)
+
+    async def body():
+        original = semaphore_manager.redis.from_url
+        semaphore_manager.redis.from_url = from_url
+        manager = SemaphoreManager("redis://fake", {INPUT_TYPE: 1}, timeout=5, lease_ttl=30)
+        try:
+            await manager.initialize()
+            await test(manager)
+        finally:
+            semaphore_manager.redis.from_url = original
+            await manager.redis_client.close()
+
+    asyncio.run(body())
+
+
+async def wait_for_waiters(manager, count):
+    """Let queued acquires reach the wait queue, so their order is known."""
+    for _ in range(200):
+        if await manager.redis_client.llen(manager._waiters_key(INPUT_TYPE)) == count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Expected {count} waiters")
+
+
+async def holders(manager):
+    return await manager.redis_client.zcard(manager._holders_key(INPUT_TYPE))
+
+
+async def enqueue(manager, token):
+    """Queue a waiter the way ACQUIRE_LUA does, without a coroutine waiting on it."""
+    return await manager.scripts["acquire"](
+        keys=[
+            manager._holders_key(INPUT_TYPE), manager._waiters_key(INPUT_TYPE), manager._marker_key(token),
+            manager._limit_key(INPUT_TYPE), manager._service_key(INPUT_TYPE),
+        ],
+        args=[manager.KEY_PREFIX, token, 1, 30000, 6000, json.dumps([]), 0, 0, 1, -1],
+    )
+
+
+def test_waiters_are_handed_permits_in_fifo_order():
+    async def test(manager):
+        first = await manager.acquire_semaphore(INPUT_TYPE)
+        second = asyncio.create_task(manager.acquire_semaphore(INPUT_TYPE))
+        await wait_for_waiters(manager, 1)
+        third = asyncio.create_task(manager.acquire_semaphore(INPUT_TYPE))
+        await wait_for_waiters(manager, 2)
+
+        await manager.release_semaphore(first)
+        second_lease = await asyncio.wait_for(second, 2)
+        assert not third.done()
+
+        await manager.release_semaphore(second_lease)
+        third_lease = await asyncio.wait_for(third, 2)
+        assert await holders(manager) == 1
+        await manager.release_semaphore(third_lease)
+        assert await holders(manager) == 0
+
+    run(test)
+
+
+def test_cancel_reports_a_grant_still_in_the_wake_list():
+    async def test(manager):
+        held = await manager.acquire_semaphore(INPUT_TYPE)
+        await enqueue(manager, "waiter")
+
+        # The release hands the permit to the queued waiter
+        await manager.release_semaphore(held)
+        assert await manager._cancel_wait(INPUT_TYPE, "waiter", None) == ""
+        await manager.release_semaphore(Lease(INPUT_TYPE, "waiter"))
+        assert await holders(manager) == 0
+
+    run(test)
+
+
+def test_cancel_after_the_hand_off_was_consumed_still_reports_the_grant():
+    async def test(manager):
+        held = await manager.acquire_semaphore(INPUT_TYPE)
+        await enqueue(manager, "waiter")
+        await manager.release_semaphore(held)
+
+        # A wait that popped its wake value and was then cancelled
+        assert await manager.redis_client.lpop(manager._wake_key("waiter")) == ""
+        assert await manager._cancel_wait(INPUT_TYPE, "waiter", None) == ""
+        await manager.release_semaphore(Lease(INPUT_TYPE, "waiter"))
+        assert await holders(manager) == 0
+
+    run(test)
+
+
+def test_cancel_without_a_grant_leaves_the_queue():
+    async def test(manager):
+        held = await manager.acquire_semaphore(INPUT_TYPE)
+        await enqueue(manager, "waiter")
+
+        assert await manager._cancel_wait(INPUT_TYPE, "waiter", None) is None
+        assert await manager.redis_client.llen(manager._waiters_key(INPUT_TYPE)) == 0
+        await manager.release_semaphore(held)
+        assert await holders(manager) == 0
+
+    run(test)
+
+
+def test_acquire_reaps_expired_leases():
+    async def test(manager):
+        # A lease of a crashed process: its expiry has long passed
+        await manager.redis_client.zadd(manager._holders_key(INPUT_TYPE), {"crashed": 1})
+
+        lease = await manager.try_acquire_semaphore(INPUT_TYPE)
+        assert lease is not None
+        members = await manager.redis_client.zrange(manager._holders_key(INPUT_TYPE), 0, -1)
+        assert members == [lease.lease_id]
+        await manager.release_semaphore(lease)
+
+    run(test)
+
+
+def test_full_semaphore_times_out_without_leaking_a_waiter():
+    async def test(manager):
+        manager.timeout = 0.2
+        held = await manager.acquire_semaphore(INPUT_TYPE)
+        with pytest.raises(SemaphoreTimeout):
+            await manager.acquire_semaphore(INPUT_TYPE)
+        assert await manager.redis_client.llen(manager._waiters_key(INPUT_TYPE)) == 0
+
+        await manager.release_semaphore(held)
+        assert await holders(manager) == 0
+
+    run(test)
+
+
+def test_cancelled_waiter_gives_back_a_permit_released_to_it():
+    async def test(manager):
+        held = await manager.acquire_semaphore(INPUT_TYPE)
+        waiter = asyncio.create_task(manager.acquire_semaphore(INPUT_TYPE))
+        await wait_for_waiters(manager, 1)
+
+        # Hand the permit over and cancel the waiter before it can use it
+        await manager.release_semaphore(held)
+        waiter.cancel()
+        try:
+            lease = await waiter
+        except asyncio.CancelledError:
+            lease = None
+        if lease is not None:
+            # It was woken before the cancel landed
+            await manager.release_semaphore(lease)
+        assert await holders(manager) == 0
+        assert await manager.redis_client.llen(manager._waiters_key(INPUT_TYPE)) == 0
+
+    run(test)
+
+
+def test_cancelled_waiter_is_not_handed_a_later_release():
+    async def test(manager):
+        held = await manager.acquire_semaphore(INPUT_TYPE)
+        waiter = asyncio.create_task(manager.acquire_semaphore(INPUT_TYPE))
+        await wait_for_waiters(manager, 1)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await manager.release_semaphore(held)
+        assert await holders(manager) == 0
+
+        lease = await manager.try_acquire_semaphore(INPUT_TYPE)
+        assert lease is not None
+        await manager.release_semaphore(lease)
+
+    run(test)